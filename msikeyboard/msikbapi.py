@@ -1,4 +1,79 @@
-import hidapi as hid
+import functools
+import threading
+from collections import deque, namedtuple
+from concurrent.futures import Future, InvalidStateError
+from contextlib import contextmanager
+from queue import Full
+from msikeyboard import msikblog
+from msikeyboard import msikbstats
+from msikeyboard import msikbtrace
+
+# hidapi is imported when the device is first opened
+hid = None
+
+
+def _importHid():
+    global hid
+    if hid is None:
+        import hidapi as hid
+
+
+def _planned(name):
+    # Collect every report sent by the wrapped method into one ReportPlan
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.Batch(name):
+                return method(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class ReportPlan:
+    def __init__(self, name=None):
+        self.name = name
+        self.operations = 0
+        self.mode = None
+        self.attributes = {}
+        self.zoneColors = {}
+        
+    def add(self, report):
+        self.operations += 1
+        command = report[1:2]
+        if command == MSIKeyboard.CMD_SET_MODE:
+            self.mode = report
+            # Colors set before a mode switch would be reset by it
+            self.zoneColors.clear()
+        elif command == MSIKeyboard.CMD_SET_MODE_ATTRIBUTE:
+            self.attributes[report[1:3]] = report
+        else:
+            self.zoneColors[report[1:3]] = report
+            
+    def reports(self):
+        # Attributes first so that a single mode switch latches all of them,
+        # zone colors last since a mode switch resets them
+        reports = list(self.attributes.values())
+        if self.mode is not None:
+            reports.append(self.mode)
+        reports.extend(self.zoneColors.values())
+        return reports
+
+
+# Ready-to-send reports of a whole mode application, see MSIKeyboard.Compile
+ReportProgram = namedtuple('ReportProgram', ['name', 'operations', 'reports'])
+
+
+class HidTransport:
+    # Opens keyboard controllers through hidapi. A transport's Open returns
+    # a device with send_feature_report(data, report_id) and close(), both
+    # raising OSError when the device is gone; see msikbsim for a simulated
+    # one.
+    def Open(self, keyboard):
+        _importHid()
+        if keyboard.path is not None:
+            return hid.Device(path=keyboard.path)
+        return hid.Device(vendor_id=keyboard.vendorID, product_id=keyboard.productID, serial_number=keyboard.serial)
+
 
 class MSIKeyboard:
     vendorID = 0x1770
@@ -13,6 +88,14 @@ class MSIKeyboard:
     CMD_SET_ZONE_COLOR = b'\x40'
     CMD_SET_MODE_ATTRIBUTE = b'\x44'
     
+    # Stats counter of the commands built by _sendCommand and its labels
+    COMMANDS_STAT = 'commands'
+    COMMAND_LABELS = {
+        CMD_SET_MODE: 'command="set_mode"', 
+        CMD_SET_ZONE_COLOR: 'command="set_zone_color"', 
+        CMD_SET_MODE_ATTRIBUTE: 'command="set_mode_attribute"'
+    }
+    
     KB_MODE_OFF = b'\x00'
     KB_MODE_NORMAL = b'\x01'
     KB_MODE_GAMING = b'\x02'
@@ -37,28 +120,193 @@ class MSIKeyboard:
         'faint-blue': 28
     }
     
-    def __init__(self):
-        self.dev = hid.Device(vendor_id=self.vendorID, product_id=self.productID, serial_number=self.serial)
+    def __init__(self, path=None, transport=None):
+        # HID device node to open, None for the first matching device
+        self.path = path
+        self.transport = transport if transport is not None else HidTransport()
+        # Shadow registers: last report confirmed by the controller, keyed by
+        # command (mode) or by command + zone/attribute byte
+        self.shadow = {}
+        # Attributes written since the last mode report; the next mode report
+        # latches them, so it has to be sent even if the mode is unchanged
+        self.pendingAttributes = set()
+        self.isForceWrite = False
+        # Translation table scaling the color bytes of every report written,
+        # None - colors as requested, see SetBrightness
+        self.colorScale = None
+        self.reportsSent = 0
+        self.reportsSkipped = 0
+        self.plan = None
+        # Plan name -> (operations requested, reports planned, reports sent)
+        self.planStats = {}
+        # The device is opened by Connect or by the first write
+        self.dev = None
+        self.isConnected = False
         self.state = 'stop'
+        # msikbtrace.TraceRecorder for every write, connect and disconnect,
+        # and this keyboard's device index in the trace
+        self.recorder = None
+        self.traceDevice = 0
     
     def Connect(self):
-        self.dev = hid.Device(vendor_id=self.vendorID, product_id=self.productID, serial_number=self.serial)
+        self.InvalidateShadow()
+        start = msikbtrace.clock()
+        try:
+            with msikbstats.stats.Timed('hid_connect'):
+                self.dev = self.transport.Open(self)
+        except OSError:
+            if self.recorder is not None:
+                self.recorder.Record(self.traceDevice, msikbtrace.CONNECT_FAILED, start=start)
+            raise
+        self.isConnected = True
+        if self.recorder is not None:
+            self.recorder.Record(self.traceDevice, msikbtrace.CONNECTED, start=start)
+        
+    def GetName(self):
+        if self.path is None:
+            return "keyboard"
+        return self.path.decode(errors='replace') if isinstance(self.path, bytes) else str(self.path)
+        
+    def EnsureConnected(self):
+        if not self.isConnected:
+            self.Connect()
     
     def Disconnect(self):
-        self.dev.close()
-    
-    def _writeToDevice(self, report):
+        self.InvalidateShadow()
+        self.isConnected = False
+        if self.recorder is not None:
+            self.recorder.Record(self.traceDevice, msikbtrace.DISCONNECTED)
+        if self.dev is not None:
+            self.dev.close()
+        
+    def InvalidateShadow(self):
+        self.shadow.clear()
+        self.pendingAttributes.clear()
+        
+    def SetBrightness(self, percent):
+        # Scale the colors of everything written from now on to percent of
+        # what's requested. Reports already written aren't touched; the
+        # shadow registers are cleared, so writing them again does.
+        percent = max(0, min(100, percent))
+        self.colorScale = None if percent == 100 else bytes(c * percent // 100 for c in range(256))
+        self.InvalidateShadow()
+        
+    def _scaleColors(self, report):
+        # Zone colors and the color attributes of composite modes; every
+        # third attribute (3, 6, 9) holds fade times and is left alone
+        command = report[1:2]
+        if command == self.CMD_SET_ZONE_COLOR or (command == self.CMD_SET_MODE_ATTRIBUTE and report[2] % 3):
+            return report[:3] + report[3:6].translate(self.colorScale) + report[6:]
+        return report
+        
+    def _shadowKey(self, report):
+        command = report[1:2]
+        if command == self.CMD_SET_MODE:
+            return command
+        return report[1:3]
+        
+    def _isShadowed(self, key, report):
+        if self.shadow.get(key) != report:
+            return False
+        if key == self.CMD_SET_MODE:
+            return not self.pendingAttributes
+        return True
+        
+    def _updateShadow(self, key, report):
+        if key == self.CMD_SET_MODE:
+            if self.shadow.get(key) != report:
+                # Zone colors are reset by a mode change, attribute registers
+                # are kept and latched by the new mode
+                for k in [k for k in self.shadow if k[:1] == self.CMD_SET_ZONE_COLOR]:
+                    del self.shadow[k]
+            self.pendingAttributes.clear()
+        elif key[:1] == self.CMD_SET_MODE_ATTRIBUTE:
+            self.pendingAttributes.add(key)
+        self.shadow[key] = report
+        
+    def _writeToDevice(self, report, force=False):
+        if self.colorScale is not None:
+            report = self._scaleColors(report)
+        key = self._shadowKey(report)
+        if not (force or self.isForceWrite) and self._isShadowed(key, report):
+            self.reportsSkipped += 1
+            msikbstats.stats.Count('hid_reports_skipped')
+            if self.recorder is not None:
+                self.recorder.Record(self.traceDevice, msikbtrace.SKIPPED, report, self.REPORT_ID)
+            return
+        if self.dev is None:
+            self.Connect()
+        elif not self.isConnected:
+            raise OSError("Keyboard is not connected")
+        start = msikbtrace.clock()
         try:
-            self.dev.send_feature_report(report, self.REPORT_ID)
+            with msikbstats.stats.Timed('hid_write'):
+                self.dev.send_feature_report(report, self.REPORT_ID)
         except OSError as e:
-            print("Device write failed: " + str(e))
-            self.Connect()
-            self.dev.send_feature_report(report, self.REPORT_ID)
-            print("Device write succeeded")
+            if self.recorder is not None:
+                self.recorder.Record(self.traceDevice, msikbtrace.FAILED, report, self.REPORT_ID, start)
+            # Reconnecting is up to the caller, see KeyboardWriter.onError
+            msikblog.Warn("Device write failed: %s", e)
+            try:
+                self.Disconnect()
+            except OSError:
+                pass
+            raise
+        if self.recorder is not None:
+            self.recorder.Record(self.traceDevice, msikbtrace.SENT, report, self.REPORT_ID, start)
+        self.reportsSent += 1
+        self._updateShadow(key, report)
+    
+    @contextmanager
+    def Batch(self, name=None):
+        if self.plan is not None:
+            if self.plan.name is None:
+                self.plan.name = name
+            yield self.plan
+            return
+        plan = self.plan = ReportPlan(name)
+        try:
+            yield plan
+        finally:
+            self.plan = None
+        self._flushPlan(plan)
+        
+    def _flushPlan(self, plan):
+        self._writeReports(plan.name, plan.operations, plan.reports())
+        
+    def _writeReports(self, name, operations, reports):
+        sentBefore = self.reportsSent
+        for report in reports:
+            self._writeToDevice(report)
+        if name is not None:
+            self.planStats[name] = (operations, len(reports), self.reportsSent - sentBefore)
+            
+    def Compile(self, apply, name=None):
+        # Run apply() against a detached keyboard that only plans reports, so
+        # compiling never touches the device or this keyboard's state and may
+        # run on another thread than the writes
+        compiler = ReportCompiler(name)
+        apply(compiler)
+        plan = compiler.plan
+        return ReportProgram(plan.name, plan.operations, tuple(plan.reports()))
+        
+    def Replay(self, program):
+        if self.plan is not None:
+            for report in program.reports:
+                self.plan.add(report)
+        else:
+            self._writeReports(program.name, program.operations, program.reports)
+            
+    def GetPlanStats(self):
+        return dict(self.planStats)
     
     def _sendCommand(self, command, arg1=b'\x00', arg2=b'\x00', arg3=b'\x00', arg4=b'\x00'):
         report = self.PREAMBLE + command + arg1 + arg2 + arg3 + arg4 + self.LAST_BYTE
-        self._writeToDevice(report)
+        msikbstats.stats.Count(self.COMMANDS_STAT, self.COMMAND_LABELS[command])
+        if self.plan is not None:
+            self.plan.add(report)
+        else:
+            self._writeToDevice(report)
         
     def _setMode(self, mode):
         self._sendCommand(self.CMD_SET_MODE, mode)
@@ -85,59 +333,214 @@ class MSIKeyboard:
     def _setWaveModeZone(self, zone, color_a=(255, 255, 255), color_b=(255, 255, 255), color_fade_time=(0, 0, 0)):
         self._setCompositeModeZone(self.KB_MODE_WAVE, zone, color_a, color_b, color_fade_time)
     
+    @_planned('Off')
     def SetOffMode(self):
         self._setMode(self.KB_MODE_OFF)
         
+    @_planned('Default')
     def SetDefaultMode(self):
         self._setMode(self.KB_MODE_DEFAULT)
         
+    @_planned('Plain')
     def SetPlainMode(self, mode_name):
         mode = self.plain_modes[mode_name]
         self._setMode(mode.to_bytes(1, 'little'))
         
+    @_planned('Gaming')
     def SetGamingMode(self, zone_color_r, zone_color_g, zone_color_b):
         self._setMode(self.KB_MODE_GAMING)
         self._setZoneColor(1, zone_color_r, zone_color_g, zone_color_b)
         
+    @_planned('Normal')
     def SetNormalMode(self, zone1_color=(255, 255, 255), zone2_color=(255, 255, 255), zone3_color=(255, 255, 255)):
         self._setMode(self.KB_MODE_NORMAL)
         self._setZoneColor(1, *zone1_color)
         self._setZoneColor(2, *zone2_color)
         self._setZoneColor(3, *zone3_color)
     
+    @_planned('DualColor')
     def SetDualModeAdvanced(self, zone1=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone2=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone3=((255, 255, 255), (255, 255, 255), (0, 0, 0))):
         self._setDualModeZone(1, *zone1)
         self._setDualModeZone(2, *zone2)
         self._setDualModeZone(3, *zone3)
         
+    @_planned('DualColor')
     def SetDualMode(self, color_a=(255, 255, 255), color_b=(255, 255, 255), color_fade_time=(0, 0, 0)):
         zone_setup = (color_a, color_b, color_fade_time)
         self.SetDualModeAdvanced(zone_setup, zone_setup, zone_setup)
     
+    @_planned('Breathing')
     def SetBreathingModeAdvanced(self, zone1=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone2=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone3=((255, 255, 255), (255, 255, 255), (0, 0, 0))):
         self._setBreathingModeZone(1, *zone1)
         self._setBreathingModeZone(2, *zone2)
         self._setBreathingModeZone(3, *zone3)
     
+    @_planned('Breathing')
     def SetBreathingMode(self, zone1_color=(255, 255, 255), zone1_time=(0, 0, 0), zone2_color=(255, 255, 255), zone2_time=(0, 0, 0), zone3_color=(255, 255, 255), zone3_time=(0, 0, 0)):
         zone1_setup = (zone1_color, (0, 0, 0), zone1_time)
         zone2_setup = (zone2_color, (0, 0, 0), zone2_time)
         zone3_setup = (zone3_color, (0, 0, 0), zone3_time)
         self.SetBreathingModeAdvanced(zone1_setup, zone2_setup, zone3_setup)
         
+    @_planned('Wave')
     def SetWaveModeAdvanced(self, zone1=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone2=((255, 255, 255), (255, 255, 255), (0, 0, 0)), zone3=((255, 255, 255), (255, 255, 255), (0, 0, 0))):
         self._setWaveModeZone(1, *zone1)
         self._setWaveModeZone(2, *zone2)
         self._setWaveModeZone(3, *zone3)
         
+    @_planned('Wave')
     def SetWaveMode(self, zone1_color=(255, 255, 255), zone1_time=(0, 0, 0), zone2_color=(255, 255, 255), zone2_time=(0, 0, 0), zone3_color=(255, 255, 255), zone3_time=(0, 0, 0)):
         zone1_setup = (zone1_color, (0, 0, 0), zone1_time)
         zone2_setup = (zone2_color, (0, 0, 0), zone2_time)
         zone3_setup = (zone3_color, (0, 0, 0), zone3_time)
         self.SetWaveModeAdvanced(zone1_setup, zone2_setup, zone3_setup)
     
+    @_planned('Audio')
     def SetAudioMode(self):
         self._setMode(self.KB_MODE_AUDIO)
     
 #    def __del__(self):
 #        self.dev.close()
+
+
+def EnumerateKeyboards():
+    # One MSIKeyboard per matching HID device node, opened by path so that
+    # identical controllers can be told apart
+    _importHid()
+    return [MSIKeyboard(info.path) for info in hid.enumerate(MSIKeyboard.vendorID, MSIKeyboard.productID) 
+            if info.serial_number == MSIKeyboard.serial]
+
+
+class ReportCompiler(MSIKeyboard):
+    # Keyboard stand-in used by MSIKeyboard.Compile: every report ends up in
+    # a plan that is never flushed
+    COMMANDS_STAT = 'commands_compiled'
+    
+    def __init__(self, name=None):
+        self.plan = ReportPlan(name)
+        
+    def _writeToDevice(self, report, force=False):
+        raise RuntimeError("Report compiler is not connected to a device")
+
+
+class KeyboardWriter:
+    # Owns the keyboard: every device access runs on one writer thread so a
+    # slow or failing USB transfer never blocks the caller
+    QUEUE_SIZE = 8
+    
+    def __init__(self, keyboard_object, on_error=None):
+        self.kb = keyboard_object
+        # Called on the writer thread with the exception of a failed action
+        self.onError = on_error
+        # Newest target state, applied again by Reapply after a reconnect
+        self.target = None
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.isRunning = True
+        self.coalesced = 0
+        self.thread = threading.Thread(target=self._run, name='msikeyboard-writer', daemon=True)
+        self.thread.start()
+        
+    def Submit(self, action, coalesce=True):
+        # action(keyboard_object) is run on the writer thread. A coalescing
+        # action describes a complete target state and supersedes the ones
+        # still waiting behind the last non-coalescing (barrier) action.
+        # Raises Full, leaving the queue and the target untouched, if the
+        # queue is full even without the actions this one would supersede
+        future = Future()
+        with self.cond:
+            if not self.isRunning:
+                raise RuntimeError("Keyboard writer is stopped")
+            superseded = 0
+            if coalesce:
+                while superseded < len(self.queue) and self.queue[-1 - superseded][1]:
+                    superseded += 1
+            if len(self.queue) - superseded >= self.QUEUE_SIZE:
+                raise Full("Keyboard writer queue is full")
+            if coalesce:
+                self.target = action
+                for _ in range(superseded):
+                    self.queue.pop()[2].cancel()
+                self.coalesced += superseded
+                msikbstats.stats.Count('writer_coalesced', '', superseded)
+            self.queue.append((action, coalesce, future))
+            self.cond.notify()
+        return future
+        
+    def Reapply(self):
+        if self.target is None:
+            return None
+        return self.Submit(self.target)
+        
+    def Stop(self):
+        # Writes already queued are still performed
+        with self.cond:
+            self.isRunning = False
+            self.cond.notify()
+        self.thread.join()
+        
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and self.isRunning:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                action, _, future = self.queue.popleft()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(action(self.kb))
+            except Exception as e:
+                msikblog.Warn("Keyboard write failed: %s", e)
+                future.set_exception(e)
+                if self.onError is not None:
+                    self.onError(e)
+
+
+def GatherFutures(futures):
+    # Future that is done once all of futures are: cancelled if any of them
+    # was superseded, failed with the first error if any failed, otherwise
+    # resolved with the list of their results
+    futures = list(futures)
+    gathered = Future()
+    if not futures:
+        gathered.set_result([])
+        return gathered
+    lock = threading.Lock()
+    remaining = [len(futures)]
+    
+    def onDone(future):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+        if any(f.cancelled() for f in futures):
+            gathered.cancel()
+            return
+        errors = [f.exception() for f in futures if f.exception() is not None]
+        if errors:
+            gathered.set_exception(errors[0])
+        else:
+            gathered.set_result([f.result() for f in futures])
+            
+    for future in futures:
+        future.add_done_callback(onDone)
+    return gathered
+
+
+def ChainFuture(source, target):
+    # Complete target the way source completes, unless target has been
+    # cancelled in the meantime
+    def onDone(future):
+        try:
+            if future.cancelled():
+                target.cancel()
+            elif future.exception() is not None:
+                target.set_exception(future.exception())
+            else:
+                target.set_result(future.result())
+        except InvalidStateError:
+            pass
+            
+    source.add_done_callback(onDone)
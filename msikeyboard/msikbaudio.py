@@ -0,0 +1,120 @@
+import importlib.util
+import os
+import stat
+import sys
+
+# Imported on first use, numpy is an optional and rather heavy dependency
+numpy = None
+
+
+def _importNumpy():
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            raise ValueError("numpy is required for audio analysis")
+
+
+def IsAvailable():
+    return numpy is not None or importlib.util.find_spec('numpy') is not None
+
+
+class AudioAnalyzer:
+    # Reads signed 16-bit little endian PCM from a file, a FIFO or stdin
+    # ('-') without blocking and computes left/middle/right zone levels
+    # from bass/mid/treble band energies of the newest window of samples.
+    WINDOW_SIZE = 2048
+    BANDS = ((20, 250), (250, 2000), (2000, 16000))
+    FLOOR_DB = -60.0
+    CEIL_DB = 0.0
+    DECAY = 0.85
+
+    def __init__(self, source, sample_rate=48000, channels=2):
+        _importNumpy()
+        if sample_rate <= 0 or channels <= 0:
+            raise ValueError("sample rate and channel count must be positive")
+        self.source = source
+        self.sampleRate = sample_rate
+        self.channels = channels
+        self.frameBytes = 2 * channels
+        self.fd = None
+        self.isRealTimeFile = False
+        self.remainder = b''
+        self.samplesRead = 0
+        self.framesAnalyzed = 0
+        self.samplesSkipped = 0
+        self.window = numpy.zeros(self.WINDOW_SIZE, dtype=numpy.float32)
+        self.hann = numpy.hanning(self.WINDOW_SIZE).astype(numpy.float32)
+        # Normalize so that a full scale sine peaks at about 0 dB
+        self.scale = 4.0 / (32768.0 * self.hann.sum()) ** 2
+        freqs = numpy.fft.rfftfreq(self.WINDOW_SIZE, 1.0 / sample_rate)
+        edges = [numpy.searchsorted(freqs, low) for low, _ in self.BANDS] + [numpy.searchsorted(freqs, self.BANDS[-1][1])]
+        self.edges = numpy.array(edges, dtype=numpy.intp)
+        self.levels = numpy.zeros(len(self.BANDS), dtype=numpy.float32)
+
+    def Open(self):
+        self.Close()
+        if self.source == '-':
+            self.fd = os.dup(sys.stdin.fileno())
+        else:
+            self.fd = os.open(self.source, os.O_RDONLY | os.O_NONBLOCK)
+        os.set_blocking(self.fd, False)
+        # A regular file has all data available at once, it is read at the
+        # pace of the stream instead
+        self.isRealTimeFile = stat.S_ISREG(os.fstat(self.fd).st_mode)
+        self.remainder = b''
+        self.samplesRead = 0
+        self.window[:] = 0
+        self.levels[:] = 0
+
+    def Close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def _read(self, elapsed):
+        if self.isRealTimeFile:
+            limit = (int(elapsed * self.sampleRate) - self.samplesRead) * self.frameBytes
+        else:
+            limit = self.WINDOW_SIZE * self.frameBytes * 16
+        chunks = []
+        while limit > 0:
+            try:
+                chunk = os.read(self.fd, limit)
+            except BlockingIOError:
+                break
+            if not chunk:
+                break
+            chunks.append(chunk)
+            limit -= len(chunk)
+        data = self.remainder + b''.join(chunks)
+        usable = len(data) - len(data) % self.frameBytes
+        self.remainder = data[usable:]
+        return data[:usable]
+
+    def Update(self, elapsed):
+        # Returns levels (0.0-1.0) for the three zones
+        data = self._read(elapsed)
+        if data:
+            samples = numpy.frombuffer(data, dtype='<i2').reshape(-1, self.channels).mean(axis=1, dtype=numpy.float32)
+            self.samplesRead += len(samples)
+            if len(samples) >= self.WINDOW_SIZE:
+                # Samples older than the newest window are never analyzed,
+                # which keeps latency bounded when the service fell behind
+                # or the frame rate is low
+                self.samplesSkipped += len(samples) - self.WINDOW_SIZE
+                self.window[:] = samples[-self.WINDOW_SIZE:]
+            else:
+                self.window[:-len(samples)] = self.window[len(samples):]
+                self.window[-len(samples):] = samples
+        spectrum = numpy.fft.rfft(self.window * self.hann)
+        power = (spectrum.real ** 2 + spectrum.imag ** 2) * self.scale
+        energies = numpy.add.reduceat(power, self.edges)[:len(self.BANDS)]
+        levels = (10.0 * numpy.log10(energies + 1e-12) - self.FLOOR_DB) / (self.CEIL_DB - self.FLOOR_DB)
+        numpy.maximum(numpy.clip(levels, 0.0, 1.0), self.levels * self.DECAY, out=self.levels)
+        self.framesAnalyzed += 1
+        return self.levels.tolist()
+
+    def GetStats(self):
+        return (self.framesAnalyzed, self.samplesSkipped)
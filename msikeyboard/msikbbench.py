@@ -0,0 +1,817 @@
+#!/usr/bin/python3
+
+# Benchmarks of report encoding, mode application and configuration
+# handling, run against simulated keyboards (see msikbsim) so no hardware or
+# bus is needed. Configuration benchmarks need the daemon's imports (dbus,
+# gi) and are skipped without them. 'check' runs correctness checks of the
+# planner, shadow registers, rules, transitions, control socket protocol and
+# simulator instead.
+#
+#   python3 -m msikeyboard.msikbbench run --output baseline.json
+#   python3 -m msikeyboard.msikbbench compare baseline.json
+#   python3 -m msikeyboard.msikbbench compare
+#   python3 -m msikeyboard.msikbbench check
+
+import gc
+import json
+import os
+import platform
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import Future
+from msikeyboard import msikbapi
+from msikeyboard import msikbeffects
+from msikeyboard import msikblog
+from msikeyboard import msikbsim
+
+FORMAT_VERSION = 1
+# Number of modes in the large generated configuration
+LARGE_CONFIG_MODES = 2000
+SMALL_CONFIG_MODES = 10
+# Relative slowdown or allocation growth reported as a regression
+DEFAULT_THRESHOLD = 0.1
+# Results of the reference machine, compared with if no baseline is given
+REFERENCE_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'data', 'bench-baseline.json')
+
+
+class SkipBenchmark(Exception):
+    pass
+
+
+class Benchmark:
+    # setup() returns (operation, transports): operation() is timed,
+    # transports are the simulated transports whose transfers count as
+    # reports sent. teardown(), if given, runs once afterwards.
+    def __init__(self, name, setup, teardown=None):
+        self.name = name
+        self.setup = setup
+        self.teardown = teardown
+
+
+def _simulatedKeyboard():
+    keyboard, = msikbsim.CreateKeyboards()
+    # Bypass the shadow registers, every operation does the full write
+    keyboard.isForceWrite = True
+    return keyboard
+
+
+def _keyboardBenchmark(name, operation):
+    # operation(keyboard) on a simulated keyboard
+    def setup():
+        keyboard = _simulatedKeyboard()
+        return (lambda: operation(keyboard)), [keyboard.transport]
+    return Benchmark(name, setup)
+
+
+WHITE = (255, 255, 255)
+ZONE = ((255, 0, 0), (0, 255, 0), (1, 2, 3))
+
+KEYBOARD_BENCHMARKS = [
+    _keyboardBenchmark('sendCommand', lambda kb: kb._sendCommand(kb.CMD_SET_ZONE_COLOR, b'\x01', b'\x10', b'\x20', b'\x30')),
+    _keyboardBenchmark('SetOffMode', lambda kb: kb.SetOffMode()),
+    _keyboardBenchmark('SetDefaultMode', lambda kb: kb.SetDefaultMode()),
+    _keyboardBenchmark('SetPlainMode', lambda kb: kb.SetPlainMode('red')),
+    _keyboardBenchmark('SetGamingMode', lambda kb: kb.SetGamingMode(255, 0, 0)),
+    _keyboardBenchmark('SetNormalMode', lambda kb: kb.SetNormalMode((255, 0, 0), (0, 255, 0), (0, 0, 255))),
+    _keyboardBenchmark('SetDualMode', lambda kb: kb.SetDualMode((255, 0, 0), (0, 0, 255), (1, 2, 3))),
+    _keyboardBenchmark('SetDualModeAdvanced', lambda kb: kb.SetDualModeAdvanced(ZONE, ZONE, ZONE)),
+    _keyboardBenchmark('SetBreathingMode', lambda kb: kb.SetBreathingMode(WHITE, (1, 2, 3), WHITE, (1, 2, 3), WHITE, (1, 2, 3))),
+    _keyboardBenchmark('SetBreathingModeAdvanced', lambda kb: kb.SetBreathingModeAdvanced(ZONE, ZONE, ZONE)),
+    _keyboardBenchmark('SetWaveMode', lambda kb: kb.SetWaveMode(WHITE, (1, 2, 3), WHITE, (1, 2, 3), WHITE, (1, 2, 3))),
+    _keyboardBenchmark('SetWaveModeAdvanced', lambda kb: kb.SetWaveModeAdvanced(ZONE, ZONE, ZONE)),
+    _keyboardBenchmark('SetAudioMode', lambda kb: kb.SetAudioMode()),
+]
+
+
+def _daemon():
+    try:
+        from msikeyboard import msikblightd
+        msikblightd._importMainLoop()
+    except ImportError as e:
+        raise SkipBenchmark("daemon imports unavailable: " + str(e))
+    return msikblightd
+
+
+def _sampleModes(daemon):
+    # One instance of every mode type that can be created here, by type name
+    color = (255, 128, 0)
+    times = (1, 2, 3)
+    factories = {
+        'Off': lambda: daemon.OffKeyboardMode(),
+        'Default': lambda: daemon.DefaultKeyboardMode(),
+        'Normal': lambda: daemon.NormalKeyboardMode((255, 0, 0), (0, 255, 0), (0, 0, 255)),
+        'Gaming': lambda: daemon.GamingKeyboardMode(color),
+        'DualColor': lambda: daemon.DualColorKeyboardMode((255, 0, 0), (0, 0, 255), times),
+        'Breathing': lambda: daemon.BreathingKeyboardMode(color, times, color, times, color, times),
+        'Wave': lambda: daemon.WaveKeyboardMode(color, times, color, times, color, times),
+        'Audio': lambda: daemon.AudioKeyboardMode(),
+        'Rainbow': lambda: daemon.RainbowKeyboardMode(4.0, 0.33, 255),
+        'Gradient': lambda: daemon.GradientKeyboardMode([(255, 0, 0), (0, 255, 0), (0, 0, 255)], 6.0, 0.2),
+        'Keyframes': lambda: daemon.KeyframesKeyboardMode([(0.0, (0, 0, 0), (0, 0, 0), (0, 0, 0)), (1.0, color, color, color)], True),
+        'AudioReactive': lambda: daemon.AudioReactiveKeyboardMode('default', 44100, 2, color, color, color),
+        'Metrics': lambda: daemon.MetricsKeyboardMode(('cpu', (0, 0, 0), (255, 0, 0), None, None), ('memory', (0, 0, 0), (0, 255, 0), None, None), ('io', (0, 0, 0), (0, 0, 255), None, None), 1.0),
+    }
+    modes = {}
+    for name, factory in factories.items():
+        try:
+            modes[name] = factory()
+        except ValueError:
+            # e.g. AudioReactive without numpy
+            pass
+    return modes
+
+
+def _modeBenchmark(type_name):
+    def setup():
+        mode = _sampleModes(_daemon()).get(type_name)
+        if mode is None:
+            raise SkipBenchmark("mode can't be created here")
+        keyboard = _simulatedKeyboard()
+        return (lambda: mode.setMode(keyboard)), [keyboard.transport]
+    return Benchmark('setMode[' + type_name + ']', setup)
+
+
+MODE_TYPES = ['Off', 'Default', 'Normal', 'Gaming', 'DualColor', 'Breathing', 'Wave', 'Audio', 'Rainbow', 'Gradient', 'Keyframes', 'AudioReactive', 'Metrics']
+MODE_BENCHMARKS = [_modeBenchmark(type_name) for type_name in MODE_TYPES]
+
+
+class _ServiceFixture:
+    # Service that is not on the bus, with a generated configuration of
+    # mode_count modes in a temporary directory
+    def __init__(self, mode_count, cached):
+        self.daemon = _daemon()
+        self.directory = tempfile.mkdtemp(prefix='msikbbench-')
+        self.configFile = os.path.join(self.directory, 'config.yaml')
+        cacheFile = os.path.join(self.directory, 'config.cache') if cached else None
+        self._writeConfig(mode_count)
+        self.keyboards = msikbsim.CreateKeyboards()
+        self.service = self.daemon.MSIKeyboardService(self.keyboards, self.configFile, cacheFile, None, export=False)
+        if not self.service.LoadConfig():
+            self.Close()
+            raise SkipBenchmark("generated configuration can't be loaded")
+
+    def _writeConfig(self, mode_count):
+        from msikeyboard import msikbconfig
+        samples = [{'type': type_name, 'config': mode.to_dict()} for type_name, mode in _sampleModes(self.daemon).items() if type_name != 'AudioReactive']
+        config_dict = {
+            'modes': [samples[index % len(samples)] for index in range(mode_count)],
+            'default_index': 0,
+            'handle_lid': False,
+            'handle_sleep': False,
+            'resume_to_connect_delay': 0.1,
+            'idle_timeout': 0,
+            # Keep the daemon's messages out of the tables
+            'log_level': 'error'
+        }
+        msikbconfig.WriteConfigFile(self.configFile, config_dict)
+
+    def Transports(self):
+        return [keyboard.transport for keyboard in self.keyboards]
+
+    def Close(self):
+        for device in self.service.devices:
+            device.Stop()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def _serviceBenchmark(name, mode_count, operation, cached=False):
+    # operation(service) on a service with a loaded configuration
+    fixtures = []
+    def setup():
+        fixture = _ServiceFixture(mode_count, cached)
+        fixtures.append(fixture)
+        return (lambda: operation(fixture.service)), fixture.Transports()
+    def teardown():
+        while fixtures:
+            fixtures.pop().Close()
+    return Benchmark(name, setup, teardown)
+
+
+CONFIG_BENCHMARKS = []
+for _size, _count in (('small', SMALL_CONFIG_MODES), ('large', LARGE_CONFIG_MODES)):
+    CONFIG_BENCHMARKS += [
+        _serviceBenchmark('LoadConfig[' + _size + ']', _count, lambda service: service.LoadConfig()),
+        _serviceBenchmark('LoadConfig[' + _size + ',snapshot]', _count, lambda service: service.LoadConfig(), cached=True),
+        _serviceBenchmark('SaveConfig[' + _size + ']', _count, lambda service: service.SaveConfig(Forced=True)),
+        _serviceBenchmark('getConfigDict[' + _size + ']', _count, lambda service: service._getConfigDict()),
+    ]
+
+def _transitionBenchmark(easing):
+    # One crossfade frame computed and written, at a different point of the
+    # transition every time
+    def setup():
+        keyboard = _simulatedKeyboard()
+        transition = msikbeffects.Transition(msikbeffects.toLinear(ZONE), ((0, 0, 255), WHITE, (0, 0, 0)), 1.0, easing)
+        times = [step / 100 for step in range(100)]
+        position = [0]
+
+        def operation():
+            position[0] = (position[0] + 1) % len(times)
+            keyboard.SetNormalMode(*transition.getFrame(times[position[0]]))
+        return operation, [keyboard.transport]
+    return Benchmark('transitionFrame[' + easing + ']', setup)
+
+
+TRANSITION_BENCHMARKS = [_transitionBenchmark(easing) for easing in msikbeffects.EASINGS]
+
+BENCHMARKS = KEYBOARD_BENCHMARKS + MODE_BENCHMARKS + TRANSITION_BENCHMARKS + CONFIG_BENCHMARKS
+
+
+def _timeOperations(operation, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        operation()
+    return time.perf_counter() - start
+
+
+def _allocatedBytes(operation, count):
+    # Peak memory allocated while one operation runs, averaged over count
+    # operations. Measured apart from the timing, tracemalloc slows
+    # allocations down considerably.
+    total = 0
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            base = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            operation()
+            total += tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return total / count
+
+
+def RunBenchmark(benchmark, min_time=1.0, rounds=5):
+    # Returns the result dict, raises SkipBenchmark
+    operation, transports = benchmark.setup()
+    try:
+        operation()
+        # Ops per round so that a round takes at least min_time / rounds
+        count = 1
+        while True:
+            elapsed = _timeOperations(operation, count)
+            if elapsed >= min_time / rounds:
+                break
+            count = max(count * 2, int(count * min_time / rounds / max(elapsed, 1e-9)) + 1)
+        transfers = sum(transport.transfers for transport in transports)
+        gc.collect()
+        timings = [elapsed] + [_timeOperations(operation, count) for _ in range(rounds - 1)]
+        reports = sum(transport.transfers for transport in transports) - transfers
+        alloc = _allocatedBytes(operation, max(1, min(count, 100)))
+    finally:
+        if benchmark.teardown is not None:
+            benchmark.teardown()
+    return {
+        'ops_per_sec': count / statistics.median(timings),
+        'reports_per_op': reports / (count * (rounds - 1)),
+        'alloc_bytes_per_op': alloc
+    }
+
+
+def RunBenchmarks(pattern=None, min_time=1.0, rounds=5, out=sys.stdout):
+    results = {}
+    for benchmark in BENCHMARKS:
+        if pattern is not None and not re.search(pattern, benchmark.name):
+            continue
+        try:
+            result = RunBenchmark(benchmark, min_time, rounds)
+        except SkipBenchmark as e:
+            print("%-34s skipped: %s" % (benchmark.name, e), file=out)
+            continue
+        results[benchmark.name] = result
+        print("%-34s %12.1f ops/s %6.2f reports/op %10.0f B/op" % (benchmark.name, result['ops_per_sec'], result['reports_per_op'], result['alloc_bytes_per_op']), file=out)
+    return results
+
+
+def _environment():
+    return {'python': platform.python_version(), 'implementation': platform.python_implementation(), 'machine': platform.machine()}
+
+
+def SaveResults(file_name, results):
+    with open(file_name, 'w') as results_file:
+        json.dump({'version': FORMAT_VERSION, 'environment': _environment(), 'results': results}, results_file, indent=2, sort_keys=True)
+        results_file.write('\n')
+
+
+def LoadResults(file_name):
+    with open(file_name) as results_file:
+        data = json.load(results_file)
+    if data.get('version') != FORMAT_VERSION:
+        raise ValueError("unsupported benchmark results format in '" + file_name + "'")
+    return data
+
+
+def CompareResults(baseline, current, threshold=DEFAULT_THRESHOLD, out=sys.stdout, compare_speed=True):
+    # Prints the comparison, returns the names of regressed benchmarks. A
+    # benchmark regresses if it is more than threshold slower (unless
+    # compare_speed is False, e.g. for a baseline from another machine),
+    # allocates more than threshold more, or sends more reports per
+    # operation.
+    regressions = []
+    for name in sorted(set(baseline) | set(current)):
+        if name not in current:
+            print("%-34s missing" % name, file=out)
+            continue
+        if name not in baseline:
+            print("%-34s new" % name, file=out)
+            continue
+        base = baseline[name]
+        result = current[name]
+        speed = result['ops_per_sec'] / base['ops_per_sec'] - 1
+        alloc = (result['alloc_bytes_per_op'] + 1) / (base['alloc_bytes_per_op'] + 1) - 1
+        problems = []
+        if compare_speed and speed < -threshold:
+            problems.append("slower")
+        if alloc > threshold:
+            problems.append("allocates more")
+        if result['reports_per_op'] > base['reports_per_op'] + 1e-9:
+            problems.append("sends more reports")
+        if problems:
+            regressions.append(name)
+        print("%-34s %+7.1f%% ops/s %6.2f -> %-6.2f reports/op %+7.1f%% B/op  %s" % (name, speed * 100, base['reports_per_op'], result['reports_per_op'], alloc * 100,
+              "REGRESSION: " + ", ".join(problems) if problems else "ok"), file=out)
+    return regressions
+
+
+class CheckFailed(Exception):
+    pass
+
+
+def _expect(condition, message):
+    # Not assert, the checks must also fail under python -O
+    if not condition:
+        raise CheckFailed(message)
+
+
+def _checkPlanner():
+    keyboard, = msikbsim.CreateKeyboards()
+    transport = keyboard.transport
+    # One mode report latches the attributes of all three zones
+    keyboard.SetDualModeAdvanced(ZONE, ZONE, ZONE)
+    _expect(transport.transfers == 10, "dual color mode took " + str(transport.transfers) + " reports, expected 9 attributes and 1 mode")
+    mode, _, attributes = transport.controller.GetState()
+    _expect(mode == keyboard.KB_MODE_DUAL[0], "dual color mode not set")
+    _expect(attributes == {zone * 3 + index + 1: ZONE[index] for zone in range(3) for index in range(3)}, "attributes not latched: " + str(attributes))
+    # A zone color set before a mode switch is dropped, the last one wins
+    sent = transport.transfers
+    with keyboard.Batch('check'):
+        keyboard._setZoneColor(1, 1, 2, 3)
+        keyboard.SetNormalMode(WHITE, WHITE, WHITE)
+        keyboard._setZoneColor(2, 4, 5, 6)
+    _expect(transport.transfers - sent == 4, "batch took " + str(transport.transfers - sent) + " reports, expected 1 mode and 3 zone colors")
+    _expect(keyboard.GetPlanStats()['check'] == (6, 4, 4), "plan stats " + str(keyboard.GetPlanStats()['check']))
+    mode, zones, _ = transport.controller.GetState()
+    _expect(mode == keyboard.KB_MODE_NORMAL[0] and zones == {1: WHITE, 2: (4, 5, 6), 3: WHITE}, "batch shows " + str((mode, zones)))
+    # A compiled program writes nothing until it is replayed
+    sent = transport.transfers
+    program = keyboard.Compile(lambda kb: kb.SetNormalMode(*ZONE), 'Normal')
+    _expect(transport.transfers == sent and len(program.reports) == 4, "compiling wrote to the keyboard or planned " + str(len(program.reports)) + " reports")
+    keyboard.Replay(program)
+    _expect(transport.controller.GetState()[1] == {1: ZONE[0], 2: ZONE[1], 3: ZONE[2]}, "replayed program not shown")
+
+
+def _checkShadowCache():
+    keyboard, = msikbsim.CreateKeyboards()
+    transport = keyboard.transport
+    keyboard.SetNormalMode(*ZONE)
+    sent = transport.transfers
+    keyboard.SetNormalMode(*ZONE)
+    _expect(transport.transfers == sent, "unchanged colors were written again")
+    keyboard.SetNormalMode(ZONE[0], ZONE[1], WHITE)
+    _expect(transport.transfers == sent + 1, "more than the changed zone was written")
+    # Changed attributes need a mode report to be latched, even if the mode
+    # is unchanged
+    keyboard.SetDualMode(*ZONE)
+    sent = transport.transfers
+    keyboard.SetDualMode(WHITE, ZONE[1], ZONE[2])
+    _expect(transport.transfers == sent + 4, "changing one color of every zone took " + str(transport.transfers - sent) + " reports, expected 3 attributes and 1 mode")
+    _expect(transport.controller.GetState()[2][1] == WHITE, "changed attribute not latched")
+    # A mode change resets the zone colors, so they are written again
+    keyboard.SetNormalMode(*ZONE)
+    keyboard.SetGamingMode(*WHITE)
+    sent = transport.transfers
+    keyboard.SetNormalMode(*ZONE)
+    _expect(transport.transfers == sent + 4, "zone colors reset by a mode change were not written again")
+    keyboard.InvalidateShadow()
+    sent = transport.transfers
+    keyboard.SetNormalMode(*ZONE)
+    _expect(transport.transfers == sent + 4, "invalidated shadow registers still skip writes")
+
+
+def _checkRules():
+    from datetime import datetime
+    from msikeyboard import msikbrules
+    # 2026-10-16 is a Friday
+    friday = datetime(2026, 10, 16, 12, 0)
+    night, = msikbrules.ParseRules([{'mode': 1, 'from': '22:00', 'to': '06:00', 'days': ['fri']}])
+    for now, expected in ((friday, False), (friday.replace(hour=23), True), (datetime(2026, 10, 17, 1, 0), True), (datetime(2026, 10, 17, 23, 0), False), (datetime(2026, 10, 17, 6, 0), False)):
+        _expect(night.Matches(now, None, False) == expected, "night rule at " + str(now) + " should " + ("" if expected else "not ") + "match")
+    _expect(night.NextEdge(friday) == friday.replace(hour=22).timestamp(), "next edge of the night rule isn't 22:00")
+    # YAML reads an unquoted 22:00 as 1320
+    _expect(msikbrules.Rule.FromDict({'mode': 1, 'from': 1320, 'to': '06:00', 'days': ['fri']}) == night, "'from: 22:00' read by YAML is a different rule")
+    battery, idle = msikbrules.ParseRules([{'mode': 'dim', 'power': 'battery'}, {'mode': 0, 'idle': True}])
+    _expect(not battery.Matches(friday, None, False), "power rule matches while the power source is unknown")
+    _expect(battery.Matches(friday, True, False) and not battery.Matches(friday, False, False), "power rule doesn't follow the power source")
+    _expect(idle.Matches(friday, None, True) and not idle.Matches(friday, None, False), "idle rule doesn't follow the idle hint")
+    _expect(msikbrules.UsesPower([night, battery]) and not msikbrules.UsesPower([night, idle]), "UsesPower")
+    _expect(msikbrules.UsesIdle([idle]) and not msikbrules.UsesIdle([night, battery]), "UsesIdle")
+    for description in ({'mode': 1, 'from': '24:00'}, {'mode': -1}, {'mode': 1, 'days': ['friday']}, {'mode': 1, 'power': 'usb'}, {'mode': 1, 'idle': 'yes'}):
+        try:
+            msikbrules.Rule.FromDict(description)
+        except ValueError:
+            continue
+        raise CheckFailed("invalid rule " + str(description) + " accepted")
+
+
+def _checkTransition():
+    start = ((0, 0, 0), WHITE, (10, 20, 30))
+    target = ((255, 0, 0), (0, 0, 0), (10, 20, 30))
+    for easing in msikbeffects.EASINGS:
+        transition = msikbeffects.Transition(msikbeffects.toLinear(start), target, 2.0, easing)
+        _expect(transition.getFrame(0.0) == start, easing + ": first frame isn't the start")
+        red = [transition.getFrame(step / 10)[0][0] for step in range(20)]
+        _expect(red == sorted(red), easing + ": not monotonic " + str(red))
+        _expect(not transition.isDone, easing + ": done before the end")
+        _expect(transition.getFrame(2.0) == target and transition.isDone, easing + ": last frame isn't the target")
+        _expect(transition.current == msikbeffects.toLinear(target), easing + ": last frame doesn't retarget from the target")
+    # Blended in linear light: halfway from black to white is sRGB 187, not 128
+    transition = msikbeffects.Transition(msikbeffects.toLinear(((0, 0, 0),) * 3), (WHITE,) * 3, 2.0, 'linear')
+    _expect(transition.getFrame(1.0)[0] == (187, 187, 187), "linear midpoint is " + str(transition.getFrame(1.0)[0]))
+    # onDone only after the last frame and only if not superseded
+    done = []
+    transition = msikbeffects.Transition(msikbeffects.toLinear(start), target, 2.0, on_done=done.append)
+    transition.getFrame(1.0)
+    transition.onStop()
+    _expect(not done, "onDone called for an unfinished transition")
+    transition.getFrame(2.0)
+    transition.isSuperseded = True
+    transition.onStop()
+    _expect(not done, "onDone called for a superseded transition")
+    transition.isSuperseded = False
+    transition.onStop()
+    _expect(done == [transition], "onDone not called for a finished transition")
+
+
+class _SocketService:
+    # Just what ControlServer.Handle uses of the daemon
+    def __init__(self, error=None):
+        self.devices = []
+        self.modes = [None] * 3
+        self.error = error
+        self.requests = []
+
+    def _noteActivity(self):
+        pass
+
+    def SetModeImpl(self, mode_index):
+        if self.error is not None:
+            raise self.error
+        self.requests.append(mode_index)
+        return object()
+
+
+def _checkSocketProtocol():
+    import socket
+    from queue import Full
+    from msikeyboard import msikbsocket
+    directory = tempfile.mkdtemp(prefix='msikbbench-')
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        path = os.path.join(directory, 'control')
+        listener.bind(path)
+        listener.listen(1)
+        client = msikbsocket.ControlClient(path)
+        server, _ = listener.accept()
+        try:
+            client.requestId = 0xFFFFFFFF
+            first = client.SendSetMode(2, 1, wait=True)
+            second = client.SendSetZoneColors({1: (1, 2, 3), 3: (4, 5, 6)})
+            _expect(first == 0 and second == 1, "request IDs don't wrap around")
+            data = b''
+            while len(data) < 2 * msikbsocket.REQUEST.size:
+                data += server.recv(4096)
+            (opcode, target, flags, request_id, payload), (opcode2, target2, flags2, _, payload2) = msikbsocket.REQUEST.iter_unpack(data)
+            _expect((opcode, target, flags, request_id) == (msikbsocket.OP_SET_MODE, 1, msikbsocket.FLAG_WAIT, 0), "set mode request header")
+            _expect(msikbsocket.MODE_PAYLOAD.unpack(payload) == (2,), "set mode payload")
+            _expect((opcode2, target2, flags2) == (msikbsocket.OP_SET_ZONE_COLORS, msikbsocket.TARGET_ALL, 0), "zone colors request header")
+            _expect(msikbsocket.ZONES_PAYLOAD.unpack(payload2) == (1, 1, 2, 3, 0, 0, 0, 0, 1, 4, 5, 6), "zone colors payload")
+            # Responses split anywhere are reassembled
+            responses = msikbsocket.RESPONSE.pack(msikbsocket.OP_SET_MODE, msikbsocket.STATUS_OK, 0, 0, -1, 0, 0, 0)
+            responses += msikbsocket.RESPONSE.pack(msikbsocket.OP_QUERY_STATE, msikbsocket.STATUS_OK, 0, 1, 2, 3, msikbsocket.STATE_BUSY, 4)
+            server.sendall(responses[:5])
+            server.sendall(responses[5:])
+            _expect(client.Receive() == (msikbsocket.OP_SET_MODE, msikbsocket.STATUS_OK, 0, -1, 0, 0, 0), "first response")
+            _expect(client.Receive() == (msikbsocket.OP_QUERY_STATE, msikbsocket.STATUS_OK, 1, 2, 3, msikbsocket.STATE_BUSY, 4), "second response")
+        finally:
+            server.close()
+            client.Close()
+    finally:
+        listener.close()
+        shutil.rmtree(directory, ignore_errors=True)
+    # Requests handled by the server, without a main loop
+    service = _SocketService()
+    control = msikbsocket.ControlServer(service, None)
+    def status(response):
+        return msikbsocket.RESPONSE.unpack(response)[1]
+    setMode = lambda mode_index, target=msikbsocket.TARGET_ALL: control.Handle(None, msikbsocket.OP_SET_MODE, target, 0, 7, msikbsocket.MODE_PAYLOAD.pack(mode_index))
+    _expect(status(setMode(1)) == msikbsocket.STATUS_OK and service.requests == [1], "valid set mode not accepted")
+    _expect(status(setMode(3)) == msikbsocket.STATUS_INVALID, "mode index out of range accepted")
+    _expect(status(setMode(1, 0)) == msikbsocket.STATUS_INVALID, "unknown device accepted")
+    _expect(status(control.Handle(None, 99, msikbsocket.TARGET_ALL, 0, 7, bytes(12))) == msikbsocket.STATUS_INVALID, "unknown opcode accepted")
+    service.error = Full()
+    _expect(status(setMode(1)) == msikbsocket.STATUS_BUSY, "full writer queue not reported as busy")
+
+
+def _checkSimulator():
+    import errno
+    keyboard, = msikbsim.CreateKeyboards()
+    transport = keyboard.transport
+    controller = transport.controller
+    keyboard.SetNormalMode(*ZONE)
+    keyboard.SetGamingMode(*WHITE)
+    _expect(controller.GetState()[:2] == (keyboard.KB_MODE_GAMING[0], {1: WHITE}), "mode change didn't reset the zone colors")
+    _expect(controller.GetStats() == (6, 0, 2), "controller stats " + str(controller.GetStats()))
+    controller.Receive(b'\x02\x41\x01\x00\x00\x00\x01', keyboard.REPORT_ID)
+    controller.Receive(b'\x02\x41\x01\x00\x00\x00\x00', 2)
+    controller.Receive(b'\x02\x42\x01\x00\x00\x00\x00', keyboard.REPORT_ID[0])
+    _expect(controller.GetStats()[1] == 3, "invalid reports not counted")
+    # Unplugged, the open handle and every Open fail until it is plugged in
+    transport.Unplug()
+    for operation in (lambda: keyboard.dev.send_feature_report(b'\x02\x41\x01\x00\x00\x00\x00', 1), lambda: transport.Open(keyboard)):
+        try:
+            operation()
+        except OSError as e:
+            _expect(e.errno == errno.ENODEV, "unplugged keyboard failed with " + str(e))
+        else:
+            raise CheckFailed("unplugged keyboard still works")
+    transport.Plug()
+    transport.Open(keyboard).send_feature_report(b'\x02\x41\x01\x00\x00\x00\x00', 1)
+    failing = msikbsim.SimulatedTransport(error_rate=1.0)
+    try:
+        failing.Open(None).send_feature_report(b'\x02\x41\x01\x00\x00\x00\x00', 1)
+    except OSError as e:
+        _expect(e.errno == errno.EIO and failing.GetStats() == (1, 1, 0), "injected error " + str(e) + ", stats " + str(failing.GetStats()))
+    else:
+        raise CheckFailed("error_rate=1 didn't fail the transfer")
+    _expect(msikbsim.ParseOptions('devices=2, latency=0.5') == {'devices': 2, 'latency': 0.5}, "options not parsed")
+    for spec in ('speed=1', 'latency', 'latency=x', 'jitter=-1', 'devices=0'):
+        try:
+            msikbsim.ParseOptions(spec)
+        except ValueError:
+            continue
+        raise CheckFailed("invalid simulator options '" + spec + "' accepted")
+    _expect([keyboard.GetName() for keyboard in msikbsim.CreateKeyboards(2, seed=1)] == ['sim0', 'sim1'], "simulated keyboard names")
+
+
+def _checkWriter():
+    import threading
+    from queue import Full
+    keyboard, = msikbsim.CreateKeyboards()
+    writer = msikbapi.KeyboardWriter(keyboard)
+    release = threading.Event()
+    try:
+        # The writer thread is held by the first action, the rest queue up
+        writer.Submit(lambda kb: release.wait(5), coalesce=False)
+        while writer.queue:
+            time.sleep(0.001)
+        first = writer.Submit(lambda kb: kb.SetNormalMode(*ZONE))
+        second = writer.Submit(lambda kb: kb.SetNormalMode(WHITE, WHITE, WHITE))
+        _expect(first.cancelled() and len(writer.queue) == 1 and writer.coalesced == 1, "superseded write not coalesced")
+        barriers = [writer.Submit(lambda kb: None, coalesce=False) for _ in range(writer.QUEUE_SIZE - 1)]
+        # Full behind a barrier: nothing can be superseded, so every write is
+        # refused without touching the queue or the target
+        target = writer.target
+        for coalesce in (True, False):
+            try:
+                writer.Submit(lambda kb: kb.SetOffMode(), coalesce)
+            except Full:
+                pass
+            else:
+                raise CheckFailed("write into a full queue accepted")
+            _expect(writer.target is target and len(writer.queue) == writer.QUEUE_SIZE and not second.cancelled(), "refused write changed the queue or the target")
+        release.set()
+        barriers[-1].result(5)
+        _expect(second.done() and not second.cancelled(), "queued write lost")
+        mode, zones, _ = keyboard.transport.controller.GetState()
+        _expect(mode == keyboard.KB_MODE_NORMAL[0] and zones == {1: WHITE, 2: WHITE, 3: WHITE}, "last write not shown")
+    finally:
+        release.set()
+        writer.Stop()
+
+
+class _PendingWriter:
+    # Writer whose actions never complete, the checks complete them instead
+    def Submit(self, action, coalesce=True):
+        return Future()
+
+
+def _checkReconnector():
+    daemon = _daemon()
+    failed = Future()
+    failed.set_exception(OSError("Simulated keyboard is unplugged"))
+    connected = Future()
+    connected.set_result(None)
+    calls = []
+    reconnector = daemon.KeyboardReconnector(_PendingWriter(), lambda: calls.append(True))
+    reconnector.Start()
+    try:
+        _expect(reconnector.isActive and reconnector.isAttempting and reconnector.attempts == 1, "Start didn't attempt to connect")
+        delays = []
+        for _ in range(12):
+            delays.append(reconnector.delay)
+            reconnector._onAttemptDone(failed)
+            _expect(reconnector.timerId is not None, "failed attempt didn't arm the retry timer")
+            # A failure while the timer is armed doesn't back off further
+            reconnector._onAttemptDone(failed)
+            # The timer fires
+            reconnector._cancelTimer()
+            reconnector._attempt()
+        expected = [min(reconnector.initialDelay * 2 ** attempt, reconnector.MAX_DELAY) for attempt in range(12)]
+        _expect(delays == expected, "retry delays " + str(delays))
+        _expect(reconnector.attempts == 13, str(reconnector.attempts) + " attempts made, expected 13")
+        reconnector._onAttemptDone(connected)
+        _expect(calls == [True] and not reconnector.isActive and reconnector.timerId is None and reconnector.monitor is None, "successful attempt didn't stop reconnecting")
+        reconnector.Start()
+        _expect(reconnector.delay == reconnector.initialDelay and reconnector.attempts == 1, "backoff not reset by Start")
+    finally:
+        reconnector.Stop()
+
+
+def _checkPowerEvents():
+    fixture = _ServiceFixture(SMALL_CONFIG_MODES, False)
+    service = fixture.service
+    controller = fixture.keyboards[0].transport.controller
+
+    def written():
+        # Waits for the writes submitted so far
+        for device in service.devices:
+            device.writer.Submit(lambda kb: None, coalesce=False).result(5)
+        return controller.GetStats()[0]
+    try:
+        service.signalDebounce = 10.0
+        service.SetModeImpl(1)
+        state = service.powerState
+        # A burst is applied once, when the debounce timer fires
+        for isLidClosed in (True, False, True):
+            service.LidActionHandler(isLidClosed)
+        _expect(service.powerTimerId is not None and service.powerState == state and service.powerEventsPending == 3, "lid events applied before the debounce time")
+        service._onPowerTimer()
+        _expect(service.powerState == service.POWER_OFF and service.powerEventsPending == 0, "lid close not applied")
+        reports = written()
+        _expect(controller.GetState()[0] == msikbapi.MSIKeyboard.KB_MODE_OFF[0], "backlight not turned off")
+        # A burst ending where it started doesn't touch the keyboard
+        service.LidActionHandler(False)
+        service.LidActionHandler(True)
+        service._onPowerTimer()
+        _expect(service.powerState == service.POWER_OFF and written() == reports, "open and close burst wrote to the keyboard")
+        # Suspend can't wait for the timer
+        service.LidActionHandler(False)
+        service.PrepareForSleepHandler(True)
+        _expect(service.powerState == service.POWER_SUSPENDED and service.powerTimerId is None and service.powerEventsPending == 0, "suspend not applied at once")
+    finally:
+        fixture.Close()
+
+
+def _checkSnapshot():
+    import pickle
+    from msikeyboard import msikbconfig
+    from msikeyboard import msikbmetrics
+    directory = tempfile.mkdtemp(prefix='msikbbench-')
+    try:
+        configFile = os.path.join(directory, 'config.yaml')
+        snapshot = msikbconfig.ConfigSnapshot(os.path.join(directory, 'config.cache'), ('code', 1))
+        data = b'default_index: 0\n'
+        with open(configFile, 'wb') as config_file:
+            config_file.write(data)
+        procFile = msikbmetrics.ProcFile('/proc/stat')
+        procFile.Open()
+        try:
+            _expect(snapshot.Store(msikbconfig.ConfigSnapshot.FileKey(os.stat(configFile), data), ('payload', procFile)), "snapshot not stored")
+        finally:
+            procFile.Close()
+        payload = snapshot.Load(configFile)
+        _expect(payload is not None and payload[0] == 'payload', "valid snapshot not loaded")
+        # Descriptors mean nothing in another process
+        _expect(payload[1].fd is None and len(payload[1].buffer) == msikbmetrics.ProcFile.BUFFER_SIZE, "descriptor pickled into the snapshot")
+        # Touched but unchanged, the content hash still matches
+        os.utime(configFile, ns=(0, 0))
+        _expect(snapshot.Load(configFile) is not None, "snapshot of a touched but unchanged file not loaded")
+        _expect(msikbconfig.ConfigSnapshot(snapshot.path, ('code', 2)).Load(configFile) is None, "snapshot of other code loaded")
+        with open(configFile, 'wb') as config_file:
+            config_file.write(b'default_index: 1\n')
+        _expect(snapshot.Load(configFile) is None, "snapshot of a changed file loaded")
+        with open(configFile, 'wb') as config_file:
+            config_file.write(data)
+        os.chmod(snapshot.path, 0o666)
+        _expect(snapshot.Load(configFile) is None, "world writable snapshot loaded")
+        os.chmod(snapshot.path, 0o600)
+        _expect(snapshot.Load(configFile) is not None, "snapshot not loaded again")
+        with open(snapshot.path, 'r+b') as snapshot_file:
+            snapshot_file.write(b'X')
+        _expect(snapshot.Load(configFile) is None, "snapshot with a bad header loaded")
+        with open(snapshot.path, 'wb') as snapshot_file:
+            snapshot_file.write(snapshot._header() + pickle.dumps(('code', 1))[:5])
+        _expect(snapshot.Load(configFile) is None, "truncated snapshot loaded")
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+# Correctness checks of what the benchmarks measure, also against simulated
+# keyboards. Each raises CheckFailed (or any other exception) on failure and
+# SkipBenchmark if it needs the daemon's imports.
+CHECKS = [
+    ('planner', _checkPlanner),
+    ('shadowCache', _checkShadowCache),
+    ('rules', _checkRules),
+    ('transition', _checkTransition),
+    ('socketProtocol', _checkSocketProtocol),
+    ('simulator', _checkSimulator),
+    ('writer', _checkWriter),
+    ('reconnector', _checkReconnector),
+    ('powerEvents', _checkPowerEvents),
+    ('snapshot', _checkSnapshot),
+]
+
+
+def RunChecks(pattern=None, out=sys.stdout):
+    # Returns the names of the failed checks
+    failures = []
+    for name, check in CHECKS:
+        if pattern is not None and not re.search(pattern, name):
+            continue
+        try:
+            check()
+        except SkipBenchmark as e:
+            print("%-34s skipped: %s" % (name, e), file=out)
+            continue
+        except Exception as e:
+            failures.append(name)
+            print("%-34s FAILED: %s" % (name, e if isinstance(e, CheckFailed) else repr(e)), file=out)
+            continue
+        print("%-34s ok" % name, file=out)
+    return failures
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmarks of the msikeyboard library and daemon")
+    parser.add_argument('--filter', help="only run benchmarks whose name matches this regular expression")
+    parser.add_argument('--min-time', type=float, default=1.0, help="seconds spent timing each benchmark")
+    parser.add_argument('--rounds', type=int, default=5, help="timing rounds per benchmark, the median is reported")
+    commands = parser.add_subparsers(dest='command', required=True)
+    run_parser = commands.add_parser('run', help="run the benchmarks")
+    run_parser.add_argument('--output', help="write the results to this file, e.g. to record a baseline")
+    compare_parser = commands.add_parser('compare', help="compare with a baseline, exit status 1 on regressions")
+    compare_parser.add_argument('baseline', nargs='?', default=REFERENCE_BASELINE, help="baseline results file, the reference machine's results (data/bench-baseline.json) if not given")
+    compare_parser.add_argument('results', nargs='?', help="results file to compare, the benchmarks are run if not given")
+    compare_parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD, help="relative slowdown or allocation growth that counts as a regression")
+    commands.add_parser('check', help="run the correctness checks instead, exit status 1 on failures")
+    args = parser.parse_args()
+    if args.rounds < 2:
+        parser.error("at least 2 rounds are required")
+    # Keep the daemon's messages out of the tables
+    msikblog.log.SetLevel(msikblog.ERROR, msikblog.ERROR)
+
+    if args.command == 'check':
+        failures = RunChecks(args.filter)
+        if failures:
+            print(str(len(failures)) + " check(s) failed")
+            sys.exit(1)
+        return
+
+    if args.command == 'run':
+        results = RunBenchmarks(args.filter, args.min_time, args.rounds)
+        if args.output is not None:
+            SaveResults(args.output, results)
+        return
+
+    try:
+        baseline = LoadResults(args.baseline)
+        current = LoadResults(args.results) if args.results is not None else None
+    except (OSError, ValueError) as e:
+        print("Can't load benchmark results: " + str(e), file=sys.stderr)
+        sys.exit(2)
+    if current is None:
+        current = {'environment': _environment(), 'results': RunBenchmarks(args.filter, args.min_time, args.rounds)}
+        print()
+    # Reports and allocations per operation don't depend on the machine, the
+    # speed does: it isn't compared with the reference machine's results
+    compare_speed = args.baseline != REFERENCE_BASELINE
+    if baseline['environment'] != current['environment']:
+        compare_speed = False
+        print("Warning: baseline was recorded with " + str(baseline['environment']) + ", comparing with " + str(current['environment']), file=sys.stderr)
+    base_results = baseline['results']
+    if args.filter is not None:
+        base_results = {name: result for name, result in base_results.items() if re.search(args.filter, name)}
+    regressions = CompareResults(base_results, current['results'], args.threshold, compare_speed=compare_speed)
+    if regressions:
+        print(str(len(regressions)) + " regression(s)")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
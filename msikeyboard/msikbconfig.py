@@ -0,0 +1,104 @@
+import os
+import pickle
+from msikeyboard import msikblog
+
+
+class ConfigFormatError(Exception):
+    pass
+
+
+def _yaml():
+    # yaml is only imported when the snapshot can't be used
+    import yaml
+    return yaml
+
+
+def ReadConfigFile(path):
+    # Returns (config dict, snapshot key) of a YAML config file
+    yaml = _yaml()
+    with open(path, 'rb') as config_file:
+        data = config_file.read()
+        key = ConfigSnapshot.FileKey(os.fstat(config_file.fileno()), data)
+    # libyaml bindings are an order of magnitude faster, if available
+    try:
+        return yaml.load(data, Loader=getattr(yaml, 'CSafeLoader', yaml.SafeLoader)), key
+    except yaml.YAMLError as e:
+        raise ConfigFormatError(str(e))
+
+
+def WriteConfigFile(path, config_dict):
+    # Returns snapshot key of the written file
+    yaml = _yaml()
+    data = yaml.dump(config_dict, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper)).encode()
+    with open(path, 'wb') as config_file:
+        config_file.write(data)
+        config_file.flush()
+        return ConfigSnapshot.FileKey(os.fstat(config_file.fileno()), data)
+
+
+class ConfigSnapshot:
+    # Binary snapshot of a parsed and compiled config file, valid as long as
+    # the file has the same mtime and size or, failing that, the same
+    # content hash. code_key invalidates snapshots made by other versions of
+    # the mode classes.
+    MAGIC = b'MSIKBCFG'
+    VERSION = 1
+
+    def __init__(self, path, code_key=()):
+        self.path = path
+        self.codeKey = code_key
+
+    @staticmethod
+    def FileKey(stat_result, data):
+        import hashlib
+        return (stat_result.st_mtime_ns, stat_result.st_size, hashlib.sha256(data).digest())
+
+    def _header(self):
+        return self.MAGIC + self.VERSION.to_bytes(2, 'little')
+
+    def Load(self, config_path):
+        # Returns the stored payload, or None if there is no valid snapshot
+        try:
+            with open(self.path, 'rb') as snapshot_file:
+                stat_result = os.fstat(snapshot_file.fileno())
+                # Only trust snapshots nobody else could have written
+                if stat_result.st_uid != os.getuid() or stat_result.st_mode & 0o022:
+                    msikblog.Warn("Ignoring config snapshot '%s' with unsafe owner or permissions", self.path)
+                    return None
+                if snapshot_file.read(len(self._header())) != self._header():
+                    return None
+                code_key, file_key, payload = pickle.load(snapshot_file)
+            if code_key != self.codeKey:
+                return None
+            config_stat = os.stat(config_path)
+            if file_key[:2] != (config_stat.st_mtime_ns, config_stat.st_size):
+                import hashlib
+                with open(config_path, 'rb') as config_file:
+                    if hashlib.sha256(config_file.read()).digest() != file_key[2]:
+                        return None
+            return payload
+        except FileNotFoundError:
+            return None
+        except (OSError, EOFError, ValueError, TypeError, AttributeError, ImportError, pickle.UnpicklingError) as e:
+            msikblog.Warn("Ignoring unreadable config snapshot '%s': %s", self.path, e)
+            return None
+
+    def Store(self, file_key, payload):
+        temp_path = self.path + '.tmp'
+        try:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(fd, 'wb') as snapshot_file:
+                snapshot_file.write(self._header())
+                pickle.dump((self.codeKey, file_key, payload), snapshot_file, pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, self.path)
+            return True
+        except (OSError, TypeError, pickle.PicklingError) as e:
+            msikblog.Warn("Can't write config snapshot '%s': %s", self.path, e)
+            try:
+                os.unlink(temp_path)
+            except OSError:
+                pass
+            return False
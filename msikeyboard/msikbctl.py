@@ -0,0 +1,184 @@
+#!/usr/bin/python3
+
+# Control client for msikeyboardd. One-shot commands only import dbus and
+# call methods directly (no proxy objects, no introspection); batch mode
+# runs many commands over one connection.
+
+import sys
+import dbus
+
+SERVICE_NAME = 'org.morozzz.MSIKeyboardService'
+SERVICE_PATH = '/org/morozzz/MSIKeyboardService'
+SERVICE_INTERFACE = 'org.morozzz.MSIKeyboardService'
+DEVICE_PATH = SERVICE_PATH + '/Device'
+
+USAGE = """Usage: msikeyboard [--device N] COMMAND [ARGS]
+       msikeyboard [--device N] --batch    (commands from stdin, one per line)
+       msikeyboard [--device N] --watch    (print state changes)
+
+Without --device, commands apply to all keyboards. --device N selects the
+keyboard with index N (see 'devices').
+
+Commands:
+  N, set N           select mode with index N
+  name NAME          select mode by its 'name' key
+  off                turn backlight off
+  default            select default (bright white) mode
+  restore            restore last mode set by index
+  zones Z:R,G,B ...  set Normal mode colors of zones 1-3
+  wait               wait until requested changes reach the keyboard
+  last               print index of last mode set
+  count              print number of configured modes
+  modes              print index, name and type of configured modes
+  devices            print object paths of the keyboards"""
+
+
+class UsageError(Exception):
+    pass
+
+
+class KeyboardClient:
+    def __init__(self, bus=None, path=SERVICE_PATH):
+        self.bus = bus if bus is not None else dbus.SystemBus()
+        self.path = path
+
+    def _call(self, method, signature='', *args, path=None):
+        return self.bus.call_blocking(SERVICE_NAME, path or self.path, SERVICE_INTERFACE, method, signature, args)
+
+    def Run(self, words):
+        # Returns (success, output or None)
+        command = words[0]
+        args = words[1:]
+        if command.isdigit():
+            command, args = 'set', words
+        if command == 'set':
+            if len(args) != 1 or not args[0].isdigit():
+                raise UsageError("set needs a mode index")
+            return bool(self._call('SetMode', 't', int(args[0]))), None
+        if command == 'name':
+            if len(args) != 1:
+                raise UsageError("name needs a mode name")
+            return bool(self._call('SetModeByName', 's', args[0])), None
+        if args and command not in ('zones',):
+            raise UsageError(command + " takes no arguments")
+        if command == 'off':
+            self._call('SetOffMode')
+            return True, None
+        if command == 'default':
+            self._call('SetDefaultMode')
+            return True, None
+        if command == 'restore':
+            return bool(self._call('RestoreLastMode')), None
+        if command == 'wait':
+            return bool(self._call('Flush')), None
+        if command == 'last':
+            isSet, index = self._call('GetLastModeIndex')
+            return bool(isSet), str(int(index)) if isSet else 'none'
+        if command == 'count':
+            return True, str(int(self._call('GetModesNumber', path=SERVICE_PATH)))
+        if command == 'modes':
+            return True, '\n'.join(str(int(index)) + ' ' + (str(name) or '-') + ' ' + str(type_name) for index, name, type_name in self._call('ListModes', path=SERVICE_PATH))
+        if command == 'devices':
+            return True, '\n'.join(str(path) for path in self._call('GetDevices', path=SERVICE_PATH))
+        if command == 'zones':
+            return bool(self._call('SetZoneColors', 'a(yyyy)', [self._parseZone(arg) for arg in args])), None
+        raise UsageError("unknown command '" + command + "'")
+
+    @staticmethod
+    def _parseZone(arg):
+        try:
+            zone, color = arg.split(':')
+            r, g, b = color.split(',')
+            zone_color = (int(zone), int(r), int(g), int(b))
+        except ValueError:
+            raise UsageError("invalid zone color '" + arg + "', expected Z:R,G,B")
+        if not 1 <= zone_color[0] <= 3 or not all(0 <= c <= 255 for c in zone_color[1:]):
+            raise UsageError("invalid zone color '" + arg + "', zones are 1-3 and colors 0-255")
+        return zone_color
+
+
+def _runBatch(client):
+    isInteractive = sys.stdin.isatty()
+    failed = 0
+    while True:
+        if isInteractive:
+            sys.stdout.write('> ')
+            sys.stdout.flush()
+        line = sys.stdin.readline()
+        if not line:
+            break
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if words[0] in ('quit', 'exit'):
+            break
+        try:
+            success, output = client.Run(words)
+        except UsageError as e:
+            print("Error: " + str(e), file=sys.stderr)
+            failed += 1
+            continue
+        except dbus.DBusException as e:
+            print("Error: " + e.get_dbus_message(), file=sys.stderr)
+            failed += 1
+            continue
+        if output is not None:
+            print(output)
+            sys.stdout.flush()
+        if not success:
+            print("Failed: " + line.strip(), file=sys.stderr)
+            failed += 1
+    return 1 if failed else 0
+
+
+def _watch(path):
+    # The main loop is only needed here
+    from dbus.mainloop.glib import DBusGMainLoop
+    from gi.repository import GLib
+    DBusGMainLoop(set_as_default=True)
+    bus = dbus.SystemBus()
+
+    def onStateChanged(kind, index):
+        print(kind if index < 0 else kind + " " + str(int(index)))
+        sys.stdout.flush()
+
+    bus.add_signal_receiver(onStateChanged, 'StateChanged', SERVICE_INTERFACE, SERVICE_NAME, path)
+    try:
+        GLib.MainLoop().run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def main():
+    args = sys.argv[1:]
+    path = SERVICE_PATH
+    if args[:1] == ['--device']:
+        if len(args) < 2 or not args[1].isdigit():
+            print("Error: --device needs a keyboard index", file=sys.stderr)
+            return 2
+        path = DEVICE_PATH + args[1]
+        args = args[2:]
+    if not args or args[0] in ('-h', '--help'):
+        print(USAGE)
+        return 0 if args else 2
+    try:
+        if args == ['--watch']:
+            return _watch(path)
+        client = KeyboardClient(path=path)
+        if args == ['--batch']:
+            return _runBatch(client)
+        success, output = client.Run(args)
+    except UsageError as e:
+        print("Error: " + str(e), file=sys.stderr)
+        return 2
+    except dbus.DBusException as e:
+        print("Error: " + e.get_dbus_message(), file=sys.stderr)
+        return 1
+    if output is not None:
+        print(output)
+    return 0 if success else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import colorsys
+import time
+from array import array
+from queue import Full
+from msikeyboard import msikblog
+
+
+def clampColor(color):
+    return tuple(min(255, max(0, int(round(c)))) for c in color)
+
+
+def lerpColor(color_a, color_b, fraction):
+    return tuple(a + (b - a) * fraction for a, b in zip(color_a, color_b))
+
+
+def hueColor(hue, saturation=1.0, brightness=255):
+    r, g, b = colorsys.hsv_to_rgb(hue % 1.0, saturation, 1.0)
+    return (r * brightness, g * brightness, b * brightness)
+
+
+# Crossfade tables. Colors are blended in linear light, as LINEAR_BITS bit
+# integers, with the progress eased through a table of EASE_STEPS + 1
+# weights in 1 / EASE_ONE units, so a transition frame is a few integer
+# operations and table lookups per channel.
+LINEAR_BITS = 12
+LINEAR_MAX = (1 << LINEAR_BITS) - 1
+EASE_STEPS = 1024
+EASE_SHIFT = 12
+EASE_ONE = 1 << EASE_SHIFT
+
+
+def _srgbToLinear(value):
+    value /= 255
+    return value / 12.92 if value <= 0.04045 else ((value + 0.055) / 1.055) ** 2.4
+
+
+def _linearToSrgb(value):
+    return value * 12.92 if value <= 0.0031308 else 1.055 * value ** (1 / 2.4) - 0.055
+
+
+EASINGS = {
+    'linear': lambda x: x,
+    'ease-in': lambda x: x * x * x,
+    'ease-out': lambda x: 1 - (1 - x) ** 3,
+    'ease-in-out': lambda x: x * x * (3 - 2 * x),
+}
+
+# sRGB byte -> linear light, linear light -> sRGB byte, easing name -> table.
+# Built by _buildTables when the first transition is made, they take longer
+# than the rest of the daemon's imports.
+TO_LINEAR = None
+FROM_LINEAR = None
+EASE_TABLES = None
+
+
+def _buildTables():
+    global TO_LINEAR, FROM_LINEAR, EASE_TABLES
+    if TO_LINEAR is None:
+        FROM_LINEAR = bytes(int(round(_linearToSrgb(value / LINEAR_MAX) * 255)) for value in range(LINEAR_MAX + 1))
+        EASE_TABLES = {name: array('H', (int(round(easing(step / EASE_STEPS) * EASE_ONE)) for step in range(EASE_STEPS + 1))) for name, easing in EASINGS.items()}
+        TO_LINEAR = array('H', (int(round(_srgbToLinear(value) * LINEAR_MAX)) for value in range(256)))
+
+
+def toLinear(frame):
+    # (zone1, zone2, zone3) colors -> 9 linear light channels
+    _buildTables()
+    return [TO_LINEAR[c] for color in frame for c in color]
+
+
+class Transition:
+    # Effect that crossfades the zone colors from start (linear light
+    # channels, see toLinear) to target (three colors) over duration
+    # seconds. current holds the channels of the last frame, so a transition
+    # interrupted by a new one can start from exactly where it stopped.
+    # on_done(transition) is called from onStop if the last frame was sent,
+    # unless the transition was superseded: stopped by EffectEngine.Stop,
+    # which may happen after the last frame was computed but before the
+    # engine finished it.
+    def __init__(self, start, target, duration, easing='ease-in-out', on_done=None):
+        _buildTables()
+        self.start = start
+        self.target = tuple(tuple(color) for color in target)
+        self.delta = [end - begin for begin, end in zip(start, toLinear(self.target))]
+        self.duration = duration
+        self.stepScale = EASE_STEPS / duration
+        self.ease = EASE_TABLES[easing]
+        self.onDone = on_done
+        self.current = list(start)
+        self.isDone = False
+        self.isSuperseded = False
+        
+    def getFrame(self, t):
+        step = int(t * self.stepScale)
+        if step >= EASE_STEPS:
+            self.current = toLinear(self.target)
+            self.isDone = True
+            return self.target
+        weight = self.ease[step]
+        self.current = current = [begin + ((delta * weight) >> EASE_SHIFT) for begin, delta in zip(self.start, self.delta)]
+        return ((FROM_LINEAR[current[0]], FROM_LINEAR[current[1]], FROM_LINEAR[current[2]]),
+                (FROM_LINEAR[current[3]], FROM_LINEAR[current[4]], FROM_LINEAR[current[5]]),
+                (FROM_LINEAR[current[6]], FROM_LINEAR[current[7]], FROM_LINEAR[current[8]]))
+        
+    def getDuration(self):
+        return self.duration
+        
+    def getFrameRate(self):
+        return None
+        
+    def onStart(self):
+        pass
+        
+    def onStop(self):
+        if self.isDone and not self.isSuperseded and self.onDone is not None:
+            self.onDone(self)
+
+
+class Animation:
+    # One running effect and the keyboard writers showing it
+    def __init__(self, effect):
+        self.effect = effect
+        self.timerId = None
+        self.interval = 0
+        self.startTime = 0.0
+        # Writer -> [pending write future, last frame submitted]
+        self.writers = {}
+
+
+class EffectEngine:
+    # Drives animated modes (see AnimatedKeyboardMode in msikblightd) on main
+    # loop timers. Frames are computed from the elapsed time, so a frame
+    # dropped because a keyboard is still busy with the previous one
+    # doesn't slow the animation down. An effect shown on several keyboards
+    # runs once, on one timer, and each frame goes to every writer that is
+    # ready for it.
+    DEFAULT_FRAME_RATE = 25
+
+    def __init__(self):
+        self.frameRate = self.DEFAULT_FRAME_RATE
+        # Limits of the power policy: highest frame rate of any animation and
+        # timer wakeups per second shared by all of them, None - no limit
+        self.maxFrameRate = None
+        self.maxWakeups = None
+        # Writer -> Animation
+        self.animations = {}
+        # Writer -> [frames sent, skipped, dropped]
+        self.stats = {}
+
+    def Start(self, writer, effect, first_frame=None):
+        # first_frame is the frame the caller has already written. A writer
+        # joins the effect if it is already running for other writers.
+        self.Stop(writer)
+        for animation in self.animations.values():
+            if animation.effect is effect:
+                self._attach(animation, writer, first_frame)
+                return
+        duration = effect.getDuration()
+        if duration is not None and duration <= 0:
+            return
+        try:
+            effect.onStart()
+        except OSError as e:
+            msikblog.Warn("Can't start animation: %s", e)
+            return
+        animation = Animation(effect)
+        animation.startTime = time.monotonic()
+        self._attach(animation, writer, first_frame)
+        self._rearm()
+
+    def _attach(self, animation, writer, first_frame):
+        animation.writers[writer] = [None, first_frame]
+        self.animations[writer] = animation
+
+    def Stop(self, writer):
+        animation = self.animations.pop(writer, None)
+        if animation is None:
+            return
+        del animation.writers[writer]
+        if not animation.writers:
+            if isinstance(animation.effect, Transition):
+                # Replaced, so its target must not be applied any more
+                animation.effect.isSuperseded = True
+            self._finish(animation)
+
+    def StopAll(self):
+        for writer in list(self.animations):
+            self.Stop(writer)
+
+    def _finish(self, animation):
+        if animation.timerId is not None:
+            from gi.repository import GLib
+            GLib.source_remove(animation.timerId)
+            animation.timerId = None
+        for writer in animation.writers:
+            del self.animations[writer]
+        animation.writers.clear()
+        animation.effect.onStop()
+        # The others may take over the wakeups this one had
+        self._rearm()
+
+    def SetLimits(self, max_frame_rate, max_wakeups):
+        self.maxFrameRate = max_frame_rate
+        self.maxWakeups = max_wakeups
+        self._rearm()
+
+    def _rearm(self):
+        # (Re)start the timers whose interval is no longer right, e.g. after
+        # the limits changed or an animation started or stopped
+        running = []
+        for animation in self.animations.values():
+            if all(other is not animation for other in running):
+                running.append(animation)
+        if not running:
+            return
+        from gi.repository import GLib
+        for animation in running:
+            frameRate = animation.effect.getFrameRate() or self.frameRate
+            if self.maxFrameRate is not None:
+                frameRate = min(frameRate, self.maxFrameRate)
+            if self.maxWakeups is not None:
+                frameRate = min(frameRate, self.maxWakeups / len(running))
+            interval = max(1, int(1000 / frameRate))
+            if animation.timerId is not None and interval == animation.interval:
+                continue
+            if animation.timerId is not None:
+                GLib.source_remove(animation.timerId)
+            animation.interval = interval
+            animation.timerId = GLib.timeout_add(interval, self._onFrame, animation)
+
+    def isRunning(self, writer=None):
+        if writer is None:
+            return bool(self.animations)
+        return writer in self.animations
+
+    def GetEffect(self, writer):
+        animation = self.animations.get(writer)
+        return animation.effect if animation is not None else None
+
+    def GetFrame(self, writer):
+        # Last frame submitted to writer, None if none or not animated
+        animation = self.animations.get(writer)
+        return animation.writers[writer][1] if animation is not None else None
+
+    def GetEffects(self):
+        # Every running effect once
+        effects = []
+        for animation in self.animations.values():
+            if all(effect is not animation.effect for effect in effects):
+                effects.append(animation.effect)
+        return effects
+
+    def _onFrame(self, animation):
+        elapsed = time.monotonic() - animation.startTime
+        duration = animation.effect.getDuration()
+        isLast = duration is not None and elapsed >= duration
+        frame = None
+        isDropped = False
+        for writer, state in animation.writers.items():
+            stats = self.stats.setdefault(writer, [0, 0, 0])
+            if state[0] is not None and not state[0].done():
+                stats[2] += 1
+                isDropped = True
+                continue
+            if frame is None:
+                frame = animation.effect.getFrame(duration if isLast else elapsed)
+            if frame == state[1]:
+                stats[1] += 1
+                continue
+            try:
+                state[0] = writer.Submit(lambda kb, frame=frame: kb.SetNormalMode(*frame))
+            except Full:
+                # Queue full of barrier writes, tried again next frame
+                stats[2] += 1
+                isDropped = True
+                continue
+            state[1] = frame
+            stats[0] += 1
+        if isLast and not isDropped:
+            animation.timerId = None
+            self._finish(animation)
+            return False
+        return True
+
+    def GetStats(self, writer=None):
+        # (frames sent, skipped because nothing changed, dropped because the
+        # keyboard was busy) for writer, or summed over all writers
+        if writer is not None:
+            return tuple(self.stats.get(writer, (0, 0, 0)))
+        return tuple(sum(stats[i] for stats in self.stats.values()) for i in range(3))
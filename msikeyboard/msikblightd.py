@@ -1,19 +1,78 @@
-#!/usr/bin/python3 -u
+#!/usr/bin/python3
+
+import time
+IMPORT_START = time.monotonic()
 
 import dbus
 import dbus.service
-import yaml
+import os
+import sys
 import signal
-import time
+from concurrent.futures import Future
+from queue import Full
 from msikeyboard import msikbapi
+from msikeyboard import msikbeffects
+from msikeyboard import msikbaudio
+from msikeyboard import msikbmetrics
+from msikeyboard import msikbconfig
+from msikeyboard import msikbstats
+from msikeyboard import msikblog
+from msikeyboard import msikbsim
+from msikeyboard import msikbtrace
+from msikeyboard import msikbrules
+from msikeyboard import msikbpower
+
+IMPORT_TIME = time.monotonic() - IMPORT_START
+
+# Imported by _importMainLoop, only needed when the service actually runs
+GLib = None
+Gio = None
 
 CONFIG_PATH = '/etc/msikeyboard/'
 CONFIG_NAME = 'config.yaml'
+CACHE_PATH = '/var/cache/msikeyboard/'
+CACHE_NAME = 'config.cache'
+STATE_PATH = '/var/lib/msikeyboard/'
+STATE_NAME = 'state.json'
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+
+def _importMainLoop():
+    global GLib, Gio
+    if GLib is None:
+        from gi.repository import GLib, Gio
+
+
+def _processAge():
+    # Seconds since this process was started, interpreter startup included
+    with open('/proc/self/stat') as stat_file:
+        fields = stat_file.read().rsplit(')', 1)[1].split()
+    return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+
+
+def _bootId():
+    try:
+        with open(BOOT_ID_PATH) as boot_id_file:
+            return boot_id_file.read().strip()
+    except OSError:
+        return None
 
 class AbstractKeyboardMode:
     def setMode(self, keyboard_object):
         return NotImplemented
         
+    def __str__(self):
+        # Mode type name, looked up only when a log line is formatted
+        return MSIKeyboardService.kbmodes_rev.get(type(self), type(self).__name__)
+        
+    def compile(self, keyboard_object):
+        return keyboard_object.Compile(self.setMode)
+        
+    def getZoneColors(self):
+        # Colors of the three zones as Normal mode would show them, for
+        # crossfades; None if the mode can't be shown that way
+        return None
+        
     def to_dict(self):
         return NotImplemented
         
@@ -29,6 +88,9 @@ class OffKeyboardMode(AbstractKeyboardMode):
     def setMode(self, keyboard_object):
         keyboard_object.SetOffMode()
         
+    def getZoneColors(self):
+        return ((0, 0, 0),) * 3
+        
     def to_dict(self):
         return {}
         
@@ -61,6 +123,9 @@ class NormalKeyboardMode(AbstractKeyboardMode):
     def setMode(self, keyboard_object):
         keyboard_object.SetNormalMode(self.zone1, self.zone2, self.zone3)
         
+    def getZoneColors(self):
+        return (self.zone1, self.zone2, self.zone3)
+        
     def to_dict(self):
         return {'left': {'r': self.zone1[0], 'g': self.zone1[1], 'b': self.zone1[2]}, 
                 'middle': {'r': self.zone2[0], 'g': self.zone2[1], 'b': self.zone2[2]}, 
@@ -83,6 +148,10 @@ class GamingKeyboardMode(AbstractKeyboardMode):
     def setMode(self, keyboard_object):
         keyboard_object.SetGamingMode(*self.color)
         
+    def getZoneColors(self):
+        # Only the left zone is lit
+        return (self.color, (0, 0, 0), (0, 0, 0))
+        
     def to_dict(self):
         return {'r': self.color[0], 'g': self.color[1], 'b': self.color[2]}
                 
@@ -191,20 +260,917 @@ class AudioKeyboardMode(AbstractKeyboardMode):
     def from_dict(cls, dict):
         return cls()
 
-class MSIKeyboardService(dbus.service.Object):
+def _colorFromDict(dict):
+    return (dict['r'], dict['g'], dict['b'])
+
+
+def _colorToDict(color):
+    return {'r': color[0], 'g': color[1], 'b': color[2]}
+
+
+class AnimatedKeyboardMode(AbstractKeyboardMode):
+    # Normal mode with zone colors computed by the daemon frame by frame,
+    # see msikbeffects.EffectEngine. setMode (and so the compiled program)
+    # shows the first frame.
+    def setMode(self, keyboard_object):
+        keyboard_object.SetNormalMode(*self.getFrame(0.0))
+        
+    def getFrame(self, t):
+        return NotImplemented
+        
+    def getZoneColors(self):
+        # Crossfades lead into the first frame
+        return self.getFrame(0.0)
+        
+    def getDuration(self):
+        # None for endless animations
+        return None
+        
+    def getFrameRate(self):
+        # None for the service-wide effect_frame_rate
+        return None
+        
+    def getFirmwareMode(self):
+        # Firmware mode looking (about) the same, shown instead on battery
+        # if the power policy allows, None if there is none
+        return None
+        
+    def onStart(self):
+        pass
+        
+    def onStop(self):
+        pass
+
+
+def _fadeTime(seconds):
+    # Firmware fade times are about a second per step, 0 - fastest
+    fade_time = max(0, min(255, round(seconds)))
+    return (fade_time, fade_time, fade_time)
+
+
+class FadeKeyboardMode(AbstractKeyboardMode):
+    # Firmware Breathing mode fading every zone between two colors and back,
+    # the firmware equivalent of two-color animations. Not configurable,
+    # see AnimatedKeyboardMode.getFirmwareMode.
+    def __init__(self, zone1, zone2, zone3):
+        # zone: (color_a, color_b, fade_times)
+        self.zones = (zone1, zone2, zone3)
+        
+    def setMode(self, keyboard_object):
+        keyboard_object.SetBreathingModeAdvanced(*self.zones)
+        
+    def to_dict(self):
+        return {}
+
+
+class FirmwareWaveKeyboardMode(FadeKeyboardMode):
+    # Firmware Wave mode, the zones fade between two colors one after the
+    # other; the firmware equivalent of Rainbow
+    def setMode(self, keyboard_object):
+        keyboard_object.SetWaveModeAdvanced(*self.zones)
+
+
+class RainbowKeyboardMode(AnimatedKeyboardMode):
+    def __init__(self, period, spread, brightness):
+        if period <= 0:
+            raise ValueError("period must be positive")
+        self.period = period
+        self.spread = spread
+        self.brightness = brightness
+        
+    def getFrame(self, t):
+        hue = t / self.period
+        return tuple(msikbeffects.clampColor(msikbeffects.hueColor(hue + zone * self.spread, 1.0, self.brightness)) for zone in range(3))
+        
+    def getFirmwareMode(self):
+        # The firmware wave can't go round the hue circle: each zone goes
+        # from its starting hue to the opposite one and back once per
+        # period, and the firmware staggers the zones instead of the spread
+        fade_time = _fadeTime(self.period / 2)
+        return FirmwareWaveKeyboardMode(*((msikbeffects.clampColor(msikbeffects.hueColor(zone * self.spread, 1.0, self.brightness)), 
+                                           msikbeffects.clampColor(msikbeffects.hueColor(zone * self.spread + 0.5, 1.0, self.brightness)), fade_time) for zone in range(3)))
+        
+    def to_dict(self):
+        return {'period': self.period, 'spread': self.spread, 'brightness': self.brightness}
+        
+    @classmethod
+    def from_dict(cls, dict):
+        return cls(float(dict['period']), float(dict['spread']), int(dict['brightness']))
+
+
+class GradientKeyboardMode(AnimatedKeyboardMode):
+    def __init__(self, stops, period, spread):
+        if not stops:
+            raise ValueError("at least one gradient stop is required")
+        if period <= 0:
+            raise ValueError("period must be positive")
+        self.stops = stops
+        self.period = period
+        self.spread = spread
+        
+    def _colorAt(self, position):
+        position = (position % 1.0) * len(self.stops)
+        index = int(position)
+        color_a = self.stops[index % len(self.stops)]
+        color_b = self.stops[(index + 1) % len(self.stops)]
+        return msikbeffects.clampColor(msikbeffects.lerpColor(color_a, color_b, position - index))
+        
+    def getFrame(self, t):
+        position = t / self.period
+        return tuple(self._colorAt(position + zone * self.spread) for zone in range(3))
+        
+    def getFirmwareMode(self):
+        # Two stops go there and back once per period; the firmware can't
+        # offset the zones, so they fade in step whatever the spread
+        if len(self.stops) != 2:
+            return None
+        zone = (self.stops[0], self.stops[1], _fadeTime(self.period / 2))
+        return FadeKeyboardMode(zone, zone, zone)
+        
+    def to_dict(self):
+        return {'stops': [_colorToDict(stop) for stop in self.stops], 'period': self.period, 'spread': self.spread}
+        
+    @classmethod
+    def from_dict(cls, dict):
+        stops = [_colorFromDict(stop) for stop in dict['stops']]
+        return cls(stops, float(dict['period']), float(dict['spread']))
+
+
+class KeyframesKeyboardMode(AnimatedKeyboardMode):
+    def __init__(self, keyframes, loop):
+        # keyframes: list of (time, zone1_color, zone2_color, zone3_color)
+        if not keyframes:
+            raise ValueError("at least one keyframe is required")
+        self.keyframes = sorted(keyframes, key=lambda keyframe: keyframe[0])
+        self.loop = loop
+        
+    def getDuration(self):
+        if self.loop and len(self.keyframes) > 1:
+            return None
+        return self.keyframes[-1][0]
+        
+    def getFrame(self, t):
+        keyframes = self.keyframes
+        if self.loop and keyframes[-1][0] > 0:
+            t = t % keyframes[-1][0]
+        if t <= keyframes[0][0]:
+            return keyframes[0][1:]
+        for prev, next in zip(keyframes, keyframes[1:]):
+            if t < next[0]:
+                fraction = (t - prev[0]) / (next[0] - prev[0])
+                return tuple(msikbeffects.clampColor(msikbeffects.lerpColor(a, b, fraction)) for a, b in zip(prev[1:], next[1:]))
+        return keyframes[-1][1:]
+        
+    def getFirmwareMode(self):
+        # A loop from one state to another and back, e.g. a pulse
+        keyframes = self.keyframes
+        if not self.loop or len(keyframes) != 3 or keyframes[0][1:] != keyframes[2][1:]:
+            return None
+        fade_time = _fadeTime((keyframes[2][0] - keyframes[0][0]) / 2)
+        return FadeKeyboardMode(*((a, b, fade_time) for a, b in zip(keyframes[0][1:], keyframes[1][1:])))
+        
+    def to_dict(self):
+        return {'loop': self.loop, 
+                'keyframes': [{'time': t, 'left': _colorToDict(z1), 'middle': _colorToDict(z2), 'right': _colorToDict(z3)} for t, z1, z2, z3 in self.keyframes]}
+        
+    @classmethod
+    def from_dict(cls, dict):
+        keyframes = [(float(keyframe['time']), _colorFromDict(keyframe['left']), _colorFromDict(keyframe['middle']), _colorFromDict(keyframe['right'])) for keyframe in dict['keyframes']]
+        return cls(keyframes, bool(dict['loop']))
+
+
+class KeyboardReconnector:
+    # Brings the keyboard back after resume or a failed write without ever
+    # blocking the main loop: connect attempts run on the writer thread and
+    # are triggered by hidraw nodes appearing in /dev, with exponential
+    # backoff on a main loop timer as a fallback
+    DEVICE_DIR = '/dev'
+    DEVICE_PREFIX = 'hidraw'
+    MAX_DELAY = 30.0
+    
+    def __init__(self, writer, on_connected):
+        self.writer = writer
+        self.onConnected = on_connected
+        self.initialDelay = 0.1
+        self.delay = self.initialDelay
+        self.isActive = False
+        self.isAttempting = False
+        self.attempts = 0
+        self.timerId = None
+        self.monitor = None
+        
+    def Start(self):
+        if self.isActive:
+            return
+        msikblog.Info("Keyboard disconnected, waiting for it to come back")
+        msikbstats.stats.Count('reconnects')
+        self.isActive = True
+        self.delay = self.initialDelay
+        self.attempts = 0
+        self._watchDevices()
+        self._attempt()
+        
+    def Stop(self):
+        self.isActive = False
+        self._cancelTimer()
+        if self.monitor is not None:
+            self.monitor.cancel()
+            self.monitor = None
+            
+    def _watchDevices(self):
+        try:
+            self.monitor = Gio.File.new_for_path(self.DEVICE_DIR).monitor_directory(Gio.FileMonitorFlags.NONE, None)
+            self.monitor.connect('changed', self._onDeviceDirChanged)
+        except GLib.Error as e:
+            msikblog.Warn("Can't watch %s for hidraw devices, using timer only: %s", self.DEVICE_DIR, e)
+            self.monitor = None
+            
+    def _onDeviceDirChanged(self, monitor, file, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.CREATED and file.get_basename().startswith(self.DEVICE_PREFIX):
+            self._cancelTimer()
+            self._attempt()
+            
+    def _cancelTimer(self):
+        if self.timerId is not None:
+            GLib.source_remove(self.timerId)
+            self.timerId = None
+            
+    def _onTimer(self):
+        self.timerId = None
+        self._attempt()
+        return False
+            
+    def _attempt(self):
+        if not self.isActive or self.isAttempting:
+            return
+        self.isAttempting = True
+        self.attempts += 1
+        msikbstats.stats.Count('reconnect_attempts')
+        future = self.writer.Submit(lambda kb: kb.EnsureConnected(), coalesce=False)
+        future.add_done_callback(lambda f: GLib.idle_add(self._onAttemptDone, f))
+        
+    def _onAttemptDone(self, future):
+        self.isAttempting = False
+        if not self.isActive:
+            return False
+        if future.exception() is None:
+            msikblog.Info("Keyboard connected after %d attempt(s)", self.attempts)
+            self.Stop()
+            self.onConnected()
+        elif self.timerId is None:
+            msikblog.Info("Connect attempt #%d failed, retrying in %s seconds", self.attempts, self.delay)
+            self.timerId = GLib.timeout_add(int(self.delay * 1000), self._onTimer)
+            self.delay = min(self.delay * 2, self.MAX_DELAY)
+        return False
+
+
+class AudioReactiveKeyboardMode(AnimatedKeyboardMode):
+    def __init__(self, source, sample_rate, channels, zone1_color, zone2_color, zone3_color):
+        if not msikbaudio.IsAvailable():
+            raise ValueError("numpy is required for audio analysis")
+        if sample_rate <= 0 or channels <= 0:
+            raise ValueError("sample rate and channel count must be positive")
+        self.source = source
+        self.sampleRate = sample_rate
+        self.channels = channels
+        # Created when the mode is started, so numpy is only imported then
+        self.analyzer = None
+        self.zone1 = zone1_color
+        self.zone2 = zone2_color
+        self.zone3 = zone3_color
+        
+    def setMode(self, keyboard_object):
+        # Start dark, levels come from the stream once the effect runs
+        keyboard_object.SetNormalMode((0, 0, 0), (0, 0, 0), (0, 0, 0))
+        
+    def getFrame(self, t):
+        levels = self.analyzer.Update(t)
+        return tuple(msikbeffects.clampColor(c * level for c in color) for color, level in zip((self.zone1, self.zone2, self.zone3), levels))
+        
+    def onStart(self):
+        if self.analyzer is None:
+            self.analyzer = msikbaudio.AudioAnalyzer(self.source, self.sampleRate, self.channels)
+        self.analyzer.Open()
+        
+    def onStop(self):
+        self.analyzer.Close()
+        msikblog.Info("Audio analysis stopped, %d frames analyzed, %d samples skipped", self.analyzer.framesAnalyzed, self.analyzer.samplesSkipped)
+        
+    def __getstate__(self):
+        # The analyzer holds the stream's descriptor and numpy buffers, it is
+        # created again by onStart after the mode is loaded from a snapshot
+        state = self.__dict__.copy()
+        state['analyzer'] = None
+        return state
+        
+    def to_dict(self):
+        return {'source': self.source, 'sample_rate': self.sampleRate, 'channels': self.channels, 
+                'left': _colorToDict(self.zone1), 'middle': _colorToDict(self.zone2), 'right': _colorToDict(self.zone3)}
+        
+    @classmethod
+    def from_dict(cls, dict):
+        return cls(str(dict['source']), int(dict['sample_rate']), int(dict['channels']), 
+                   _colorFromDict(dict['left']), _colorFromDict(dict['middle']), _colorFromDict(dict['right']))
+
+
+class MetricsKeyboardMode(AnimatedKeyboardMode):
+    def __init__(self, zone1, zone2, zone3, interval):
+        # zoneN: (metric name, low color, high color, minimum, maximum), 
+        # minimum and maximum may be None for the metric's default range
+        if interval <= 0:
+            raise ValueError("interval must be positive")
+        self.zones = (zone1, zone2, zone3)
+        self.interval = interval
+        self.levels = [msikbmetrics.MetricLevel(msikbmetrics.CreateSampler(zone[0]), zone[3], zone[4]) for zone in self.zones]
+        
+    def setMode(self, keyboard_object):
+        keyboard_object.SetNormalMode(*(zone[1] for zone in self.zones))
+        
+    def getFrame(self, t):
+        return tuple(msikbeffects.clampColor(msikbeffects.lerpColor(zone[1], zone[2], level.Update())) for zone, level in zip(self.zones, self.levels))
+        
+    def getFrameRate(self):
+        return 1.0 / self.interval
+        
+    def onStart(self):
+        for level in self.levels:
+            level.sampler.Open()
+            
+    def onStop(self):
+        for level in self.levels:
+            level.sampler.Close()
+        
+    def _zoneToDict(self, zone):
+        zone_dict = {'metric': zone[0], 'low': _colorToDict(zone[1]), 'high': _colorToDict(zone[2])}
+        if zone[3] is not None:
+            zone_dict['min'] = zone[3]
+        if zone[4] is not None:
+            zone_dict['max'] = zone[4]
+        return zone_dict
+        
+    @staticmethod
+    def _zoneFromDict(dict):
+        minimum = float(dict['min']) if 'min' in dict else None
+        maximum = float(dict['max']) if 'max' in dict else None
+        return (str(dict['metric']), _colorFromDict(dict['low']), _colorFromDict(dict['high']), minimum, maximum)
+        
+    def to_dict(self):
+        return {'left': self._zoneToDict(self.zones[0]), 'middle': self._zoneToDict(self.zones[1]), 'right': self._zoneToDict(self.zones[2]), 
+                'interval': self.interval}
+        
+    @classmethod
+    def from_dict(cls, dict):
+        return cls(cls._zoneFromDict(dict['left']), cls._zoneFromDict(dict['middle']), cls._zoneFromDict(dict['right']), float(dict['interval']))
+
+
+class ModeLibrary:
+    # The configured modes, by index and by their optional 'name'. A mode is
+    # built from its description and compiled the first time it is used and
+    # then kept, so loading a library of thousands of modes costs little
+    # more than reading it, and invalid modes are only reported when they
+    # are selected (or by --precompile, which builds all of them).
+    def __init__(self, descriptions):
+        # Raises TypeError if descriptions isn't a list, RuntimeError for
+        # invalid or duplicate names
+        if not isinstance(descriptions, list):
+            raise TypeError("modes must be a list")
+        self.descriptions = descriptions
+        # (mode, program) of every mode built so far, None for the others
+        self.entries = [None] * len(descriptions)
+        self.names = {}
+        for index, description in enumerate(descriptions):
+            name = description.get('name') if isinstance(description, dict) else None
+            if name is None:
+                continue
+            if not isinstance(name, str):
+                raise RuntimeError("Invalid name of mode " + str(index))
+            if name in self.names:
+                raise RuntimeError("Duplicate mode name '" + name + "'")
+            self.names[name] = index
+            
+    @classmethod
+    def FromModes(cls, modes, keyboard_object):
+        library = cls([{'type': MSIKeyboardService.kbmodes_rev[type(mode)], 'config': mode.to_dict()} for mode in modes])
+        library.entries = [(mode, mode.compile(keyboard_object)) for mode in modes]
+        return library
+        
+    def __len__(self):
+        return len(self.descriptions)
+        
+    def Get(self, index):
+        # Returns (mode, program), raises IndexError or RuntimeError if the
+        # mode's description is invalid
+        if index < 0:
+            raise IndexError("mode index out of range")
+        entry = self.entries[index]
+        if entry is None:
+            entry = self.entries[index] = MSIKeyboardService._parseModeDescription(self.descriptions[index], msikbapi.ReportCompiler())
+        return entry
+        
+    def BuildAll(self):
+        # Raises RuntimeError for the first invalid mode
+        for index in range(len(self.descriptions)):
+            self.Get(index)
+            
+    def IndexOf(self, name):
+        # None if there is no mode with this name
+        return self.names.get(name)
+        
+    def GetName(self, index):
+        description = self.descriptions[index]
+        name = description.get('name') if isinstance(description, dict) else None
+        return name if name is not None else ''
+        
+    def GetTypeName(self, index):
+        description = self.descriptions[index]
+        type_name = description.get('type') if isinstance(description, dict) else None
+        return type_name if isinstance(type_name, str) else ''
+        
+    def GetDescription(self, index):
+        return self.descriptions[index]
+
+
+class BusyError(dbus.DBusException):
+    # Reply to a request that found the keyboard's write queue full of
+    # writes that can't be superseded (flushes, reconnects), see
+    # msikbapi.KeyboardWriter.Submit
+    _dbus_error_name = 'org.morozzz.MSIKeyboardService.Error.Busy'
+
+
+class KeyboardTarget(dbus.service.Object):
+    # Backlight control methods shared by a single keyboard (KeyboardDevice)
+    # and the group of all keyboards (MSIKeyboardService), subclasses
+    # implement the *Impl methods
+    SERVICE_NATIVE_INTERFACE = 'org.morozzz.MSIKeyboardService'
+    
+    def SetModeImpl(self, mode_index):
+        return NotImplemented
+        
+    def SetDefaultModeImpl(self):
+        return NotImplemented
+        
+    def SetOffModeImpl(self):
+        return NotImplemented
+        
+    def ApplySceneImpl(self, mode, program):
+        return NotImplemented
+        
+    def SetZoneColorsImpl(self, zone_colors):
+        return NotImplemented
+        
+    def RestoreModeImpl(self):
+        return NotImplemented
+        
+    def FlushImpl(self):
+        return NotImplemented
+        
+    def GetLastModeIndexImpl(self):
+        return NotImplemented
+        
+    def GetModesImpl(self):
+        # Returns the service's ModeLibrary
+        return NotImplemented
+        
+    def GetStatsImpl(self):
+        # Returns (report stats, effect stats, audio stats)
+        return NotImplemented
+        
+    def _noteActivity(self):
+        pass
+        
+    def _replyWhenWritten(self, future, reply, error):
+        # Deliver the outcome of a queued write to an asynchronous D-Bus
+        # caller from the main loop
+        def deliver():
+            if future.cancelled():
+                reply(False)
+            elif future.exception() is not None:
+                error(future.exception())
+            else:
+                reply(True)
+            return False
+        future.add_done_callback(lambda f: GLib.idle_add(deliver))
+        
+    @dbus.service.signal(dbus_interface=SERVICE_NATIVE_INTERFACE, signature="sx")
+    def StateChanged(self, kind, index):
+        # kind: 'mode' (index is the mode index), 'scene', 'off' or 'default'
+        # (index is -1)
+        pass
+        
+    @staticmethod
+    def _submitted(submit, *args):
+        # Run an *Impl method for a D-Bus caller, Full is returned as BusyError
+        try:
+            return submit(*args)
+        except Full:
+            raise BusyError("Keyboard is busy, try again later")
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="t", out_signature="b")
+    def SetMode(self, index):
+        return self._submitted(self.SetModeImpl, index) is not None
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="s", out_signature="b")
+    def SetModeByName(self, name):
+        index = self.GetModesImpl().IndexOf(name)
+        if index is None:
+            msikblog.Warn("No mode named '%s', not setting mode", name)
+            return False
+        return self._submitted(self.SetModeImpl, index) is not None
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="t", out_signature="b", async_callbacks=('reply', 'error'))
+    def SetModeAndWait(self, index, reply, error):
+        try:
+            future = self._submitted(self.SetModeImpl, index)
+        except BusyError as e:
+            error(e)
+            return
+        if future is None:
+            reply(False)
+        else:
+            self._replyWhenWritten(future, reply, error)
+            
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="a{sv}", out_signature="b")
+    def ApplyScene(self, scene):
+        # scene has the same layout as an entry of the 'modes' config list
+        try:
+            mode, program = MSIKeyboardService._parseModeDescription(scene, msikbapi.ReportCompiler())
+        except RuntimeError as e:
+            msikblog.Warn("Invalid scene: %s", e)
+            return False
+        return self._submitted(self.ApplySceneImpl, mode, program) is not None
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="a(yyyy)", out_signature="b")
+    def SetZoneColors(self, zone_colors):
+        # (zone, r, g, b) with zones 1-3 (left, middle, right), zones not
+        # listed keep their color if Normal mode is active, white otherwise
+        zone_colors = [(int(zone), (int(r), int(g), int(b))) for zone, r, g, b in zone_colors]
+        for zone, color in zone_colors:
+            if not 1 <= zone <= 3:
+                msikblog.Warn("Invalid zone %d, not setting zone colors", zone)
+                return False
+        return self._submitted(self.SetZoneColorsImpl, zone_colors) is not None
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="")
+    def SetDefaultMode(self):
+        self._submitted(self.SetDefaultModeImpl)
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="")
+    def SetOffMode(self):
+        self._submitted(self.SetOffModeImpl)
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="bt")
+    def GetLastModeIndex(self):
+        index = self.GetLastModeIndexImpl()
+        return (True, index) if index is not None else (False, 0)
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="b")
+    def RestoreLastMode(self):
+        return self._submitted(self.RestoreModeImpl) is not None
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="b", async_callbacks=('reply', 'error'))
+    def Flush(self, reply, error):
+        try:
+            self._replyWhenWritten(self._submitted(self.FlushImpl), reply, error)
+        except BusyError as e:
+            error(e)
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="(tt)")
+    def GetAudioStats(self):
+        return self.GetStatsImpl()[2]
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="a{s(ttt)}")
+    def GetReportStats(self):
+        return self.GetStatsImpl()[0]
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="(ttt)")
+    def GetEffectStats(self):
+        return self.GetStatsImpl()[1]
+        
+    def _message_cb(self, connection, message):
+        self._noteActivity()
+        with msikbstats.stats.Timed('dbus_call', 'method="' + str(message.get_member()) + '"'):
+            return dbus.service.Object._message_cb(self, connection, message)
+
+
+class KeyboardDevice(KeyboardTarget):
+    # One keyboard with its own writer thread, reconnector, animation and
+    # backlight state. Methods called on its object path affect only this
+    # keyboard, MSIKeyboardService applies group requests to every device.
+    def __init__(self, service, keyboard_object, bus_name, object_path):
+        self.service = service
+        self.kb = keyboard_object
+        self.name = keyboard_object.GetName()
+        self.objectPath = object_path
+        self.writer = msikbapi.KeyboardWriter(keyboard_object, self._onWriteError)
+        self.reconnector = KeyboardReconnector(self.writer, self._onReconnected)
+        # Animations run on the service's engine, shared with other devices
+        # showing the same effect
+        self.effects = service.effects
+        self.curModeIndex = None
+        # Mode applied by ApplyScene/SetZoneColors, restored instead of the
+        # mode at curModeIndex until another mode is selected
+        self.sceneMode = None
+        self.sceneProgram = None
+        # Zone colors the keyboard shows while no effect runs, None if
+        # unknown or not zone colors. Crossfades start from these.
+        self.shownColors = None
+        # Future of the crossfade in progress, see _startTransition
+        self.transitionFuture = None
+        # Animation shown as its firmware equivalent for the power policy
+        self.firmwareOf = None
+        # Not exported without a bus name, see MSIKeyboardService
+        dbus.service.Object.__init__(self, bus_name, object_path if bus_name is not None else None)
+        
+    def _noteActivity(self):
+        self.service._noteActivity()
+        
+    def _onWriteError(self, error):
+        # Called on the writer thread
+        if isinstance(error, OSError):
+            GLib.idle_add(self._startReconnect)
+            
+    def _startReconnect(self):
+        self.reconnector.initialDelay = self.service.resumeConnectDelay
+        self.reconnector.Start()
+        return False
+        
+    def _onReconnected(self):
+        self.writer.Reapply()
+        
+    def Suspend(self):
+        self.writer.Submit(lambda kb: kb.Disconnect(), coalesce=False)
+        
+    def Resume(self):
+        self._startReconnect()
+        
+    def IsBusy(self):
+        # An animation or a reconnect needs the process
+        return self.effects.isRunning(self.writer) or self.reconnector.isActive
+        
+    def Stop(self):
+        # Pending writes are finished, the keyboard keeps showing the current
+        # mode
+        self._cancelTransition()
+        self.effects.Stop(self.writer)
+        self.reconnector.Stop()
+        self.writer.Stop()
+        
+    def _modeName(self, mode):
+        return MSIKeyboardService.kbmodes_rev[type(mode)]
+        
+    def _replay(self, program):
+        labels = 'mode="' + str(program.name) + '"'
+        
+        def replay(kb):
+            with msikbstats.stats.Timed('mode_apply', labels):
+                kb.Replay(program)
+        return self.writer.Submit(replay)
+        
+    def _applyMode(self, mode_index):
+        # Raises IndexError or RuntimeError, see ModeLibrary.Get
+        return self._applyModeObject(*self.service.modes.Get(mode_index))
+        
+    def _applyModeObject(self, mode, program, transition=False):
+        # With transition, the change is crossfaded if the service has a
+        # transition_time and both modes can be shown as zone colors
+        if transition and self.service.transitionTime > 0:
+            future = self._startTransition(mode, program)
+            if future is not None:
+                return future
+        self._cancelTransition()
+        self.firmwareOf = None
+        if isinstance(mode, AnimatedKeyboardMode) and self.service.powerLimits.firmwareEffects:
+            firmware = mode.getFirmwareMode()
+            if firmware is not None:
+                self.firmwareOf = mode
+                mode, program = firmware, firmware.compile(self.service.compiler)
+        future = self._replay(program)
+        if isinstance(mode, AnimatedKeyboardMode):
+            self.effects.Start(self.writer, mode, mode.getFrame(0.0))
+            self.shownColors = None
+        else:
+            self.effects.Stop(self.writer)
+            self.shownColors = mode.getZoneColors()
+        return future
+        
+    def SetBrightness(self, percent):
+        # The current frame or mode is written again with the new colors
+        self.writer.Submit(lambda kb: kb.SetBrightness(percent), coalesce=False)
+        self.writer.Reapply()
+        
+    def ReapplyAnimation(self):
+        # After the power policy changed whether animations are shown by the
+        # firmware: switch the animation shown (if any) to or from it
+        mode = self.effects.GetEffect(self.writer)
+        if not isinstance(mode, AnimatedKeyboardMode):
+            mode = self.firmwareOf
+        if mode is not None:
+            self._applyModeObject(mode, mode.compile(self.service.compiler))
+        
+    def _shownLinear(self):
+        # Linear light channels the keyboard shows, None if unknown
+        effect = self.effects.GetEffect(self.writer)
+        if isinstance(effect, msikbeffects.Transition):
+            # Retargeted from the exact interpolated state
+            return effect.current
+        frame = self.effects.GetFrame(self.writer) if effect is not None else self.shownColors
+        return msikbeffects.toLinear(frame) if frame is not None else None
+        
+    def _startTransition(self, mode, program):
+        # Returns the future of the whole crossfade (done once the mode
+        # itself is written, cancelled if another mode is selected first), or
+        # None if the change can't be crossfaded
+        target = mode.getZoneColors()
+        start = self._shownLinear()
+        if target is None or start is None or start == msikbeffects.toLinear(target):
+            return None
+        self._cancelTransition()
+        future = Future()
+        
+        def onDone(transition):
+            # The last frame is out, now the mode itself (for Gaming mode or
+            # animations it isn't the same as the frame)
+            self.transitionFuture = None
+            msikbapi.ChainFuture(self._applyModeObject(mode, program), future)
+        self.effects.Start(self.writer, msikbeffects.Transition(start, target, self.service.transitionTime, self.service.transitionEasing, onDone))
+        self.transitionFuture = future
+        return future
+        
+    def _cancelTransition(self):
+        if self.transitionFuture is not None:
+            self.transitionFuture.cancel()
+            self.transitionFuture = None
+        
+    def _currentMode(self):
+        if self.sceneMode is not None:
+            return self.sceneMode
+        if self.curModeIndex is not None:
+            try:
+                return self.service.modes.Get(self.curModeIndex)[0]
+            except (IndexError, RuntimeError):
+                pass
+        return None
+        
+    def SetModeImpl(self, mode_index):
+        # Returns the write future, or None if nothing was queued
+        try:
+            mode, program = self.service.modes.Get(mode_index)
+        except IndexError:
+            msikblog.Warn("Mode index '%d' is out of range, not setting mode", mode_index)
+            return None
+        except RuntimeError as e:
+            msikblog.Warn("Mode %d is invalid, not setting mode: %s", mode_index, e)
+            return None
+        future = self._applyModeObject(mode, program, transition=True)
+        self.curModeIndex = mode_index
+        self.sceneMode = None
+        self.sceneProgram = None
+        msikblog.Debug("%s: selected mode %d: %s", self.name, mode_index, mode)
+        self.StateChanged('mode', mode_index)
+        return future
+            
+    def SetDefaultModeImpl(self):
+        self._cancelTransition()
+        self.effects.Stop(self.writer)
+        self.shownColors = None
+        self.firmwareOf = None
+        future = self.writer.Submit(lambda kb: kb.SetDefaultMode())
+        msikblog.Debug("%s: selected Default mode", self.name)
+        self.StateChanged('default', -1)
+        return future
+        
+    def SetOffModeImpl(self):
+        self._cancelTransition()
+        self.effects.Stop(self.writer)
+        self.shownColors = OffKeyboardMode().getZoneColors()
+        self.firmwareOf = None
+        future = self.writer.Submit(lambda kb: kb.SetOffMode())
+        msikblog.Debug("%s: selected Off mode", self.name)
+        self.StateChanged('off', -1)
+        return future
+        
+    def ApplySceneImpl(self, mode, program):
+        future = self._applyModeObject(mode, program, transition=True)
+        self.sceneMode = mode
+        self.sceneProgram = program
+        msikblog.Debug("%s: applied scene: %s", self.name, mode)
+        self.StateChanged('scene', -1)
+        return future
+        
+    def SetZoneColorsImpl(self, zone_colors):
+        current = self._currentMode()
+        if type(current) is NormalKeyboardMode:
+            zones = [current.zone1, current.zone2, current.zone3]
+        else:
+            zones = [(255, 255, 255)] * 3
+        for zone, color in zone_colors:
+            zones[zone - 1] = color
+        mode = NormalKeyboardMode(*zones)
+        return self.ApplySceneImpl(mode, mode.compile(self.kb))
+        
+    def RestoreModeImpl(self):
+        if self.sceneMode is not None:
+            future = self._applyModeObject(self.sceneMode, self.sceneProgram)
+            msikblog.Debug("%s: restored scene: %s", self.name, self.sceneMode)
+            self.StateChanged('scene', -1)
+            return future
+        elif self.curModeIndex is None:
+            msikblog.Info("%s: last mode index is not set, nothing to restore", self.name)
+            return None
+        else:
+            try:
+                mode, program = self.service.modes.Get(self.curModeIndex)
+            except IndexError:
+                msikblog.Warn("Last mode index '%d' is out of range, unsetting it", self.curModeIndex)
+                self.curModeIndex = None
+                return None
+            except RuntimeError as e:
+                msikblog.Warn("Last mode %d is invalid, unsetting it: %s", self.curModeIndex, e)
+                self.curModeIndex = None
+                return None
+            future = self._applyModeObject(mode, program)
+            msikblog.Debug("%s: restored mode %d: %s", self.name, self.curModeIndex, mode)
+            self.StateChanged('mode', self.curModeIndex)
+            return future
+                
+    def ReapplyIfChanged(self, old_modes):
+        # After a config reload: write the keyboard only if the mode it shows
+        # has changed
+        if self.sceneMode is not None or self.curModeIndex is None:
+            return
+        if self.curModeIndex >= len(self.service.modes):
+            msikblog.Warn("%s: active mode %d is no longer configured", self.name, self.curModeIndex)
+            return
+        # Compared by description, so modes that aren't active are never built
+        old_description = old_modes.GetDescription(self.curModeIndex) if self.curModeIndex < len(old_modes) else None
+        if old_description != self.service.modes.GetDescription(self.curModeIndex):
+            msikblog.Info("%s: active mode changed, reapplying it", self.name)
+            self.SetModeImpl(self.curModeIndex)
+            
+    def FlushImpl(self):
+        return self.writer.Submit(lambda kb: None, coalesce=False)
+        
+    def GetLastModeIndexImpl(self):
+        return self.curModeIndex
+        
+    def GetModesImpl(self):
+        return self.service.modes
+        
+    def GetStatsImpl(self):
+        mode = self.effects.GetEffect(self.writer)
+        audio = (0, 0)
+        if isinstance(mode, AudioReactiveKeyboardMode) and mode.analyzer is not None:
+            audio = mode.analyzer.GetStats()
+        return (self.kb.GetPlanStats(), self.effects.GetStats(self.writer), audio)
+        
+    def GetState(self):
+        scene = None
+        if self.sceneMode is not None:
+            scene = {'type': self._modeName(self.sceneMode), 'config': self.sceneMode.to_dict()}
+        return {'mode_index': self.curModeIndex, 'scene': scene}
+        
+    def SetState(self, state):
+        # Raises KeyError, TypeError or RuntimeError if state is invalid
+        mode_index = state['mode_index']
+        if mode_index is not None and not 0 <= mode_index < len(self.service.modes):
+            raise RuntimeError("mode index " + str(mode_index) + " is out of range")
+        if state['scene'] is not None:
+            self.sceneMode, self.sceneProgram = MSIKeyboardService._parseModeDescription(state['scene'], self.kb)
+        self.curModeIndex = mode_index
+
+
+class MSIKeyboardService(KeyboardTarget):
+    # The group of all keyboards: backlight methods on SERVICE_PATH apply to
+    # every device at once, each device is also exported on its own path
     SERVICE_NAME = 'org.morozzz.MSIKeyboardService'
     SERVICE_PATH = '/org/morozzz/MSIKeyboardService'
     SERVICE_NATIVE_INTERFACE = 'org.morozzz.MSIKeyboardService'
+    DEVICE_PATH = SERVICE_PATH + '/Device'
     
     PROPS_INTERFACE = 'org.freedesktop.DBus.Properties'
     PROPS_CHANGED_SIGNAL = 'PropertiesChanged'
     UPOWER_NAME = 'org.freedesktop.UPower'
     
+    UPOWER_PATH = '/org/freedesktop/UPower'
+    UPOWER_DEVICE_INTERFACE = 'org.freedesktop.UPower.Device'
+    UPOWER_DISPLAY_DEVICE_PATH = '/org/freedesktop/UPower/devices/DisplayDevice'
+    
     LOGIND_MANAGER_INTERFACE = 'org.freedesktop.login1.Manager'
     SLEEP_PREPARE_SIGNAL = 'PrepareForSleep'
     LOGIND_NAME = 'org.freedesktop.login1'
+    LOGIND_PATH = '/org/freedesktop/login1'
+    
+    CONFIG_RELOAD_DELAY = 500
+    DEFAULT_STATS_INTERVAL = 15.0
+    DEFAULT_TRACE_SIZE = 16
+    DEFAULT_CONTROL_SOCKET_MODE = 0o600
+    DEFAULT_TRANSITION_EASING = 'ease-in-out'
+    DEFAULT_SIGNAL_DEBOUNCE = 0.25
     
-    RECONNECT_ATTEMPTS = 7
+    # Backlight states driven by lid and sleep events
+    POWER_ON = 'on'
+    POWER_OFF = 'off'
+    POWER_SUSPENDED = 'suspended'
     
     kbmodes = {
         'Off': OffKeyboardMode, 
@@ -215,265 +1181,970 @@ class MSIKeyboardService(dbus.service.Object):
         'Breathing': BreathingKeyboardMode, 
         'Wave': WaveKeyboardMode, 
         'Audio': AudioKeyboardMode, 
+        'Rainbow': RainbowKeyboardMode, 
+        'Gradient': GradientKeyboardMode, 
+        'Keyframes': KeyframesKeyboardMode, 
+        'AudioReactive': AudioReactiveKeyboardMode, 
+        'Metrics': MetricsKeyboardMode, 
     }
     
     kbmodes_rev = {value: key for key, value in kbmodes.items()}
     
-    def __init__(self, keyboard_object, config_file_name=None):
-        self.kb = keyboard_object
-        self.modes = []
+    def __init__(self, keyboard_objects, config_file_name=None, cache_file_name=None, state_file_name=None, export=True):
+        # With export False nothing is registered on the bus (benchmarks)
+        _importMainLoop()
+        # Modes are compiled without a device, see MSIKeyboard.Compile
+        self.compiler = msikbapi.ReportCompiler()
+        self.effects = msikbeffects.EffectEngine()
+        self.modes = ModeLibrary([])
         self.configfile = config_file_name
+        self.cachefile = cache_file_name
+        self.statefile = state_file_name
         self.isConfigChanged = False
         self.isHandleLid = False
         self.isHandleSleep = False
         self.resumeConnectDelay = 0.1
+        self.effectFrameRate = msikbeffects.EffectEngine.DEFAULT_FRAME_RATE
+        # Crossfade of mode changes in seconds, 0 - switch instantly
+        self.transitionTime = 0.0
+        self.transitionEasing = self.DEFAULT_TRANSITION_EASING
         self.defModeIndex = 0
+        # Last mode set by index on the whole group
         self.curModeIndex = None
-        bus = dbus.SystemBus()
-        bus.request_name(self.SERVICE_NAME)
-        bus_name = dbus.service.BusName(self.SERVICE_NAME, bus=bus)
-        dbus.service.Object.__init__(self, bus_name, self.SERVICE_PATH)
+        self.propsChangedMatch = None
+        self.sleepMatch = None
+        self.idleMatch = None
+        self.configMonitor = None
+        self.reloadTimerId = None
+        # Lid and sleep events are folded into the state they ask for and
+        # applied at most once per signalDebounce seconds, see _onPowerEvent
+        self.signalDebounce = self.DEFAULT_SIGNAL_DEBOUNCE
+        self.isLidClosed = False
+        self.isSleeping = False
+        # Last power state applied to the keyboards, None before the first
+        # event
+        self.powerState = None
+        self.powerTimerId = None
+        self.powerEventsPending = 0
+        # AC/battery state and battery percentage from UPower, None if
+        # unknown
+        self.isOnBattery = None
+        self.batteryPercentage = None
+        # Power policy, None - never limited, and the level and limits in
+        # effect, see _applyPowerLevel
+        self.powerPolicy = None
+        self.powerLevel = msikbpower.LEVEL_AC
+        self.powerLimits = msikbpower.UNLIMITED
+        self.powerAccounting = msikbpower.LevelAccounting()
+        # Automation rules as configured and as parsed, handed to the
+        # scheduler once the initial mode is set (see OnLoad)
+        self.ruleDescriptions = []
+        self.rules = []
+        self.ruleScheduler = msikbrules.RuleScheduler(self._onRuleMatched)
+        self.isRulesStarted = False
+        # Mode selected by a rule while the backlight was off for the lid or
+        # sleep, set when the backlight is restored
+        self.pendingRuleMode = None
+        # Exit after this many seconds without method calls, 0 - never
+        self.idleTimeout = 0
+        self.idleTimerId = None
+        # Prometheus textfile written every statsInterval seconds, if set
+        self.statsFile = None
+        self.statsInterval = self.DEFAULT_STATS_INTERVAL
+        self.statsTimerId = None
+        self.logLevel = msikblog.LEVEL_NAMES[msikblog.INFO]
+        # Lowest level kept for GetRecentLog even if not written out
+        self.logBufferLevel = msikblog.LEVEL_NAMES[msikblog.DEBUG]
+        # HID trace of all keyboards, rotated at traceSize MiB, if set
+        self.traceFile = None
+        self.traceSize = self.DEFAULT_TRACE_SIZE
+        self.recorder = None
+        # (path, mode, group) of the control socket, path None - no socket
+        self.controlSocket = (None, self.DEFAULT_CONTROL_SOCKET_MODE, None)
+        self.controlServer = None
+        self.lastActivity = time.monotonic()
+        self.isFirstCallAnswered = False
+        # Called to leave the main loop on idle exit
+        self.onIdleExit = None
+        bus_name = None
+        if export:
+            bus = dbus.SystemBus()
+            bus.request_name(self.SERVICE_NAME)
+            bus_name = dbus.service.BusName(self.SERVICE_NAME, bus=bus)
+        dbus.service.Object.__init__(self, bus_name, self.SERVICE_PATH if bus_name is not None else None)
+        self.devices = [KeyboardDevice(self, keyboard_object, bus_name, self.DEVICE_PATH + str(index)) for index, keyboard_object in enumerate(keyboard_objects)]
+        for device in self.devices:
+            msikblog.Info("Keyboard %s is available at %s", device.name, device.objectPath)
     
     def LoadDefaultConfig(self):
-        self.modes = [
+        self.modes = ModeLibrary.FromModes([
             OffKeyboardMode(), 
             DefaultKeyboardMode(), 
             NormalKeyboardMode((255, 0, 0), (0, 255, 0), (0, 0, 255)), 
             DualColorKeyboardMode((255, 0, 0), (0, 255, 0), (3, 3, 3)), 
-        ]
+        ], self.compiler)
         self.defModeIndex = 0
         self.isHandleLid = True
         self.isHandleSleep = True
         self.isConfigChanged = True
         self.resumeConnectDelay = 0.1
+        self.signalDebounce = self.DEFAULT_SIGNAL_DEBOUNCE
+        self.effectFrameRate = msikbeffects.EffectEngine.DEFAULT_FRAME_RATE
+        self.effects.frameRate = self.effectFrameRate
+        self.transitionTime = 0.0
+        self.transitionEasing = self.DEFAULT_TRANSITION_EASING
+        self.idleTimeout = 0
+        self.statsFile = None
+        self.statsInterval = self.DEFAULT_STATS_INTERVAL
+        self._updateStatsTimer()
+        self._setLogLevel(msikblog.LEVEL_NAMES[msikblog.INFO], msikblog.LEVEL_NAMES[msikblog.DEBUG])
+        self.traceFile = None
+        self.traceSize = self.DEFAULT_TRACE_SIZE
+        self._updateTrace()
+        self._updateControlServer((None, self.DEFAULT_CONTROL_SOCKET_MODE, None))
+        self.ruleDescriptions = []
+        self._updateRules([])
+        self._updatePowerPolicy(None)
+        self._updateSignalHandlers()
     
     def LoadDefaultConfigConditional(self):
         if self.modes:
-            print("Leaving current configuration")
+            msikblog.Info("Leaving current configuration")
         else:
-            print("Loading default config")
+            msikblog.Info("Loading default config")
             self.LoadDefaultConfig()
     
     def PrepareForSleepHandler(self, isSleep):
+        with msikbstats.stats.Timed('signal_handler', 'signal="PrepareForSleep"'):
+            self._handlePrepareForSleep(isSleep)
+            
+    def _handlePrepareForSleep(self, isSleep):
         # True - hibernating, False - resuming
-        if isSleep:
-            print("Suspend detected, turning off keyboard backlight and disconnecting")
-            self.SetOffModeImpl()
-            self.kb.Disconnect()
-        else:
-            print("Resume detected, reconnecting and restoring keyboard backlight")
-            isConnected = False
-            for i in range(self.RECONNECT_ATTEMPTS):
-                try:
-                    self.kb.Connect()
-                    isConnected = True
-                    break
-                except OSError:
-                    print("Connect attempt #" + str(i+1) + " failed, retrying")
-                    time.sleep(self.resumeConnectDelay)
-            if not isConnected:
-                raise OSError("Can't connect to keyboard device")
-            self.RestoreModeImpl()
+        self.isSleeping = isSleep
+        self._onPowerEvent('sleep' if isSleep else 'resume')
     
-    def PropsChangedHandler(self, source, props_dict, unused):
+    def PropsChangedHandler(self, source, props_dict, unused, path=None):
+        with msikbstats.stats.Timed('signal_handler', 'signal="PropertiesChanged"'):
+            self._handlePropsChanged(source, props_dict, path)
+            
+    def _handlePropsChanged(self, source, props_dict, path=None):
         if source == self.UPOWER_NAME:
-            if 'LidIsClosed' in props_dict:
+            if 'LidIsClosed' in props_dict and self.isHandleLid:
                 isLidClosed = props_dict['LidIsClosed']
                 if isinstance(isLidClosed, dbus.Boolean):
                     self.LidActionHandler(bool(isLidClosed))
                 else:
-                    print('Warning: property LidIsClosed has unusual type ' + str(type(isLidClosed)) + ", skipping signal")
+                    msikblog.Warn("Property LidIsClosed has unusual type %s, skipping signal", type(isLidClosed))
+            if 'OnBattery' in props_dict:
+                self._setOnBattery(bool(props_dict['OnBattery']))
+        elif source == self.UPOWER_DEVICE_INTERFACE and path == self.UPOWER_DISPLAY_DEVICE_PATH:
+            if 'Percentage' in props_dict:
+                self.batteryPercentage = float(props_dict['Percentage'])
+                self._applyPowerLevel()
+        elif source == self.LOGIND_MANAGER_INTERFACE:
+            if 'IdleHint' in props_dict:
+                self.ruleScheduler.SetIdle(bool(props_dict['IdleHint']))
+                
+    def _setOnBattery(self, isOnBattery):
+        if isOnBattery != self.isOnBattery:
+            msikblog.Info("Running on %s", "battery" if isOnBattery else "AC power")
+        self.isOnBattery = isOnBattery
+        self.ruleScheduler.SetOnBattery(isOnBattery)
+        self._applyPowerLevel()
+        
+    def _updatePowerPolicy(self, policy):
+        self.powerPolicy = policy
+        if policy is not None:
+            if self.isOnBattery is None:
+                self.isOnBattery = self._readProperty(self.UPOWER_NAME, self.UPOWER_PATH, self.UPOWER_NAME, 'OnBattery')
+                self.ruleScheduler.isOnBattery = self.isOnBattery
+            if self.batteryPercentage is None:
+                self.batteryPercentage = self._readProperty(self.UPOWER_NAME, self.UPOWER_DISPLAY_DEVICE_PATH, self.UPOWER_DEVICE_INTERFACE, 'Percentage', float)
+        self._applyPowerLevel()
+        
+    def _applyPowerLevel(self):
+        # Apply the limits of the level the power state asks for, changing
+        # only what differs from the limits in effect
+        if self.powerPolicy is None:
+            level = msikbpower.LEVEL_AC
+        else:
+            level = self.powerPolicy.Level(self.isOnBattery, self.batteryPercentage)
+        limits = self.powerPolicy.Limits(level) if self.powerPolicy is not None else msikbpower.UNLIMITED
+        if level != self.powerLevel:
+            self.powerAccounting.Switch(level)
+            self.powerLevel = level
+            msikbstats.stats.Count('power_level_changes', 'level="' + level + '"')
+            msikblog.Info("Power level %s: frame rate %s, %s wakeups per second, brightness %d%%", level, 
+                          limits.frameRate or "not limited", limits.maxWakeups or "any", limits.brightness)
+        old_limits = self.powerLimits
+        if limits == old_limits:
+            return
+        self.powerLimits = limits
+        self.effects.SetLimits(limits.frameRate, limits.maxWakeups)
+        for device in self.devices:
+            if limits.brightness != old_limits.brightness:
+                device.SetBrightness(limits.brightness)
+            if limits.firmwareEffects != old_limits.firmwareEffects:
+                device.ReapplyAnimation()
     
     def LidActionHandler(self, isLidClosed):
-        if isLidClosed is True:
-            print("Lid close detected, turning off keyboard backlight")
+        self.isLidClosed = isLidClosed is True
+        self._onPowerEvent('lid_close' if self.isLidClosed else 'lid_open')
+        
+    def _powerTarget(self):
+        # Sleep takes precedence over the lid
+        if self.isSleeping:
+            return self.POWER_SUSPENDED
+        return self.POWER_OFF if self.isLidClosed else self.POWER_ON
+        
+    def _onPowerEvent(self, event):
+        # Flaky lid switches, docks and suspend/resume races send bursts of
+        # events. Events only update the state asked for, which is applied
+        # once signalDebounce seconds after the first event of a burst, so a
+        # burst costs at most one keyboard update. Suspend is applied right
+        # away, the main loop doesn't run again before the machine sleeps.
+        msikbstats.stats.Count('power_events', 'event="' + event + '"')
+        self.powerEventsPending += 1
+        if self.isSleeping or self.signalDebounce <= 0:
+            self._applyPowerState()
+        elif self.powerTimerId is None:
+            self.powerTimerId = GLib.timeout_add(max(1, int(self.signalDebounce * 1000)), self._onPowerTimer)
+            
+    def _onPowerTimer(self):
+        self.powerTimerId = None
+        self._applyPowerState()
+        return False
+        
+    def _applyPowerState(self):
+        if self.powerTimerId is not None:
+            GLib.source_remove(self.powerTimerId)
+            self.powerTimerId = None
+        target = self._powerTarget()
+        current = self.powerState
+        events = self.powerEventsPending
+        self.powerEventsPending = 0
+        if target == current:
+            msikbstats.stats.Count('power_events_collapsed', '', events)
+            msikblog.Debug("%d lid/sleep event(s) left the backlight %s", events, target)
+            return
+        msikbstats.stats.Count('power_events_collapsed', '', events - 1)
+        msikbstats.stats.Count('power_updates', 'state="' + target + '"')
+        if target == self.POWER_SUSPENDED:
+            msikblog.Info("Suspend detected, turning off keyboard backlight and disconnecting")
             self.SetOffModeImpl()
+            for device in self.devices:
+                device.Suspend()
+        elif current == self.POWER_SUSPENDED:
+            msikblog.Info("Resume detected, reconnecting keyboards")
+            # The backlight state from before the suspend (off) is applied
+            # again once reconnected
+            for device in self.devices:
+                device.Resume()
+            # Rule timers don't count the time asleep. Still suspended here,
+            # so a rule that matches now is left to the restore below.
+            if self.isRulesStarted:
+                self.ruleScheduler.Reschedule()
+        self.powerState = target
+        if target == self.POWER_SUSPENDED:
+            return
+        if target == self.POWER_OFF:
+            msikblog.Info("Lid closed, turning off keyboard backlight")
+            if current != self.POWER_SUSPENDED:
+                self.SetOffModeImpl()
+        elif self.pendingRuleMode is not None:
+            msikblog.Info("Restoring keyboard backlight with the mode selected by rules")
+            self.SetModeImpl(self.pendingRuleMode)
         else:
-            print("Lid open detected, restoring keyboard backlight")
+            msikblog.Info("Restoring keyboard backlight")
             self.RestoreModeImpl()
             
-    def _connectPropsChangedHandler(self):
-        bus = dbus.SystemBus()
-        bus.add_signal_receiver(self.PropsChangedHandler, self.PROPS_CHANGED_SIGNAL, self.PROPS_INTERFACE, self.UPOWER_NAME)
+    def _onRuleMatched(self, index, rule):
+        if isinstance(rule.mode, str):
+            mode_index = self.modes.IndexOf(rule.mode)
+        else:
+            mode_index = rule.mode if rule.mode < len(self.modes) else None
+        if mode_index is None:
+            msikblog.Warn("Rule %d selects mode '%s' which is not configured", index, rule.mode)
+            return
+        if self.powerState in (self.POWER_OFF, self.POWER_SUSPENDED):
+            msikblog.Info("Rule %d matches, mode %d is set when the backlight is restored", index, mode_index)
+            self.pendingRuleMode = mode_index
+            return
+        msikblog.Info("Rule %d matches, setting mode %d", index, mode_index)
+        self.SetModeImpl(mode_index)
+        
+    def _updateRules(self, rules):
+        self.rules = rules
+        if msikbrules.UsesPower(rules) and self.isOnBattery is None:
+            self.isOnBattery = self._readProperty(self.UPOWER_NAME, self.UPOWER_PATH, self.UPOWER_NAME, 'OnBattery')
+            self.ruleScheduler.isOnBattery = self.isOnBattery
+        if msikbrules.UsesIdle(rules):
+            isIdle = self._readProperty(self.LOGIND_NAME, self.LOGIND_PATH, self.LOGIND_MANAGER_INTERFACE, 'IdleHint')
+            self.ruleScheduler.isIdle = bool(isIdle)
+        if self.isRulesStarted:
+            self.ruleScheduler.SetRules(rules)
+            
+    def _startRules(self):
+        # After the initial mode is set, so the first matching rule wins
+        self.isRulesStarted = True
+        self.ruleScheduler.SetRules(self.rules)
         
-    def _connectSleepHandler(self):
-        bus = dbus.SystemBus()
-        bus.add_signal_receiver(self.PrepareForSleepHandler, self.SLEEP_PREPARE_SIGNAL, self.LOGIND_MANAGER_INTERFACE, self.LOGIND_NAME)
+    @staticmethod
+    def _readProperty(bus_name, object_path, interface, name, convert=bool):
+        # Returns the property converted to a Python type, None if it can't
+        # be read
+        try:
+            value = dbus.SystemBus().call_blocking(bus_name, object_path, MSIKeyboardService.PROPS_INTERFACE, 'Get', 'ss', (interface, name))
+            return convert(value)
+        except dbus.DBusException as e:
+            msikblog.Warn("Can't read %s.%s: %s", interface, name, e)
+            return None
+            
+    def _updateSignalHandlers(self):
+        # Connect or disconnect signal receivers to match the configuration,
+        # each receiver is registered at most once however often it's reloaded
+        isWatchingUPower = self.isHandleLid or msikbrules.UsesPower(self.rules) or self.powerPolicy is not None
+        if isWatchingUPower and self.propsChangedMatch is None:
+            # The display device sends the battery percentage
+            self.propsChangedMatch = dbus.SystemBus().add_signal_receiver(self.PropsChangedHandler, self.PROPS_CHANGED_SIGNAL, self.PROPS_INTERFACE, self.UPOWER_NAME, path_keyword='path')
+        elif not isWatchingUPower and self.propsChangedMatch is not None:
+            self.propsChangedMatch.remove()
+            self.propsChangedMatch = None
+        isWatchingIdle = msikbrules.UsesIdle(self.rules)
+        if isWatchingIdle and self.idleMatch is None:
+            self.idleMatch = dbus.SystemBus().add_signal_receiver(self.PropsChangedHandler, self.PROPS_CHANGED_SIGNAL, self.PROPS_INTERFACE, self.LOGIND_NAME, self.LOGIND_PATH)
+        elif not isWatchingIdle and self.idleMatch is not None:
+            self.idleMatch.remove()
+            self.idleMatch = None
+        if self.isHandleSleep and self.sleepMatch is None:
+            self.sleepMatch = dbus.SystemBus().add_signal_receiver(self.PrepareForSleepHandler, self.SLEEP_PREPARE_SIGNAL, self.LOGIND_MANAGER_INTERFACE, self.LOGIND_NAME)
+        elif not self.isHandleSleep and self.sleepMatch is not None:
+            self.sleepMatch.remove()
+            self.sleepMatch = None
+            
+    def _watchConfig(self):
+        if self.configfile is None or self.configMonitor is not None:
+            return
+        try:
+            self.configMonitor = Gio.File.new_for_path(self.configfile).monitor_file(Gio.FileMonitorFlags.NONE, None)
+            self.configMonitor.connect('changed', self._onConfigFileChanged)
+        except GLib.Error as e:
+            msikblog.Warn("Can't watch config file for changes: %s", e)
+            self.configMonitor = None
+            
+    def _onConfigFileChanged(self, monitor, file, other_file, event_type):
+        # Editors save in bursts of events, reload once they have settled
+        if self.reloadTimerId is not None:
+            GLib.source_remove(self.reloadTimerId)
+        self.reloadTimerId = GLib.timeout_add(self.CONFIG_RELOAD_DELAY, self._onReloadTimer)
+        
+    def _onReloadTimer(self):
+        self.reloadTimerId = None
+        if os.path.exists(self.configfile):
+            msikblog.Info("Config file changed")
+            self.ReloadConfigImpl()
+        return False
     
     def LoadConfig(self):
         if self.configfile is not None:
-            print("Loading config from file " + self.configfile)
+            msikblog.Info("Loading config from file %s", self.configfile)
             try:
-                config_file = open(self.configfile, 'r')
-                config_dict = yaml.load(config_file)
-                config_file.close()
+                with msikbstats.stats.Timed('config_load'):
+                    config_dict, modes = self._readConfig(self.configfile, self.cachefile)
                 try:
                     self.defModeIndex = int(config_dict['default_index'])
                 except (KeyError, TypeError, ValueError):
-                    print("Key 'default_index' not found or invalid, proceeding with default value '" + self.defModeIndex + "'")
+                    msikblog.Info("Key 'default_index' not found or invalid, proceeding with default value '%s'", self.defModeIndex)
                 try:
                     self.isHandleLid = bool(config_dict['handle_lid'])
-                    if self.isHandleLid:
-                        self._connectPropsChangedHandler()
                 except (KeyError, TypeError, ValueError):
-                    print("Key 'handle_lid' not found or invalid, not handling lid events")
+                    self.isHandleLid = False
+                    msikblog.Info("Key 'handle_lid' not found or invalid, not handling lid events")
                 try:
                     self.isHandleSleep = bool(config_dict['handle_sleep'])
-                    if self.isHandleSleep:
-                        self._connectSleepHandler()
                 except (KeyError, TypeError, ValueError):
-                    print("Key 'handle_sleep' not found or invalid, not handling sleep events")
+                    self.isHandleSleep = False
+                    msikblog.Info("Key 'handle_sleep' not found or invalid, not handling sleep events")
                 try:
                     self.resumeConnectDelay = float(config_dict['resume_to_connect_delay'])
                 except (KeyError, TypeError, ValueError):
-                    print("Key 'resume_to_connect_delay' not found or invalid, setting to default " + str(self.resumeConnectDelay) + " seconds")
-                modes_list = config_dict['modes']
-                modes = []
-                for mode_description in modes_list:
-                    try:
-                        mode_type_name = mode_description['type']
-                        mode_dict = mode_description['config']
-                    except KeyError as e:
-                        raise RuntimeError("Can't find key " + str(e) + " in one of the mode descriptions")
-                    except TypeError:
-                        raise RuntimeError("Invalid config block type for mode description (must be mapping)")
-                    try:
-                        mode_type = self.kbmodes[mode_type_name]
-                    except KeyError:
-                        raise RuntimeError("Unknown mode '" + mode_type_name + "'")
-                    try:
-                        mode = mode_type.from_dict(mode_dict)
-                    except KeyError as e:
-                        raise RuntimeError("Invalid config for mode '" + mode_type_name + "': can't find key '" + str(e) + "'")
-                    except TypeError:
-                        raise RuntimeError("Invalid config for mode '" + mode_type_name + "': invalid config block type")
-                    modes.append(mode)
+                    msikblog.Info("Key 'resume_to_connect_delay' not found or invalid, setting to default %s seconds", self.resumeConnectDelay)
+                try:
+                    self.signalDebounce = max(0.0, float(config_dict.get('signal_debounce', self.DEFAULT_SIGNAL_DEBOUNCE)))
+                except (TypeError, ValueError):
+                    self.signalDebounce = self.DEFAULT_SIGNAL_DEBOUNCE
+                    msikblog.Warn("Key 'signal_debounce' is invalid, setting to default %s seconds", self.signalDebounce)
+                try:
+                    self.effectFrameRate = float(config_dict['effect_frame_rate'])
+                    if self.effectFrameRate <= 0:
+                        raise ValueError()
+                except (KeyError, TypeError, ValueError):
+                    self.effectFrameRate = msikbeffects.EffectEngine.DEFAULT_FRAME_RATE
+                    msikblog.Info("Key 'effect_frame_rate' not found or invalid, setting to default %s frames per second", self.effectFrameRate)
+                self.effects.frameRate = self.effectFrameRate
+                try:
+                    self.transitionTime = max(0.0, float(config_dict.get('transition_time', 0.0)))
+                except (TypeError, ValueError):
+                    self.transitionTime = 0.0
+                    msikblog.Warn("Key 'transition_time' is invalid, switching modes instantly")
+                self.transitionEasing = config_dict.get('transition_easing', self.DEFAULT_TRANSITION_EASING)
+                if self.transitionEasing not in msikbeffects.EASINGS:
+                    msikblog.Warn("Key 'transition_easing' is invalid, setting to default '%s'", self.DEFAULT_TRANSITION_EASING)
+                    self.transitionEasing = self.DEFAULT_TRANSITION_EASING
+                try:
+                    self.idleTimeout = max(0, int(config_dict['idle_timeout']))
+                except (KeyError, TypeError, ValueError):
+                    self.idleTimeout = 0
+                    msikblog.Info("Key 'idle_timeout' not found or invalid, not exiting when idle")
+                self.statsFile = config_dict.get('stats_file')
+                if self.statsFile is not None and not isinstance(self.statsFile, str):
+                    msikblog.Warn("Key 'stats_file' is invalid, not writing stats")
+                    self.statsFile = None
+                try:
+                    self.statsInterval = float(config_dict['stats_interval'])
+                    if self.statsInterval <= 0:
+                        raise ValueError()
+                except (KeyError, TypeError, ValueError):
+                    self.statsInterval = self.DEFAULT_STATS_INTERVAL
+                    if self.statsFile is not None:
+                        msikblog.Info("Key 'stats_interval' not found or invalid, setting to default %s seconds", self.statsInterval)
+                self._updateStatsTimer()
+                log_level = config_dict.get('log_level', msikblog.LEVEL_NAMES[msikblog.INFO])
+                if log_level not in msikblog.LEVELS:
+                    msikblog.Warn("Key 'log_level' is invalid, setting to default 'info'")
+                    log_level = msikblog.LEVEL_NAMES[msikblog.INFO]
+                log_buffer_level = config_dict.get('log_buffer_level', msikblog.LEVEL_NAMES[msikblog.DEBUG])
+                if log_buffer_level not in msikblog.LEVELS:
+                    msikblog.Warn("Key 'log_buffer_level' is invalid, setting to default 'debug'")
+                    log_buffer_level = msikblog.LEVEL_NAMES[msikblog.DEBUG]
+                self._setLogLevel(log_level, log_buffer_level)
+                traceFile = config_dict.get('hid_trace')
+                if traceFile is not None and not isinstance(traceFile, str):
+                    msikblog.Warn("Key 'hid_trace' is invalid, not tracing HID traffic")
+                    traceFile = None
+                try:
+                    self.traceSize = int(config_dict['hid_trace_size'])
+                    if self.traceSize <= 0:
+                        raise ValueError()
+                except (KeyError, TypeError, ValueError):
+                    self.traceSize = self.DEFAULT_TRACE_SIZE
+                    if traceFile is not None:
+                        msikblog.Info("Key 'hid_trace_size' not found or invalid, setting to default %d MiB", self.traceSize)
+                self.traceFile = traceFile
+                self._updateTrace()
+                self._updateControlServer(self._readControlSocketConfig(config_dict))
+                try:
+                    rules = msikbrules.ParseRules(config_dict.get('rules', []))
+                    self.ruleDescriptions = config_dict.get('rules', [])
+                except ValueError as e:
+                    msikblog.Warn("Key 'rules' is invalid, not using rules: %s", e)
+                    rules = []
+                    self.ruleDescriptions = []
                 self.modes = modes
-                print("Configuration loaded successfully")
+                self._updateRules(rules)
+                self._updatePowerPolicy(self._readPowerPolicyConfig(config_dict))
+                self._updateSignalHandlers()
+                msikblog.Info("Configuration loaded successfully")
                 return True
             except (FileNotFoundError, PermissionError):
-                print("Can't open configuration file '" + str(self.configfile) + "'")
+                msikblog.Error("Can't open configuration file '%s'", self.configfile)
             except KeyError as e:
-                print("Invalid configuration file format: can't find key '" + str(e) + "'")
+                msikblog.Error("Invalid configuration file format: can't find key '%s'", e)
             except TypeError:
-                print("Invalid configuration file format: invalid block type")
+                msikblog.Error("Invalid configuration file format: invalid block type")
             except RuntimeError as e:
-                print("Invalid configuration file: " + str(e))
-            except yaml.YAMLError as e:
-                print("Incorrect configuration file: " + str(e))
+                msikblog.Error("Invalid configuration file: %s", e)
+            except msikbconfig.ConfigFormatError as e:
+                msikblog.Error("Incorrect configuration file: %s", e)
             self.LoadDefaultConfigConditional()
             return False
         else:
-            print("Config file name is not set")
+            msikblog.Info("Config file name is not set")
             self.LoadDefaultConfigConditional()
             return False
             
+    def ReloadConfigImpl(self):
+        # Reload and write a keyboard only if its active mode has changed
+        old_modes = self.modes
+        result = self.LoadConfig()
+        for device in self.devices:
+            device.ReapplyIfChanged(old_modes)
+        self._armIdleTimer()
+        return result
+        
+    @staticmethod
+    def _codeKey():
+        # Snapshots hold pickled mode objects and programs, so they are only
+        # valid for the code that made them
+        return tuple(os.stat(module.__file__).st_mtime_ns for module in (msikbapi, msikbeffects, msikbaudio, msikbmetrics, msikbconfig, sys.modules[__name__]))
+        
+    @classmethod
+    def _readConfig(cls, config_file_name, cache_file_name):
+        # Returns (config dict, ModeLibrary), from the snapshot if it is
+        # still valid for the config file
+        snapshot = msikbconfig.ConfigSnapshot(cache_file_name, cls._codeKey()) if cache_file_name is not None else None
+        if snapshot is not None:
+            payload = snapshot.Load(config_file_name)
+            if payload is not None:
+                msikblog.Info("Using config snapshot %s", cache_file_name)
+                return payload
+        config_dict, file_key = msikbconfig.ReadConfigFile(config_file_name)
+        modes = ModeLibrary(config_dict['modes'])
+        if snapshot is not None:
+            snapshot.Store(file_key, (config_dict, modes))
+        return config_dict, modes
+        
+    @classmethod
+    def _parseModeDescription(cls, mode_description, keyboard_object):
+        # Returns (mode, compiled program), raises RuntimeError if invalid
+        try:
+            mode_type_name = mode_description['type']
+            mode_dict = mode_description['config']
+        except KeyError as e:
+            raise RuntimeError("Can't find key " + str(e) + " in one of the mode descriptions")
+        except TypeError:
+            raise RuntimeError("Invalid config block type for mode description (must be mapping)")
+        try:
+            mode_type = cls.kbmodes[mode_type_name]
+        except (KeyError, TypeError):
+            raise RuntimeError("Unknown mode '" + str(mode_type_name) + "'")
+        try:
+            mode = mode_type.from_dict(mode_dict)
+        except KeyError as e:
+            raise RuntimeError("Invalid config for mode '" + mode_type_name + "': can't find key '" + str(e) + "'")
+        except TypeError:
+            raise RuntimeError("Invalid config for mode '" + mode_type_name + "': invalid config block type")
+        except ValueError as e:
+            raise RuntimeError("Invalid config for mode '" + mode_type_name + "': " + str(e))
+        try:
+            program = mode.compile(keyboard_object)
+        except (AttributeError, OverflowError, TypeError, ValueError):
+            raise RuntimeError("Invalid config for mode '" + mode_type_name + "': invalid color or time value")
+        return mode, program
+            
     def _getConfigDict(self):
-        modes_list = []
-        for mode in self.modes:
-            mode_type_name = self.kbmodes_rev[type(mode)]
-            mode_dict = mode.to_dict()
-            mode_description = {"type": mode_type_name, "config": mode_dict}
-            modes_list.append(mode_description)
-        return {'modes': modes_list, 'default_index': self.defModeIndex, 'handle_lid': self.isHandleLid, 'handle_sleep': self.isHandleSleep, 'resume_to_connect_delay': self.resumeConnectDelay}
+        return {'modes': list(self.modes.descriptions), 'default_index': self.defModeIndex, 'handle_lid': self.isHandleLid, 'handle_sleep': self.isHandleSleep, 'resume_to_connect_delay': self.resumeConnectDelay, 'signal_debounce': self.signalDebounce, 'effect_frame_rate': self.effectFrameRate, 'transition_time': self.transitionTime, 'transition_easing': self.transitionEasing, 'idle_timeout': self.idleTimeout, 'stats_file': self.statsFile, 'stats_interval': self.statsInterval, 'log_level': self.logLevel, 'log_buffer_level': self.logBufferLevel, 'hid_trace': self.traceFile, 'hid_trace_size': self.traceSize, 
+                'control_socket': self.controlSocket[0], 'control_socket_mode': '%04o' % self.controlSocket[1], 'control_socket_group': self.controlSocket[2], 'rules': self.ruleDescriptions, 
+                'power_policy': self.powerPolicy.to_dict() if self.powerPolicy is not None else None}
             
     def SaveConfig(self, Forced=False):
         if self.configfile is None:
-            print("Config file name is not set, not saving")
+            msikblog.Info("Config file name is not set, not saving")
             return False
         elif not Forced and self.isConfigChanged is False:
-            print("Configuration not changed, not saving")
+            msikblog.Info("Configuration not changed, not saving")
             return False
         else:
-            print("Saving configuration to file '" + self.configfile + "'")
+            msikblog.Info("Saving configuration to file '%s'", self.configfile)
             try:
-                config_file = open(self.configfile, "w")
                 config_dict = self._getConfigDict()
-                yaml.dump(config_dict, config_file)
-                config_file.close()
-                print("Configuration successfully saved")
+                with msikbstats.stats.Timed('config_save'):
+                    file_key = msikbconfig.WriteConfigFile(self.configfile, config_dict)
+                msikblog.Info("Configuration successfully saved")
+                if self.cachefile is not None:
+                    msikbconfig.ConfigSnapshot(self.cachefile, self._codeKey()).Store(file_key, (config_dict, self.modes))
                 return True
             except (FileNotFoundError, PermissionError):
-                print("Can't open file " + self.configfile + " for write, not saving config")
+                msikblog.Error("Can't open file %s for write, not saving config", self.configfile)
                 return False
             
+    def _fanOut(self, action):
+        # Run action on every device and gather the write futures. Each
+        # device has its own writer thread, so a slow or disconnected
+        # keyboard doesn't hold the others up.
+        # A device whose queue is full is left out, Full is raised only if
+        # every device's is.
+        futures = []
+        busy = 0
+        for device in self.devices:
+            try:
+                future = action(device)
+            except Full:
+                msikblog.Warn("%s: write queue is full, skipping request", device.name)
+                busy += 1
+                continue
+            if future is not None:
+                futures.append(future)
+        if busy and busy == len(self.devices):
+            raise Full("All keyboard write queues are full")
+        if not futures:
+            return None
+        return msikbapi.GatherFutures(futures)
+            
     def SetModeImpl(self, mode_index):
-        try:
-            mode = self.modes[mode_index]
-            mode.setMode(self.kb)
-            self.curModeIndex = mode_index
-            print("Selected mode " + str(mode_index) + ": " + self.kbmodes_rev[type(mode)])
-            return True
-        except IndexError:
-            print("Warning: Mode index '" + str(mode_index) + "' is out of range, not setting mode")
-            return False
+        # Returns the write future, or None if nothing was queued
+        if not 0 <= mode_index < len(self.modes):
+            msikblog.Warn("Mode index '%d' is out of range, not setting mode", mode_index)
+            return None
+        future = self._fanOut(lambda device: device.SetModeImpl(mode_index))
+        self.curModeIndex = mode_index
+        self.pendingRuleMode = None
+        self.StateChanged('mode', mode_index)
+        return future
             
     def SetDefaultModeImpl(self):
-        self.kb.SetDefaultMode()
-        print("Selected Default mode")
+        future = self._fanOut(lambda device: device.SetDefaultModeImpl())
+        self.StateChanged('default', -1)
+        return future
         
     def SetOffModeImpl(self):
-        self.kb.SetOffMode()
-        print("Selected Off mode")
+        future = self._fanOut(lambda device: device.SetOffModeImpl())
+        self.StateChanged('off', -1)
+        return future
+        
+    def ApplySceneImpl(self, mode, program):
+        future = self._fanOut(lambda device: device.ApplySceneImpl(mode, program))
+        self.StateChanged('scene', -1)
+        return future
+        
+    def SetZoneColorsImpl(self, zone_colors):
+        # Zones not listed keep each device's own colors
+        future = self._fanOut(lambda device: device.SetZoneColorsImpl(zone_colors))
+        self.StateChanged('scene', -1)
+        return future
         
     def RestoreModeImpl(self):
-        if self.curModeIndex is None:
-            print("Last mode index is not set, nothing to restore")
-            return False
-        else:
+        # Every device restores its own last mode or scene
+        return self._fanOut(lambda device: device.RestoreModeImpl())
+                
+    def FlushImpl(self):
+        return msikbapi.GatherFutures(device.FlushImpl() for device in self.devices)
+            
+    def GetLastModeIndexImpl(self):
+        return self.curModeIndex
+        
+    def GetModesImpl(self):
+        return self.modes
+        
+    def GetStatsImpl(self):
+        # Sums over all devices, an effect shown on several of them counts once
+        # for audio stats
+        reports = {}
+        for device in self.devices:
+            for name, stats in device.kb.GetPlanStats().items():
+                reports[name] = tuple(a + b for a, b in zip(reports.get(name, (0, 0, 0)), stats))
+        audio = (0, 0)
+        for mode in self.effects.GetEffects():
+            if isinstance(mode, AudioReactiveKeyboardMode) and mode.analyzer is not None:
+                audio = tuple(a + b for a, b in zip(audio, mode.analyzer.GetStats()))
+        return (reports, self.effects.GetStats(), audio)
+        
+    def _updateStatsTimer(self):
+        if self.statsTimerId is not None:
+            GLib.source_remove(self.statsTimerId)
+            self.statsTimerId = None
+        if self.statsFile is not None:
+            self.statsTimerId = GLib.timeout_add(int(self.statsInterval * 1000), self._onStatsTimer)
+            
+    def _onStatsTimer(self):
+        self.powerAccounting.Update()
+        msikbstats.stats.WritePrometheus(self.statsFile)
+        return True
+        
+    def WriteStats(self):
+        if self.statsFile is not None:
+            self.powerAccounting.Update()
+            msikbstats.stats.WritePrometheus(self.statsFile)
+            
+    def _updateTrace(self):
+        # (Re)open the trace if its file or size changed and hand it to every
+        # keyboard, writer threads pick it up with their next write
+        if self.recorder is not None and self.recorder.fileName == self.traceFile and self.recorder.maxSize == self.traceSize * 1024 * 1024:
+            return
+        recorder = None
+        if self.traceFile is not None:
             try:
-                mode = self.modes[self.curModeIndex]
-                mode.setMode(self.kb)
-                print("Restored mode " + str(self.curModeIndex) + ": " + self.kbmodes_rev[type(mode)])
-                return True
-            except IndexError:
-                print("Warning: Last mode index '" + str(self.curModeIndex) + "' is out of range, unsetting it")
-                self.curModeIndex = None
-                return False
+                recorder = msikbtrace.TraceRecorder(self.traceFile, self.traceSize * 1024 * 1024)
+                msikblog.Info("Tracing HID traffic to %s", self.traceFile)
+            except OSError as e:
+                msikblog.Error("Can't open HID trace '%s': %s", self.traceFile, e)
+        for index, device in enumerate(self.devices):
+            device.kb.traceDevice = index
+            device.kb.recorder = recorder
+        if self.recorder is not None:
+            self.recorder.Close()
+        self.recorder = recorder
+        
+    def _readControlSocketConfig(self, config_dict):
+        path = config_dict.get('control_socket')
+        if path is not None and not isinstance(path, str):
+            msikblog.Warn("Key 'control_socket' is invalid, not opening a control socket")
+            path = None
+        mode = config_dict.get('control_socket_mode', self.DEFAULT_CONTROL_SOCKET_MODE)
+        try:
+            # An octal string like '0660', or a number
+            mode = int(mode, 8) if isinstance(mode, str) else int(mode)
+            if not 0 <= mode <= 0o777:
+                raise ValueError()
+        except (TypeError, ValueError):
+            msikblog.Warn("Key 'control_socket_mode' is invalid, setting to default %04o", self.DEFAULT_CONTROL_SOCKET_MODE)
+            mode = self.DEFAULT_CONTROL_SOCKET_MODE
+        group = config_dict.get('control_socket_group')
+        if group is not None and not isinstance(group, str):
+            msikblog.Warn("Key 'control_socket_group' is invalid, not changing the socket group")
+            group = None
+        return (path, mode, group)
+        
+    def _readPowerPolicyConfig(self, config_dict):
+        description = config_dict.get('power_policy')
+        if description is None:
+            return None
+        try:
+            return msikbpower.PowerPolicy.FromDict(description)
+        except ValueError as e:
+            msikblog.Warn("Key 'power_policy' is invalid, not limiting effects on battery: %s", e)
+            return None
+        
+    def _updateControlServer(self, control_socket):
+        # (Re)open the control socket if its configuration changed
+        if control_socket == self.controlSocket and (self.controlServer is not None or control_socket[0] is None):
+            return
+        self._stopControlServer()
+        self.controlSocket = control_socket
+        path, mode, group = control_socket
+        if path is None:
+            return
+        from msikeyboard import msikbsocket
+        server = msikbsocket.ControlServer(self, path, mode, group)
+        try:
+            server.Start()
+            self.controlServer = server
+        except KeyError:
+            msikblog.Error("Unknown control socket group '%s', not opening a control socket", group)
+        except OSError as e:
+            msikblog.Error("Can't open control socket '%s': %s", path, e)
             
-    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="t", out_signature="b")
-    def SetMode(self, index):
-        return self.SetModeImpl(index)
+    def _stopControlServer(self):
+        if self.controlServer is not None:
+            self.controlServer.Stop()
+            self.controlServer = None
+            
+    def _closeTrace(self):
+        if self.recorder is not None:
+            self.recorder.Close()
+            
+    def _setLogLevel(self, log_level, log_buffer_level):
+        self.logLevel = log_level
+        self.logBufferLevel = log_buffer_level
+        msikblog.log.SetLevel(msikblog.LEVELS[log_level], msikblog.LEVELS[log_buffer_level])
+            
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="(a{st}a{s(dtat)}ad)")
+    def GetStats(self):
+        # (counters, latency histograms as (sum in seconds, count, per-bucket
+        # counts), bucket upper bounds in seconds without the final +Inf)
+        self.powerAccounting.Update()
+        counters, histograms = msikbstats.stats.Snapshot()
+        return (counters, histograms, list(msikbstats.BUCKETS))
         
-    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="")
-    def SetDefaultMode(self):
-        self.SetDefaultModeImpl()
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="t", out_signature="a(dss)")
+    def GetRecentLog(self, count):
+        # Newest count log records as (unix time, level, message), including
+        # debug records not written to the log at the current log_level
+        return msikblog.log.GetRecent(count)
         
-    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="")
-    def SetOffMode(self):
-        self.SetOffModeImpl()
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="ao")
+    def GetDevices(self):
+        return [device.objectPath for device in self.devices]
         
     @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="t")
     def GetModesNumber(self):
         return len(self.modes)
         
-    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="bt")
-    def GetLastModeIndex(self):
-        return (True, self.curModeIndex) if self.curModeIndex is not None else (False, 0)
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="t", out_signature="aay")
+    def GetModeProgram(self, index):
+        try:
+            return list(self.modes.Get(index)[1].reports)
+        except (IndexError, RuntimeError):
+            return []
+        
+    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="a(tss)")
+    def ListModes(self):
+        # (index, name or '', type name) of every mode, without building any
+        return [(index, self.modes.GetName(index), self.modes.GetTypeName(index)) for index in range(len(self.modes))]
         
     @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="b")
     def ReloadConfig(self):
-        return self.LoadConfig()
+        return self.ReloadConfigImpl()
         
     @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="b")
     def ForceSaveConfig(self):
         return self.SaveConfig(True)
     
-    @dbus.service.method(dbus_interface=SERVICE_NATIVE_INTERFACE, in_signature="", out_signature="b")
-    def RestoreLastMode(self):
-        return self.RestoreModeImpl()
-    
+    def _noteActivity(self):
+        # Every method call counts as activity for the idle exit timer
+        self.lastActivity = time.monotonic()
+        if not self.isFirstCallAnswered:
+            self.isFirstCallAnswered = True
+            GLib.idle_add(self._printFirstCall)
+            
+    @staticmethod
+    def _printFirstCall():
+        msikblog.Info("First method call answered %.1f ms after process start", _processAge() * 1000)
+        return False
+        
+    def _armIdleTimer(self):
+        if self.idleTimeout > 0 and self.idleTimerId is None:
+            remaining = self.idleTimeout - (time.monotonic() - self.lastActivity)
+            self.idleTimerId = GLib.timeout_add_seconds(max(1, int(remaining + 0.999)), self._onIdleTimer)
+            
+    def _canExitWhenIdle(self):
+        # Lid and sleep events, rules, animations and reconnecting need the
+        # process, as do connected control socket clients
+        return not (self.isHandleLid or self.isHandleSleep or self.ruleScheduler.HasRules() or any(device.IsBusy() for device in self.devices) or 
+                    (self.controlServer is not None and self.controlServer.HasClients()))
+        
+    def _onIdleTimer(self):
+        self.idleTimerId = None
+        if self.idleTimeout <= 0:
+            return False
+        if time.monotonic() - self.lastActivity < self.idleTimeout:
+            self._armIdleTimer()
+        elif not self._canExitWhenIdle():
+            self.lastActivity = time.monotonic()
+            self._armIdleTimer()
+        else:
+            self.OnIdleExit()
+        return False
+        
+    def SaveState(self):
+        # Persist what the keyboards show, for the next activation in this boot
+        if self.statefile is None:
+            return False
+        state = {'boot_id': _bootId(), 'mode_index': self.curModeIndex, 'devices': [device.GetState() for device in self.devices]}
+        import json
+        temp_name = self.statefile + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.statefile) or '.', exist_ok=True)
+            with open(temp_name, 'w') as state_file:
+                json.dump(state, state_file)
+            os.replace(temp_name, self.statefile)
+            return True
+        except OSError as e:
+            msikblog.Warn("Can't save state to '%s': %s", self.statefile, e)
+            return False
+            
+    def LoadState(self):
+        # Returns True if the state of a previous instance in this boot was
+        # restored, the keyboards still show it then
+        if self.statefile is None:
+            return False
+        try:
+            with open(self.statefile) as state_file:
+                import json
+                state = json.load(state_file)
+            os.unlink(self.statefile)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            msikblog.Warn("Can't load state from '%s': %s", self.statefile, e)
+            return False
+        try:
+            if state['boot_id'] is None or state['boot_id'] != _bootId():
+                return False
+            if len(state['devices']) != len(self.devices):
+                msikblog.Info("Number of keyboards has changed, not using saved state")
+                return False
+            for device, device_state in zip(self.devices, state['devices']):
+                device.SetState(device_state)
+            self.curModeIndex = state['mode_index']
+            return True
+        except (KeyError, TypeError, RuntimeError) as e:
+            msikblog.Warn("Invalid state file '%s': %s", self.statefile, e)
+            for device in self.devices:
+                device.curModeIndex = None
+                device.sceneMode = None
+                device.sceneProgram = None
+            return False
+        
     def OnLoad(self):
         self.LoadConfig()
-        self.SetModeImpl(self.defModeIndex)
+        self._watchConfig()
+        if self.LoadState():
+            msikblog.Info("Continuing with state of the previous instance, mode %s", self.curModeIndex)
+        else:
+            self.SetModeImpl(self.defModeIndex)
+        self._startRules()
+        self._armIdleTimer()
+        
+    def OnIdleExit(self):
+        msikblog.Info("Idle for %d seconds, exiting", self.idleTimeout)
+        if self.configMonitor is not None:
+            self.configMonitor.cancel()
+        self._stopControlServer()
+        for device in self.devices:
+            device.Stop()
+        self.SaveState()
+        self.SaveConfig()
+        self.WriteStats()
+        self._closeTrace()
+        if self.onIdleExit is not None:
+            self.onIdleExit()
     
     def OnExit(self):
+        if self.configMonitor is not None:
+            self.configMonitor.cancel()
+        self.ruleScheduler.Stop()
+        self._stopControlServer()
         self.SaveConfig()
-        self.kb.SetOffMode()
+        self.SetOffModeImpl()
+        for device in self.devices:
+            device.Stop()
+        self.WriteStats()
+        self._closeTrace()
+
+def PrecompileConfig(config_file_name, cache_file_name):
+    # Validate the config file and write its snapshot ahead of time, without
+    # touching the bus or the keyboard
+    print("Precompiling config file " + config_file_name + " to " + cache_file_name)
+    try:
+        config_dict, file_key = msikbconfig.ReadConfigFile(config_file_name)
+        modes = ModeLibrary(config_dict['modes'])
+        # Build every mode, so the snapshot holds them ready to use
+        modes.BuildAll()
+    except (FileNotFoundError, PermissionError):
+        print("Can't open configuration file '" + config_file_name + "'")
+        return False
+    except KeyError as e:
+        print("Invalid configuration file format: can't find key '" + str(e) + "'")
+        return False
+    except TypeError:
+        print("Invalid configuration file format: invalid block type")
+        return False
+    except RuntimeError as e:
+        print("Invalid configuration file: " + str(e))
+        return False
+    except msikbconfig.ConfigFormatError as e:
+        print("Incorrect configuration file: " + str(e))
+        return False
+    snapshot = msikbconfig.ConfigSnapshot(cache_file_name, MSIKeyboardService._codeKey())
+    if not snapshot.Store(file_key, (config_dict, modes)):
+        return False
+    print("Configuration is valid, " + str(len(modes)) + " modes precompiled")
+    return True
+
+def _simulatorOptions(spec):
+    import argparse
+    try:
+        return msikbsim.ParseOptions(spec)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
 
 def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Keyboard backlight controlling service for MSI notebooks")
+    parser.add_argument('--config', default=CONFIG_PATH + CONFIG_NAME, help="configuration file")
+    parser.add_argument('--cache', default=CACHE_PATH + CACHE_NAME, help="compiled configuration snapshot file")
+    parser.add_argument('--precompile', action='store_true', help="validate the configuration, write its snapshot and exit")
+    parser.add_argument('--all-devices', action='store_true', help="control every matching keyboard controller instead of the first one")
+    parser.add_argument('--simulate', nargs='?', const='', type=_simulatorOptions, metavar='OPTIONS', 
+                        help="control simulated keyboards instead of the real ones, OPTIONS is a comma separated list of " + ", ".join(name + '=N' for name in msikbsim.OPTIONS))
+    args = parser.parse_args()
+    if args.precompile:
+        sys.exit(0 if PrecompileConfig(args.config, args.cache) else 1)
+    
     from dbus.mainloop.glib import DBusGMainLoop
-    from gi.repository import GLib
+    _importMainLoop()
+    msikblog.Info("Module imports took %.1f ms, main loop imports done %.1f ms after process start", IMPORT_TIME * 1000, _processAge() * 1000)
 
     DBusGMainLoop(set_as_default=True)
     GLib.threads_init()
@@ -482,25 +2153,25 @@ def main():
     def InitSignal(actor):
         def signal_action(signal):
             if signal == 1:
-                print(("Got signal SIGHUP(1)"))
-                actor.LoadConfig()
+                msikblog.Info("Got signal SIGHUP(1)")
+                actor.ReloadConfigImpl()
                 return
             elif signal == 2:
-                print(("Got signal SIGINT(2)"))
+                msikblog.Info("Got signal SIGINT(2)")
             elif signal == 15:
-                print(("Got signal SIGTERM(15)"))
+                msikblog.Info("Got signal SIGTERM(15)")
             else:
-                print(("Got unregistered signal " + str(signal)))
+                msikblog.Warn("Got unregistered signal %s", signal)
                 return
             actor.OnExit()
             loop.quit()
 
         def idle_handler(*args):
-            print("Python signal handler activated")
+            msikblog.Debug("Python signal handler activated")
             GLib.idle_add(signal_action, priority=GLib.PRIORITY_HIGH)
 
         def handler(*args):
-            print("GLib signal handler activated")
+            msikblog.Debug("GLib signal handler activated")
             signal_action(args[0])
 
         def install_glib_handler(sig):
@@ -512,20 +2183,31 @@ def main():
                 unix_signal_add = GLib.unix_signal_add_full
 
             if unix_signal_add:
-                print(("Register GLib signal handler: %r" % sig))
+                msikblog.Debug("Register GLib signal handler: %r", sig)
                 unix_signal_add(GLib.PRIORITY_HIGH, sig, handler, sig)
             else:
-                print("Can't install GLib signal handler, too old gi.")
+                msikblog.Warn("Can't install GLib signal handler, too old gi.")
 
         SIGS = [getattr(signal, s, None) for s in "SIGINT SIGTERM SIGHUP".split()]
         for sig in [_f for _f in SIGS if _f]:
-            print(("Register Python signal handler: %r" % sig))
+            msikblog.Debug("Register Python signal handler: %r", sig)
             signal.signal(sig, idle_handler)
             GLib.idle_add(install_glib_handler, sig, priority=GLib.PRIORITY_HIGH)
 
-    keyboard = msikbapi.MSIKeyboard()
-    service = MSIKeyboardService(keyboard, CONFIG_PATH + CONFIG_NAME)
+    keyboards = []
+    if args.simulate is not None:
+        keyboards = msikbsim.CreateKeyboards(**args.simulate)
+        msikblog.Info("Simulating %d keyboard(s)", len(keyboards))
+    elif args.all_devices:
+        keyboards = msikbapi.EnumerateKeyboards()
+        msikblog.Info("Found %d keyboard(s)", len(keyboards))
+    if not keyboards:
+        # Opened on the first write, or once it appears
+        keyboards = [msikbapi.MSIKeyboard()]
+    service = MSIKeyboardService(keyboards, args.config, args.cache, STATE_PATH + STATE_NAME)
+    service.onIdleExit = loop.quit
     service.OnLoad()
     InitSignal(service)
     loop.run()
-    print("Application exited.")
+    msikblog.Info("Application exited.")
+    msikblog.log.Flush()
@@ -0,0 +1,152 @@
+import atexit
+import itertools
+import os
+import sys
+import threading
+import time
+from collections import deque, namedtuple
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'debug', INFO: 'info', WARNING: 'warning', ERROR: 'error'}
+LEVELS = {name: level for level, name in LEVEL_NAMES.items()}
+
+# syslog priorities, understood by the journal as '<N>' line prefixes
+_PRIORITIES = {DEBUG: 7, INFO: 6, WARNING: 4, ERROR: 3}
+
+# message is a %-format string, formatted only when the record is written or
+# read back
+LogRecord = namedtuple('LogRecord', ['sequence', 'time', 'level', 'message', 'args'])
+
+
+def FormatRecord(record):
+    if not record.args:
+        return record.message
+    try:
+        return record.message % record.args
+    except (TypeError, ValueError):
+        return record.message + ' ' + repr(record.args)
+
+
+class Logger:
+    # Records go into a fixed-size ring buffer and are written to stderr by a
+    # background thread, so logging never blocks the main loop or a writer
+    # thread on a syscall. Records below bufferLevel cost a single compare,
+    # see SetLevel.
+    CAPACITY = 1024
+
+    def __init__(self, capacity=CAPACITY):
+        # Records at or above level are written out, records at or above
+        # bufferLevel are kept for GetRecent
+        self.level = INFO
+        self.bufferLevel = DEBUG
+        self.records = deque(maxlen=capacity)
+        self.outbox = deque()
+        self.capacity = capacity
+        self.dropped = 0
+        self.sequence = itertools.count()
+        self.cond = threading.Condition()
+        self.writeLock = threading.Lock()
+        self.thread = None
+        # Under systemd stderr is a journal stream, which takes the priority
+        # from a '<N>' prefix
+        self.isJournal = 'JOURNAL_STREAM' in os.environ
+        self.stream = sys.stderr
+
+    def SetLevel(self, level, buffer_level=DEBUG):
+        # Records below the lower of level and buffer_level are neither
+        # written nor kept; raise buffer_level to make them free
+        self.level = level
+        self.bufferLevel = min(level, buffer_level)
+
+    def Log(self, level, message, *args):
+        if level < self.bufferLevel:
+            return
+        with self.cond:
+            record = LogRecord(next(self.sequence), time.time(), level, message, args)
+            self.records.append(record)
+            if level < self.level:
+                return
+            if len(self.outbox) >= self.capacity:
+                self.outbox.popleft()
+                self.dropped += 1
+            self.outbox.append(record)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='msikeyboard-log', daemon=True)
+                self.thread.start()
+            elif len(self.outbox) == 1:
+                self.cond.notify()
+
+    def Debug(self, message, *args):
+        if DEBUG >= self.bufferLevel:
+            self.Log(DEBUG, message, *args)
+
+    def Info(self, message, *args):
+        if INFO >= self.bufferLevel:
+            self.Log(INFO, message, *args)
+
+    def Warn(self, message, *args):
+        self.Log(WARNING, message, *args)
+
+    def Error(self, message, *args):
+        self.Log(ERROR, message, *args)
+
+    def GetRecent(self, count):
+        # Newest count records as (time, level name, message), oldest first
+        with self.cond:
+            records = list(self.records)[-count:] if count > 0 else []
+        return [(record.time, LEVEL_NAMES[record.level], FormatRecord(record)) for record in records]
+
+    def Flush(self):
+        # Write everything pending from the calling thread, e.g. before exit.
+        # Batches are taken and written under writeLock to keep their order.
+        with self.writeLock:
+            with self.cond:
+                records = list(self.outbox)
+                self.outbox.clear()
+                dropped = self.dropped
+                self.dropped = 0
+            self._write(records, dropped)
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.outbox:
+                    self.cond.wait()
+            self.Flush()
+
+    def _formatLine(self, level, text):
+        if self.isJournal:
+            return '<%d>%s\n' % (_PRIORITIES[level], text)
+        if level >= WARNING:
+            return LEVEL_NAMES[level].capitalize() + ': ' + text + '\n'
+        return text + '\n'
+
+    def _write(self, records, dropped):
+        if not records and not dropped:
+            return
+        lines = []
+        if dropped:
+            lines.append(self._formatLine(WARNING, str(dropped) + " log records dropped"))
+        for record in records:
+            lines.append(self._formatLine(record.level, FormatRecord(record)))
+        # One write for the whole batch
+        try:
+            self.stream.write(''.join(lines))
+            self.stream.flush()
+        except (OSError, ValueError):
+            pass
+
+
+# The process-wide logger
+log = Logger()
+atexit.register(log.Flush)
+
+Debug = log.Debug
+Info = log.Info
+# Not 'Warning', which would shadow the builtin exception
+Warn = log.Warn
+Error = log.Error
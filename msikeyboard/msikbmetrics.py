@@ -0,0 +1,186 @@
+import os
+from array import array
+
+
+class ProcFile:
+    # Kept open and re-read with a single pread into a preallocated buffer
+    BUFFER_SIZE = 16384
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+        self.buffer = bytearray(self.BUFFER_SIZE)
+        self.length = 0
+
+    def __getstate__(self):
+        # A descriptor means nothing in another process: pickled files (e.g.
+        # in the config snapshot) are reopened by Open
+        state = self.__dict__.copy()
+        state['fd'] = None
+        state['buffer'] = None
+        state['length'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.buffer = bytearray(self.BUFFER_SIZE)
+
+    def Open(self):
+        if self.fd is None:
+            self.fd = os.open(self.path, os.O_RDONLY)
+
+    def Close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+    def Read(self):
+        self.length = os.preadv(self.fd, [self.buffer], 0)
+        return self.buffer
+
+    def FieldsAfter(self, key, fields):
+        # Fills the preallocated array 'fields' with the integer fields
+        # following 'key' in the last read. The digits are accumulated in
+        # place, so no list, slice or bytes object is created per sample
+        buf = self.buffer
+        pos = buf.find(key, 0, self.length)
+        if pos < 0:
+            raise ValueError("Key " + key.decode() + " not found in " + self.path)
+        pos += len(key)
+        end = buf.find(b'\n', pos, self.length)
+        if end < 0:
+            end = self.length
+        count = len(fields)
+        index = -1
+        inField = False
+        while pos < end:
+            c = buf[pos]
+            if 0x30 <= c <= 0x39:
+                if not inField:
+                    index += 1
+                    if index == count:
+                        break
+                    fields[index] = 0
+                    inField = True
+                fields[index] = fields[index] * 10 + c - 0x30
+            else:
+                inField = False
+            pos += 1
+        if index < count - 1:
+            raise ValueError("Fewer than " + str(count) + " fields after " + key.decode().strip() + " in " + self.path)
+        return fields
+
+
+class CpuSampler:
+    # Utilization in percent since the previous sample, of all cores ('cpu')
+    # or of one core ('cpu0', 'cpu1', ...)
+    PATH = '/proc/stat'
+    RANGE = (0.0, 100.0)
+
+    def __init__(self, name='cpu'):
+        self.file = ProcFile(self.PATH)
+        self.key = b'\n' + name.encode() + b' ' if name != 'cpu' else b'cpu '
+        self.fields = array('q', bytes(8 * 8))
+        self.lastTotal = 0
+        self.lastIdle = 0
+
+    def Open(self):
+        self.file.Open()
+        self.Sample()
+
+    def Close(self):
+        self.file.Close()
+
+    def Sample(self):
+        self.file.Read()
+        user, nice, system, idle, iowait, irq, softirq, steal = self.file.FieldsAfter(self.key, self.fields)
+        idle += iowait
+        total = user + nice + system + idle + irq + softirq + steal
+        deltaTotal = total - self.lastTotal
+        deltaIdle = idle - self.lastIdle
+        self.lastTotal = total
+        self.lastIdle = idle
+        if deltaTotal <= 0:
+            return 0.0
+        return 100.0 * (deltaTotal - deltaIdle) / deltaTotal
+
+
+class ThermalSampler:
+    # Temperature in degrees Celsius of /sys/class/thermal/thermal_zone<N>
+    PATH = '/sys/class/thermal/thermal_zone%d/temp'
+    RANGE = (40.0, 90.0)
+
+    def __init__(self, zone=0):
+        self.file = ProcFile(self.PATH % zone)
+
+    def Open(self):
+        self.file.Open()
+
+    def Close(self):
+        self.file.Close()
+
+    def Sample(self):
+        self.file.Read()
+        return int(self.file.buffer[:self.file.length]) / 1000.0
+
+
+class PressureSampler:
+    # Pressure stall information, percentage of the last 10 seconds some
+    # tasks were stalled on the resource ('memory', 'cpu' or 'io')
+    PATH = '/proc/pressure/%s'
+    RANGE = (0.0, 20.0)
+    KEY = b'some avg10='
+
+    def __init__(self, resource='memory'):
+        self.file = ProcFile(self.PATH % resource)
+
+    def Open(self):
+        self.file.Open()
+
+    def Close(self):
+        self.file.Close()
+
+    def Sample(self):
+        buf = self.file.Read()
+        pos = buf.find(self.KEY, 0, self.file.length)
+        if pos < 0:
+            raise ValueError("Unexpected format of " + self.file.path)
+        pos += len(self.KEY)
+        return float(buf[pos:buf.find(b' ', pos, self.file.length)])
+
+
+def CreateSampler(metric):
+    # 'cpu', 'cpu<N>', 'temperature', 'temperature<N>', 'memory', 'io'
+    if metric.startswith('cpu'):
+        if metric != 'cpu' and not metric[3:].isdigit():
+            raise ValueError("unknown metric '" + metric + "'")
+        return CpuSampler(metric)
+    if metric.startswith('temperature'):
+        zone = metric[len('temperature'):]
+        if zone and not zone.isdigit():
+            raise ValueError("unknown metric '" + metric + "'")
+        return ThermalSampler(int(zone) if zone else 0)
+    if metric in ('memory', 'io'):
+        return PressureSampler(metric)
+    raise ValueError("unknown metric '" + metric + "'")
+
+
+class MetricLevel:
+    # Maps a sampler to 0.0-1.0, moving only when the value has changed by
+    # more than the hysteresis so that noise doesn't cause device writes
+    HYSTERESIS = 0.04
+
+    def __init__(self, sampler, minimum=None, maximum=None):
+        self.sampler = sampler
+        self.minimum = sampler.RANGE[0] if minimum is None else minimum
+        self.maximum = sampler.RANGE[1] if maximum is None else maximum
+        if self.maximum <= self.minimum:
+            raise ValueError("metric maximum must be greater than minimum")
+        self.level = 0.0
+
+    def Update(self):
+        value = self.sampler.Sample()
+        level = min(1.0, max(0.0, (value - self.minimum) / (self.maximum - self.minimum)))
+        if abs(level - self.level) >= self.HYSTERESIS or (level != self.level and level in (0.0, 1.0)):
+            self.level = level
+        return self.level
@@ -0,0 +1,133 @@
+# Power policy: how much the daemon may spend on the backlight on AC power,
+# on battery and on low battery. Every level caps the animation frame rate
+# and the timer wakeups of all animations together, dims the colors and may
+# show animations that have a firmware equivalent with the firmware mode,
+# which costs no wakeups at all. The wall time, CPU time and main thread
+# wakeups spent at each level are counted, so the effect of the limits can
+# be measured.
+
+import time
+from collections import namedtuple
+from msikeyboard import msikbstats
+
+LEVEL_AC = 'ac'
+LEVEL_BATTERY = 'battery'
+LEVEL_LOW_BATTERY = 'low_battery'
+
+# frameRate: highest frame rate of any animation, maxWakeups: animation
+# timer wakeups per second shared by all animations, None - no limit.
+# brightness: percent of the requested colors. firmwareEffects: show
+# animations with a firmware equivalent as that firmware mode.
+PowerLimits = namedtuple('PowerLimits', ['frameRate', 'maxWakeups', 'brightness', 'firmwareEffects'])
+
+UNLIMITED = PowerLimits(None, None, 100, False)
+DEFAULT_LIMITS = {
+    LEVEL_BATTERY: PowerLimits(10.0, 20.0, 60, True),
+    LEVEL_LOW_BATTERY: PowerLimits(4.0, 8.0, 30, True),
+}
+# Battery percentage at or below which the low battery level applies
+DEFAULT_LOW_BATTERY = 20.0
+
+# Main thread scheduler statistics: time on CPU, time waiting to run and the
+# number of times it was scheduled in, i.e. woken up
+SCHEDSTAT_PATH = '/proc/self/schedstat'
+
+
+def _readLimits(description, default, key):
+    if description is None:
+        return default
+    if not isinstance(description, dict):
+        raise ValueError("'" + key + "' must be a mapping")
+    try:
+        frameRate = description.get('frame_rate', default.frameRate)
+        frameRate = float(frameRate) if frameRate is not None else None
+        maxWakeups = description.get('max_wakeups', default.maxWakeups)
+        maxWakeups = float(maxWakeups) if maxWakeups is not None else None
+        brightness = int(description.get('brightness', default.brightness))
+    except (TypeError, ValueError):
+        raise ValueError("'" + key + "' has an invalid frame_rate, max_wakeups or brightness")
+    if (frameRate is not None and frameRate <= 0) or (maxWakeups is not None and maxWakeups <= 0):
+        raise ValueError("'" + key + "': frame_rate and max_wakeups must be positive")
+    if not 0 <= brightness <= 100:
+        raise ValueError("'" + key + "': brightness must be 0 to 100")
+    return PowerLimits(frameRate, maxWakeups, brightness, bool(description.get('firmware_effects', default.firmwareEffects)))
+
+
+def _limitsToDict(limits):
+    return {'frame_rate': limits.frameRate, 'max_wakeups': limits.maxWakeups, 'brightness': limits.brightness, 'firmware_effects': limits.firmwareEffects}
+
+
+class PowerPolicy:
+    def __init__(self, limits=None, low_battery=DEFAULT_LOW_BATTERY):
+        # limits: level -> PowerLimits for the battery levels, AC is never
+        # limited
+        self.limits = dict(DEFAULT_LIMITS if limits is None else limits)
+        self.lowBattery = low_battery
+
+    @classmethod
+    def FromDict(cls, description):
+        # Raises ValueError if the description is invalid
+        if not isinstance(description, dict):
+            raise ValueError("'power_policy' must be a mapping")
+        limits = {level: _readLimits(description.get(level), DEFAULT_LIMITS[level], level) for level in DEFAULT_LIMITS}
+        try:
+            low_battery = float(description.get('low_battery_level', DEFAULT_LOW_BATTERY))
+        except (TypeError, ValueError):
+            raise ValueError("'low_battery_level' must be a percentage")
+        return cls(limits, low_battery)
+
+    def to_dict(self):
+        description = {level: _limitsToDict(limits) for level, limits in self.limits.items()}
+        description['low_battery_level'] = self.lowBattery
+        return description
+
+    def Level(self, is_on_battery, percentage):
+        # AC power while the power source is unknown (None), battery while
+        # the percentage is
+        if not is_on_battery:
+            return LEVEL_AC
+        if percentage is not None and percentage <= self.lowBattery:
+            return LEVEL_LOW_BATTERY
+        return LEVEL_BATTERY
+
+    def Limits(self, level):
+        return self.limits.get(level, UNLIMITED)
+
+
+def _readWakeups():
+    try:
+        with open(SCHEDSTAT_PATH) as schedstat_file:
+            return int(schedstat_file.read().split()[2])
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+class LevelAccounting:
+    # Adds the wall time and CPU time (all threads) in ms and the main thread
+    # wakeups since the last update to the stats counters of the current
+    # level: power_level_ms, power_level_cpu_ms and power_level_wakeups
+    def __init__(self, level=LEVEL_AC):
+        self.level = level
+        self.labels = 'level="' + level + '"'
+        self.wallTime = time.monotonic()
+        self.cpuTime = time.process_time()
+        self.wakeups = _readWakeups()
+
+    def Switch(self, level):
+        self.Update()
+        self.level = level
+        self.labels = 'level="' + level + '"'
+
+    def Update(self):
+        wallTime = time.monotonic()
+        cpuTime = time.process_time()
+        wakeups = _readWakeups()
+        # Whole milliseconds are counted, the remainder is carried over
+        wallMs = int((wallTime - self.wallTime) * 1000)
+        cpuMs = int((cpuTime - self.cpuTime) * 1000)
+        msikbstats.stats.Count('power_level_ms', self.labels, wallMs)
+        msikbstats.stats.Count('power_level_cpu_ms', self.labels, cpuMs)
+        msikbstats.stats.Count('power_level_wakeups', self.labels, max(0, wakeups - self.wakeups))
+        self.wallTime += wallMs / 1000
+        self.cpuTime += cpuMs / 1000
+        self.wakeups = wakeups
@@ -0,0 +1,276 @@
+# Automation rules: the first rule whose conditions all hold selects the
+# mode, which is set when that changes. Time conditions can only change at
+# the edges of their windows (and at midnight for weekday rules), so every
+# timed rule has its next edge in a min-heap and one GLib timer is armed for
+# the nearest, but at most MAX_TIMER_DELAY ahead.
+#
+# GLib timers run on the monotonic clock, which stops during suspend and
+# doesn't follow changes of the system clock. The offset between the wall
+# and monotonic clocks and the local UTC offset are checked whenever the
+# timer fires, and the owner calls Reschedule after a resume, so deadlines
+# are recomputed from the wall clock within MAX_TIMER_DELAY of a clock or
+# timezone change.
+
+import heapq
+import math
+import time
+from datetime import datetime, timedelta
+from datetime import time as dtime
+from msikeyboard import msikblog
+from msikeyboard import msikbstats
+
+# Imported when the first timer is armed
+GLib = None
+
+
+def _importGLib():
+    global GLib
+    if GLib is None:
+        from gi.repository import GLib
+
+
+WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+POWER_SOURCES = ('ac', 'battery')
+MINUTES_PER_DAY = 24 * 60
+# Drift of the wall clock against the monotonic clock taken as a clock change
+CLOCK_JUMP_TOLERANCE = 2.0
+# Longest sleep of the rule timer in seconds, how late a clock or timezone
+# change may be noticed
+MAX_TIMER_DELAY = 60
+
+
+def _parseTime(value, key):
+    # 'HH:MM' -> minutes after midnight. YAML reads an unquoted 22:00 as the
+    # base 60 integer 1320, which is the same number of minutes.
+    if isinstance(value, int) and not isinstance(value, bool):
+        minutes = value
+    elif isinstance(value, str):
+        hours, sep, mins = value.partition(':')
+        try:
+            minutes = int(hours) * 60 + int(mins) if sep and 0 <= int(mins) < 60 else -1
+        except ValueError:
+            minutes = -1
+    else:
+        minutes = -1
+    if not 0 <= minutes < MINUTES_PER_DAY:
+        raise ValueError("'" + key + "' must be a time of day as 'HH:MM', got '" + str(value) + "'")
+    return minutes
+
+
+class Rule:
+    def __init__(self, mode, start=None, end=None, days=None, power=None, idle=None):
+        # mode: mode index or name. start, end: minutes after local midnight
+        # (both or neither), the window ends at midnight or later if end is
+        # not after start. days: weekday numbers (0 - Monday) on which the
+        # window starts, None - every day. power: 'ac', 'battery' or None.
+        # idle: True, False or None.
+        self.mode = mode
+        self.start = start
+        self.end = end
+        self.days = days
+        self.power = power
+        self.idle = idle
+
+    @classmethod
+    def FromDict(cls, description):
+        # Raises ValueError if the description is invalid
+        if not isinstance(description, dict):
+            raise ValueError("a rule must be a mapping")
+        mode = description.get('mode')
+        if isinstance(mode, bool) or not isinstance(mode, (int, str)) or (isinstance(mode, int) and mode < 0):
+            raise ValueError("'mode' must be a mode index or name")
+        start = end = None
+        if 'from' in description or 'to' in description:
+            start = _parseTime(description.get('from', 0), 'from')
+            end = _parseTime(description.get('to', 0), 'to')
+        days = None
+        if 'days' in description:
+            if not isinstance(description['days'], list) or not all(day in WEEKDAYS for day in description['days']):
+                raise ValueError("'days' must be a list of " + ", ".join(WEEKDAYS))
+            days = frozenset(WEEKDAYS.index(day) for day in description['days'])
+        power = description.get('power')
+        if power is not None and power not in POWER_SOURCES:
+            raise ValueError("'power' must be one of " + ", ".join(POWER_SOURCES))
+        idle = description.get('idle')
+        if idle is not None and not isinstance(idle, bool):
+            raise ValueError("'idle' must be true or false")
+        return cls(mode, start, end, days, power, idle)
+
+    def _key(self):
+        return (self.mode, self.start, self.end, self.days, self.power, self.idle)
+
+    def __eq__(self, other):
+        return isinstance(other, Rule) and self._key() == other._key()
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def IsTimed(self):
+        # A window from a time to the same time is the whole day
+        return (self.start is not None and self.start != self.end) or self.days is not None
+
+    def Matches(self, now, is_on_battery, is_idle):
+        # now: local time as a naive datetime. A power condition doesn't
+        # hold while the power source is unknown (None).
+        if self.power is not None and (is_on_battery is None or is_on_battery != (self.power == 'battery')):
+            return False
+        if self.idle is not None and is_idle != self.idle:
+            return False
+        return self._matchesTime(now)
+
+    def _matchesTime(self, now):
+        weekday = now.weekday()
+        if self.start is None or self.start == self.end:
+            return self.days is None or weekday in self.days
+        minute = now.hour * 60 + now.minute
+        if self.start < self.end:
+            return self.start <= minute < self.end and (self.days is None or weekday in self.days)
+        # Past midnight the window still belongs to the day it started on
+        if minute >= self.start:
+            return self.days is None or weekday in self.days
+        if minute < self.end:
+            return self.days is None or (weekday - 1) % 7 in self.days
+        return False
+
+    def NextEdge(self, now):
+        # Timestamp of the first edge after now at which the time condition
+        # may change. Edges are local times, so they move with DST.
+        edges = []
+        if self.start is not None and self.start != self.end:
+            edges += [self.start, self.end]
+        if self.days is not None:
+            edges.append(0)
+        nearest = None
+        for minute in edges:
+            candidate = datetime.combine(now.date(), dtime(minute // 60, minute % 60))
+            if candidate <= now:
+                candidate += timedelta(days=1)
+            if nearest is None or candidate < nearest:
+                nearest = candidate
+        return nearest.timestamp()
+
+
+def ParseRules(descriptions):
+    # Raises ValueError naming the first invalid rule
+    if not isinstance(descriptions, list):
+        raise ValueError("'rules' must be a list")
+    rules = []
+    for index, description in enumerate(descriptions):
+        try:
+            rules.append(Rule.FromDict(description))
+        except ValueError as e:
+            raise ValueError("rule " + str(index) + ": " + str(e))
+    return rules
+
+
+def UsesPower(rules):
+    # True if a rule depends on the power source, which is then watched
+    return any(rule.power is not None for rule in rules)
+
+
+def UsesIdle(rules):
+    # True if a rule depends on the session idle hint
+    return any(rule.idle is not None for rule in rules)
+
+
+class RuleScheduler:
+    # Tracks which rule matches and calls on_change(index, rule) when the
+    # first matching rule changes to another one. Between changes the mode
+    # is left alone, so a mode selected by hand stays until the next change.
+    def __init__(self, on_change):
+        self.onChange = on_change
+        self.rules = []
+        # (deadline timestamp, rule index) of timed rules
+        self.heap = []
+        self.timerId = None
+        # Wall minus monotonic clock and local UTC offset when the timer was
+        # armed
+        self.clockOffset = 0.0
+        self.utcOffset = 0
+        self.isOnBattery = None
+        self.isIdle = False
+        # Index of the matching rule, None if none matches
+        self.active = None
+
+    def SetRules(self, rules):
+        # The matching rule is kept if the rules haven't changed, so
+        # reloading the configuration doesn't override a manual mode
+        if rules != self.rules:
+            self.rules = rules
+            self.active = None
+        self.Reschedule()
+
+    def HasRules(self):
+        return bool(self.rules)
+
+    def SetOnBattery(self, is_on_battery):
+        if is_on_battery != self.isOnBattery:
+            self.isOnBattery = is_on_battery
+            self._evaluate(datetime.now())
+
+    def SetIdle(self, is_idle):
+        if is_idle != self.isIdle:
+            self.isIdle = is_idle
+            self._evaluate(datetime.now())
+
+    def Reschedule(self):
+        # Recompute every deadline from the wall clock, after a resume, a
+        # clock change or a reload
+        now = datetime.now()
+        self.heap = [(rule.NextEdge(now), index) for index, rule in enumerate(self.rules) if rule.IsTimed()]
+        heapq.heapify(self.heap)
+        self._evaluate(now)
+        self._arm()
+
+    def Stop(self):
+        if self.timerId is not None:
+            GLib.source_remove(self.timerId)
+            self.timerId = None
+
+    def _arm(self):
+        self.Stop()
+        if not self.heap:
+            return
+        _importGLib()
+        wallTime = time.time()
+        self.clockOffset = wallTime - time.monotonic()
+        self.utcOffset = time.localtime(wallTime).tm_gmtoff
+        # Whole seconds, so GLib can wake up for this together with other
+        # timers
+        delay = max(1, min(MAX_TIMER_DELAY, math.ceil(self.heap[0][0] - wallTime)))
+        self.timerId = GLib.timeout_add_seconds(delay, self._onTimer)
+
+    def _onTimer(self):
+        self.timerId = None
+        msikbstats.stats.Count('rule_timer_wakeups')
+        wallTime = time.time()
+        if abs(wallTime - time.monotonic() - self.clockOffset) > CLOCK_JUMP_TOLERANCE:
+            msikblog.Info("System clock changed, rescheduling rules")
+            self.Reschedule()
+            return False
+        # The C library only rereads the timezone when asked to
+        time.tzset()
+        if time.localtime(wallTime).tm_gmtoff != self.utcOffset:
+            msikblog.Info("Timezone changed, rescheduling rules")
+            self.Reschedule()
+            return False
+        now = datetime.now()
+        while self.heap and self.heap[0][0] <= wallTime:
+            _, index = self.heap[0]
+            heapq.heapreplace(self.heap, (self.rules[index].NextEdge(now), index))
+        self._evaluate(now)
+        self._arm()
+        return False
+
+    def _evaluate(self, now):
+        active = None
+        for index, rule in enumerate(self.rules):
+            if rule.Matches(now, self.isOnBattery, self.isIdle):
+                active = index
+                break
+        if active == self.active:
+            return
+        self.active = active
+        if active is not None:
+            msikbstats.stats.Count('rule_changes')
+            self.onChange(active, self.rules[active])
@@ -0,0 +1,201 @@
+import errno
+import threading
+import time
+from msikeyboard import msikbapi
+from msikeyboard import msikblog
+
+REPORT_ID = msikbapi.MSIKeyboard.REPORT_ID
+REPORT_LENGTH = 7
+
+
+class SimulatedController:
+    # Emulated keyboard controller: decodes feature reports the way the
+    # firmware does and keeps its registers. A mode report latches the
+    # attribute registers written so far and, if the mode changes, resets the
+    # zone colors.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mode = None
+        self.zoneColors = {}
+        # Attribute registers as written and as latched by the last mode
+        # report
+        self.attributes = {}
+        self.latchedAttributes = {}
+        self.reportsReceived = 0
+        self.invalidReports = 0
+        self.modeChanges = 0
+
+    def Receive(self, data, report_id):
+        with self.lock:
+            self.reportsReceived += 1
+            data = bytes(data)
+            # hidapi takes the report ID as a byte string or an int
+            if isinstance(report_id, int):
+                report_id = bytes((report_id,))
+            if report_id != REPORT_ID or len(data) != REPORT_LENGTH or data[0:1] != msikbapi.MSIKeyboard.PREAMBLE or data[-1:] != msikbapi.MSIKeyboard.LAST_BYTE:
+                self.invalidReports += 1
+                msikblog.Warn("Simulated controller got an invalid report %s", data.hex())
+                return
+            command = data[1:2]
+            if command == msikbapi.MSIKeyboard.CMD_SET_MODE:
+                if data[2] != self.mode:
+                    self.zoneColors.clear()
+                    self.modeChanges += 1
+                self.mode = data[2]
+                self.latchedAttributes = dict(self.attributes)
+            elif command == msikbapi.MSIKeyboard.CMD_SET_ZONE_COLOR:
+                self.zoneColors[data[2]] = tuple(data[3:6])
+            elif command == msikbapi.MSIKeyboard.CMD_SET_MODE_ATTRIBUTE:
+                self.attributes[data[2]] = tuple(data[3:6])
+            else:
+                self.invalidReports += 1
+                msikblog.Warn("Simulated controller got an unknown command %s", data.hex())
+
+    def GetState(self):
+        # What the keyboard shows: (mode byte, zone -> (r, g, b),
+        # attribute -> (a1, a2, a3) as latched by the mode)
+        with self.lock:
+            return (self.mode, dict(self.zoneColors), dict(self.latchedAttributes))
+
+    def GetStats(self):
+        with self.lock:
+            return (self.reportsReceived, self.invalidReports, self.modeChanges)
+
+
+class SimulatedDevice:
+    # Open handle of a SimulatedTransport, dead once the device is unplugged
+    def __init__(self, transport, generation):
+        self.transport = transport
+        self.generation = generation
+
+    def send_feature_report(self, data, report_id=0):
+        return self.transport.Transfer(self, data, report_id)
+
+    def close(self):
+        pass
+
+
+class SimulatedTransport:
+    # Transport for MSIKeyboard that talks to a SimulatedController instead
+    # of hidapi. Every transfer takes latency plus up to jitter seconds (on
+    # the writer thread, like a real USB control transfer) and fails with
+    # OSError with probability error_rate. With probability disconnect_rate
+    # a transfer unplugs the device for unplug_time seconds: the open handle
+    # and every Open until then fail, like a controller that dropped off the
+    # bus.
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, disconnect_rate=0.0, unplug_time=1.0, connect_latency=0.0, seed=None):
+        self.controller = SimulatedController()
+        self.latency = latency
+        self.jitter = jitter
+        self.errorRate = error_rate
+        self.disconnectRate = disconnect_rate
+        self.unplugTime = unplug_time
+        self.connectLatency = connect_latency
+        # Imported here, the daemon only loads this module for simulation
+        import random
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        # Bumped by every unplug, handles of an older generation are dead
+        self.generation = 0
+        self.unpluggedUntil = 0.0
+        self.transfers = 0
+        self.injectedErrors = 0
+        self.disconnects = 0
+
+    def Open(self, keyboard):
+        if self.connectLatency > 0:
+            time.sleep(self.connectLatency)
+        with self.lock:
+            if not self._isPresent():
+                raise OSError(errno.ENODEV, "Simulated keyboard is unplugged")
+            return SimulatedDevice(self, self.generation)
+
+    def Transfer(self, device, data, report_id):
+        delay = self.latency
+        if self.jitter > 0:
+            delay += self.random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.transfers += 1
+            if device.generation != self.generation:
+                raise OSError(errno.ENODEV, "Simulated keyboard is unplugged")
+            roll = self.random.random()
+            if roll < self.disconnectRate:
+                self._unplug(self.unplugTime)
+                raise OSError(errno.ENODEV, "Simulated keyboard disconnected")
+            if roll < self.disconnectRate + self.errorRate:
+                self.injectedErrors += 1
+                raise OSError(errno.EIO, "Simulated transfer error")
+        self.controller.Receive(data, report_id)
+        return len(data) + 1
+
+    def Unplug(self, duration=None):
+        # For duration seconds, or until Plug if None
+        with self.lock:
+            self._unplug(duration)
+
+    def Plug(self):
+        with self.lock:
+            self.unpluggedUntil = 0.0
+
+    def IsPresent(self):
+        with self.lock:
+            return self._isPresent()
+
+    def GetStats(self):
+        with self.lock:
+            return (self.transfers, self.injectedErrors, self.disconnects)
+
+    def _isPresent(self):
+        return self.unpluggedUntil is not None and time.monotonic() >= self.unpluggedUntil
+
+    def _unplug(self, duration):
+        self.generation += 1
+        self.disconnects += 1
+        self.unpluggedUntil = time.monotonic() + duration if duration is not None else None
+        msikblog.Info("Simulated keyboard unplugged for %s seconds", duration if duration is not None else "unlimited")
+
+
+# Option name -> type, for ParseOptions
+OPTIONS = {
+    'devices': int,
+    'latency': float,
+    'jitter': float,
+    'error_rate': float,
+    'disconnect_rate': float,
+    'unplug_time': float,
+    'connect_latency': float,
+    'seed': int
+}
+
+
+def ParseOptions(spec):
+    # 'latency=0.002,error_rate=0.01' -> {'latency': 0.002, 'error_rate': 0.01}
+    options = {}
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        name, sep, value = item.partition('=')
+        name = name.strip()
+        if not sep or name not in OPTIONS:
+            raise ValueError("unknown simulator option '" + item.strip() + "', expected one of: " + ", ".join(OPTIONS))
+        try:
+            options[name] = OPTIONS[name](value)
+        except ValueError:
+            raise ValueError("invalid value for simulator option '" + name + "': '" + value + "'")
+        if options[name] < 0:
+            raise ValueError("simulator option '" + name + "' can't be negative")
+    if options.get('devices', 1) < 1:
+        raise ValueError("simulator option 'devices' must be at least 1")
+    return options
+
+
+def CreateKeyboards(devices=1, seed=None, **options):
+    # MSIKeyboards backed by independent simulated controllers, named sim0,
+    # sim1 and so on. Each gets its own random stream derived from seed.
+    keyboards = []
+    for index in range(devices):
+        transport = SimulatedTransport(seed=None if seed is None else seed + index, **options)
+        keyboards.append(msikbapi.MSIKeyboard(('sim' + str(index)).encode(), transport))
+    return keyboards
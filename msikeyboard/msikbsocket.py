@@ -0,0 +1,364 @@
+# Control endpoint on a UNIX domain socket, for local programs that change
+# the backlight at a high rate (effect producers) without going through the
+# D-Bus broker. Served from the daemon's GLib main loop and calling the same
+# methods as the D-Bus interface, so both see and change the same state.
+#
+# Every request is REQUEST.size bytes and answered by one RESPONSE.size
+# response carrying its request ID. Requests may be pipelined; responses of
+# requests with FLAG_WAIT are sent once the keyboard is written, so they may
+# arrive after responses to later requests. Access is controlled by the
+# socket file's owner, group and mode.
+
+import grp
+import os
+import socket
+import stat
+import struct
+from queue import Full
+from msikeyboard import msikblog
+from msikeyboard import msikbstats
+
+# Imported when the server is started, the client doesn't need it
+GLib = None
+
+
+def _importGLib():
+    global GLib
+    if GLib is None:
+        from gi.repository import GLib
+
+
+# opcode, target, flags, request ID, 12 payload bytes
+REQUEST = struct.Struct('<BBHI12s')
+# opcode, status, reserved, request ID, last mode index (-1 if not set),
+# number of configured modes, state flags, writes pending (at most 255)
+RESPONSE = struct.Struct('<BBHIiHBB')
+# Payloads
+MODE_PAYLOAD = struct.Struct('<I8x')
+# Per zone 1-3: set (0 or 1), r, g, b
+ZONES_PAYLOAD = struct.Struct('<12B')
+
+# Opcodes
+OP_SET_MODE = 1
+OP_SET_ZONE_COLORS = 2
+OP_QUERY_STATE = 3
+
+OP_NAMES = {OP_SET_MODE: 'set_mode', OP_SET_ZONE_COLORS: 'set_zone_colors', OP_QUERY_STATE: 'query_state'}
+# Stats labels
+OP_LABELS = {opcode: 'op="' + name + '"' for opcode, name in OP_NAMES.items()}
+
+# Targets: all keyboards, or the device index
+TARGET_ALL = 0xFF
+
+# Request flags
+FLAG_WAIT = 0x0001
+
+# Statuses
+STATUS_OK = 0
+STATUS_INVALID = 1
+STATUS_BUSY = 2
+STATUS_FAILED = 3
+STATUS_CANCELLED = 4
+
+# State flags
+STATE_SCENE = 0x01
+STATE_BUSY = 0x02
+
+
+class ControlServer:
+    # Listens on path and serves clients from the main loop. Per connection
+    # at most MAX_WAITING requests wait for the keyboard and at most
+    # MAX_OUTPUT bytes of responses are buffered; beyond that requests already
+    # received wait in the input buffer and the connection isn't read until
+    # the client catches up, so a flooding client is slowed down by its own
+    # socket buffer.
+    MAX_WAITING = 64
+    MAX_OUTPUT = 64 * 1024
+
+    def __init__(self, service, path, mode=0o600, group=None):
+        self.service = service
+        self.path = path
+        self.mode = mode
+        self.group = group
+        self.sock = None
+        self.watchId = None
+        self.connections = set()
+
+    def Start(self):
+        # Raises OSError or KeyError (unknown group)
+        _importGLib()
+        gid = grp.getgrnam(self.group).gr_gid if self.group is not None else -1
+        try:
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                # Left behind by a previous instance
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            # Never accessible to more users than configured, not even
+            # between bind and chmod
+            umask = os.umask(0o777 & ~self.mode)
+            try:
+                sock.bind(self.path)
+            finally:
+                os.umask(umask)
+            os.chown(self.path, -1, gid)
+            os.chmod(self.path, self.mode)
+            sock.listen(16)
+            sock.setblocking(False)
+        except OSError:
+            sock.close()
+            raise
+        self.sock = sock
+        self.watchId = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN, self._onAccept)
+        msikblog.Info("Control socket listening at %s", self.path)
+
+    def Stop(self):
+        for connection in list(self.connections):
+            connection.Close()
+        if self.watchId is not None:
+            GLib.source_remove(self.watchId)
+            self.watchId = None
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def HasClients(self):
+        return bool(self.connections)
+
+    def _onAccept(self, fd, condition):
+        try:
+            client, _ = self.sock.accept()
+        except BlockingIOError:
+            return True
+        except OSError as e:
+            msikblog.Warn("Can't accept control socket connection: %s", e)
+            return True
+        client.setblocking(False)
+        self.connections.add(_Connection(self, client))
+        msikbstats.stats.Count('socket_connections')
+        return True
+
+    def Handle(self, connection, opcode, target_index, flags, request_id, payload):
+        # Returns the response, or None if it is sent once the write is done
+        self.service._noteActivity()
+        if target_index == TARGET_ALL:
+            target = self.service
+        elif target_index < len(self.service.devices):
+            target = self.service.devices[target_index]
+        else:
+            return self._response(opcode, STATUS_INVALID, request_id)
+        if opcode == OP_QUERY_STATE:
+            return self._stateResponse(target, request_id)
+        try:
+            if opcode == OP_SET_MODE:
+                mode_index, = MODE_PAYLOAD.unpack(payload)
+                if not 0 <= mode_index < len(self.service.modes):
+                    return self._response(opcode, STATUS_INVALID, request_id)
+                future = target.SetModeImpl(mode_index)
+            elif opcode == OP_SET_ZONE_COLORS:
+                values = ZONES_PAYLOAD.unpack(payload)
+                zone_colors = [(zone + 1, values[zone * 4 + 1:zone * 4 + 4]) for zone in range(3) if values[zone * 4]]
+                if not zone_colors:
+                    return self._response(opcode, STATUS_INVALID, request_id)
+                future = target.SetZoneColorsImpl(zone_colors)
+            else:
+                return self._response(opcode, STATUS_INVALID, request_id)
+        except Full:
+            # Writer queue full of barrier writes
+            return self._response(opcode, STATUS_BUSY, request_id)
+        if future is None:
+            return self._response(opcode, STATUS_FAILED, request_id)
+        if not flags & FLAG_WAIT:
+            return self._response(opcode, STATUS_OK, request_id)
+        connection.waiting += 1
+
+        def deliver():
+            if future.cancelled():
+                status = STATUS_CANCELLED
+            elif future.exception() is not None:
+                status = STATUS_FAILED
+            else:
+                status = STATUS_OK
+            connection.waiting -= 1
+            connection.Send(self._response(opcode, status, request_id))
+            return False
+        future.add_done_callback(lambda f: GLib.idle_add(deliver))
+        return None
+
+    def _response(self, opcode, status, request_id):
+        return RESPONSE.pack(opcode, status, 0, request_id, -1, 0, 0, 0)
+
+    def _stateResponse(self, target, request_id):
+        mode_index = target.GetLastModeIndexImpl()
+        devices = self.service.devices if target is self.service else [target]
+        flags = 0
+        if any(device.sceneMode is not None for device in devices):
+            flags |= STATE_SCENE
+        pending = sum(len(device.writer.queue) for device in devices)
+        if pending:
+            flags |= STATE_BUSY
+        return RESPONSE.pack(OP_QUERY_STATE, STATUS_OK, 0, request_id, mode_index if mode_index is not None else -1,
+                             min(len(self.service.modes), 0xFFFF), flags, min(pending, 0xFF))
+
+
+class _Connection:
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.input = bytearray()
+        self.output = bytearray()
+        self.waiting = 0
+        self.readId = None
+        self.writeId = None
+        self.isClosed = False
+        self._updateWatches()
+
+    def _isBlocked(self):
+        return len(self.output) >= self.server.MAX_OUTPUT or self.waiting >= self.server.MAX_WAITING
+
+    def _updateWatches(self):
+        isReading = not self._isBlocked()
+        if isReading and self.readId is None:
+            self.readId = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR, self._onReadable)
+        elif not isReading and self.readId is not None:
+            GLib.source_remove(self.readId)
+            self.readId = None
+        if self.output and self.writeId is None:
+            self.writeId = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR, self._onWritable)
+        elif not self.output and self.writeId is not None:
+            GLib.source_remove(self.writeId)
+            self.writeId = None
+
+    def _onReadable(self, fd, condition):
+        try:
+            data = self.sock.recv(65536)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            self.Close()
+            return False
+        self.input += data
+        self._handleInput()
+        self._flush()
+        if self.isClosed:
+            return False
+        # The watch is removed by _updateWatches when backpressure starts
+        return self.readId is not None
+
+    def _handleInput(self):
+        # Handles the complete requests received until a limit is reached,
+        # the rest is kept and handled by _flush once a waiting request
+        # completes or the output drains
+        offset = 0
+        while len(self.input) - offset >= REQUEST.size and not self._isBlocked():
+            opcode, target, flags, request_id, payload = REQUEST.unpack_from(self.input, offset)
+            offset += REQUEST.size
+            with msikbstats.stats.Timed('socket_request', OP_LABELS.get(opcode, 'op="unknown"')):
+                response = self.server.Handle(self, opcode, target, flags, request_id, payload)
+            if response is not None:
+                self.output += response
+        del self.input[:offset]
+
+    def _onWritable(self, fd, condition):
+        self.writeId = None
+        self._flush()
+        return False
+
+    def Send(self, response):
+        if self.isClosed:
+            return
+        self.output += response
+        self._flush()
+
+    def _flush(self):
+        while True:
+            if self.output:
+                try:
+                    sent = self.sock.send(self.output)
+                    del self.output[:sent]
+                except BlockingIOError:
+                    pass
+                except OSError:
+                    self.Close()
+                    return
+            if len(self.input) < REQUEST.size or self._isBlocked():
+                break
+            # Below the limits again, handle the requests held back
+            self._handleInput()
+        self._updateWatches()
+
+    def Close(self):
+        if self.isClosed:
+            return
+        self.isClosed = True
+        for watchId in (self.readId, self.writeId):
+            if watchId is not None:
+                GLib.source_remove(watchId)
+        self.readId = self.writeId = None
+        self.sock.close()
+        self.server.connections.discard(self)
+
+
+class ControlClient:
+    # Blocking client. Send* queue requests without waiting, Receive returns
+    # the next response as (opcode, status, request ID, mode index, modes,
+    # state flags, writes pending); the other methods are round trips.
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.requestId = 0
+        self.input = bytearray()
+
+    def Close(self):
+        self.sock.close()
+
+    def _send(self, opcode, target, flags, payload):
+        self.requestId = (self.requestId + 1) & 0xFFFFFFFF
+        self.sock.sendall(REQUEST.pack(opcode, target, flags, self.requestId, payload))
+        return self.requestId
+
+    def SendSetMode(self, mode_index, target=TARGET_ALL, wait=False):
+        return self._send(OP_SET_MODE, target, FLAG_WAIT if wait else 0, MODE_PAYLOAD.pack(mode_index))
+
+    def SendSetZoneColors(self, zone_colors, target=TARGET_ALL, wait=False):
+        # zone_colors: {zone 1-3: (r, g, b)}
+        values = [0] * 12
+        for zone, color in zone_colors.items():
+            values[(zone - 1) * 4:zone * 4] = (1,) + tuple(color)
+        return self._send(OP_SET_ZONE_COLORS, target, FLAG_WAIT if wait else 0, ZONES_PAYLOAD.pack(*values))
+
+    def SendQueryState(self, target=TARGET_ALL):
+        return self._send(OP_QUERY_STATE, target, 0, bytes(12))
+
+    def Receive(self):
+        while len(self.input) < RESPONSE.size:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError("Control socket closed by the service")
+            self.input += data
+        opcode, status, _, request_id, mode_index, modes, flags, pending = RESPONSE.unpack_from(self.input)
+        del self.input[:RESPONSE.size]
+        return (opcode, status, request_id, mode_index, modes, flags, pending)
+
+    def _call(self, request_id):
+        while True:
+            response = self.Receive()
+            if response[2] == request_id:
+                return response
+
+    def SetMode(self, mode_index, target=TARGET_ALL, wait=False):
+        return self._call(self.SendSetMode(mode_index, target, wait))[1]
+
+    def SetZoneColors(self, zone_colors, target=TARGET_ALL, wait=False):
+        return self._call(self.SendSetZoneColors(zone_colors, target, wait))[1]
+
+    def QueryState(self, target=TARGET_ALL):
+        return self._call(self.SendQueryState(target))
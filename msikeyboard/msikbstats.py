@@ -0,0 +1,132 @@
+import bisect
+import os
+import threading
+import time
+from msikeyboard import msikblog
+
+# Monotonic nanosecond clock, a vDSO call without float conversion
+clock = time.perf_counter_ns
+
+# Upper bounds of the latency histogram buckets in seconds, +Inf is implied.
+# USB control transfers take about a millisecond, anything past 100 ms is a
+# stalled device.
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+_BUCKETS_NS = tuple(int(bound * 1e9) for bound in BUCKETS)
+
+
+def _seriesName(name, labels):
+    return name + '{' + labels + '}' if labels else name
+
+
+class Histogram:
+    def __init__(self):
+        # Per-bucket (not cumulative) counts, the last one is +Inf
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.sumNs = 0
+        self.count = 0
+
+    def Observe(self, duration_ns):
+        self.counts[bisect.bisect_left(_BUCKETS_NS, duration_ns)] += 1
+        self.sumNs += duration_ns
+        self.count += 1
+
+
+class Stats:
+    # Counters and latency histograms of the whole process, updated from the
+    # main loop and the writer threads. Series are keyed by name and an
+    # optional Prometheus label string, e.g. 'method="SetMode"'.
+    PREFIX = 'msikeyboard_'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def Count(self, name, labels='', value=1):
+        key = (name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def Observe(self, name, duration_ns, labels=''):
+        key = (name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.Observe(duration_ns)
+
+    def Timed(self, name, labels=''):
+        # Context manager observing name + '_seconds' and counting
+        # name + '_errors' if the block raises
+        return _Timer(self, name, labels)
+
+    def Snapshot(self):
+        # Returns (counters, histograms) keyed by series name, histograms as
+        # (sum in seconds, count, per-bucket counts)
+        with self.lock:
+            counters = {_seriesName(name, labels): value for (name, labels), value in self.counters.items()}
+            histograms = {_seriesName(name, labels): (histogram.sumNs / 1e9, histogram.count, list(histogram.counts))
+                          for (name, labels), histogram in self.histograms.items()}
+        return counters, histograms
+
+    def FormatPrometheus(self):
+        # Text exposition format, for the node_exporter textfile collector
+        with self.lock:
+            counters = sorted(self.counters.items())
+            histograms = sorted((key, (histogram.sumNs, histogram.count, list(histogram.counts))) for key, histogram in self.histograms.items())
+        lines = []
+        lastName = None
+        for (name, labels), value in counters:
+            metric = self.PREFIX + name + '_total'
+            if name != lastName:
+                lines.append('# TYPE ' + metric + ' counter')
+                lastName = name
+            lines.append(_seriesName(metric, labels) + ' ' + str(value))
+        lastName = None
+        for (name, labels), (sumNs, count, counts) in histograms:
+            metric = self.PREFIX + name
+            if name != lastName:
+                lines.append('# TYPE ' + metric + ' histogram')
+                lastName = name
+            prefix = labels + ',' if labels else ''
+            cumulative = 0
+            for bound, bucket_count in zip(BUCKETS + ('+Inf',), counts):
+                cumulative += bucket_count
+                lines.append(metric + '_bucket{' + prefix + 'le="' + str(bound) + '"} ' + str(cumulative))
+            lines.append(_seriesName(metric + '_sum', labels) + ' ' + repr(sumNs / 1e9))
+            lines.append(_seriesName(metric + '_count', labels) + ' ' + str(count))
+        return '\n'.join(lines) + '\n'
+
+    def WritePrometheus(self, file_name):
+        # Written to a temporary file and renamed, so the collector never
+        # reads a partial file
+        temp_name = file_name + '.tmp'
+        try:
+            with open(temp_name, 'w') as prom_file:
+                prom_file.write(self.FormatPrometheus())
+            os.replace(temp_name, file_name)
+            return True
+        except OSError as e:
+            msikblog.Warn("Can't write stats to '%s': %s", file_name, e)
+            return False
+
+
+class _Timer:
+    def __init__(self, stats, name, labels):
+        self.stats = stats
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = clock()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stats.Observe(self.name + '_seconds', clock() - self.start, self.labels)
+        if exc_type is not None:
+            self.stats.Count(self.name + '_errors', self.labels)
+        return False
+
+
+# The process-wide registry
+stats = Stats()
@@ -0,0 +1,289 @@
+#!/usr/bin/python3
+
+# HID traffic traces: every report MSIKeyboard writes (or skips, or fails to
+# write) and every connect and disconnect, as fixed-size binary records
+# after a fixed-size header, so a trace can be memory-mapped and indexed.
+#
+#   python3 -m msikeyboard.msikbtrace dump TRACE
+#   python3 -m msikeyboard.msikbtrace replay TRACE [--speed X] [--simulate [OPTIONS]]
+
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from msikeyboard import msikblog
+
+# CLOCK_MONOTONIC in ns, comparable across processes of the same boot
+clock = time.monotonic_ns
+
+MAGIC = b'MSIKBTRC'
+VERSION = 1
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# magic, version, record size, boot ID, monotonic and wall clock time of the
+# start of the trace in ns. Monotonic time restarts with every boot, so a
+# trace only has records of one boot.
+HEADER = struct.Struct('<8sHH4x16sqq')
+# monotonic time in ns, duration of the transfer in us, device index,
+# outcome, report ID, report length, report bytes
+RECORD = struct.Struct('<qIBBBB8s')
+MAX_REPORT_LENGTH = 8
+
+# Outcomes
+SENT = 0
+SKIPPED = 1
+FAILED = 2
+CONNECTED = 3
+CONNECT_FAILED = 4
+DISCONNECTED = 5
+
+OUTCOME_NAMES = {SENT: 'sent', SKIPPED: 'skipped', FAILED: 'failed', CONNECTED: 'connected', CONNECT_FAILED: 'connect-failed', DISCONNECTED: 'disconnected'}
+
+TraceRecord = namedtuple('TraceRecord', ['time', 'duration', 'device', 'outcome', 'reportId', 'report'])
+
+
+def _bootId():
+    try:
+        with open(BOOT_ID_PATH) as boot_id_file:
+            # A UUID, parsed without importing uuid (and its dependencies)
+            # for a faster daemon start
+            boot_id = bytes.fromhex(boot_id_file.read().strip().replace('-', ''))
+        if len(boot_id) != 16:
+            raise ValueError()
+        return boot_id
+    except (OSError, ValueError):
+        return bytes(16)
+
+
+class TraceRecorder:
+    # Appends records to a trace file through a preallocated buffer: Record
+    # packs into it in place and the buffer is written out when full, at
+    # most a second after the first record it holds (by a timer thread armed
+    # only while records are waiting) or right after a disconnect (e.g. on
+    # suspend). Once the file exceeds max_size bytes it is moved to
+    # file_name + '.1' and a new trace is started. Thread-safe, keyboards
+    # record from their writer threads.
+    BUFFER_RECORDS = 256
+    FLUSH_INTERVAL_NS = 1000000000
+
+    def __init__(self, file_name, max_size=16 * 1024 * 1024):
+        self.fileName = file_name
+        self.maxSize = max_size
+        self.buffer = bytearray(RECORD.size * self.BUFFER_RECORDS)
+        self.count = 0
+        self.lock = threading.Lock()
+        self.flushedAt = clock()
+        # Flushes records left in the buffer after a burst of writes
+        self.timer = None
+        self.recordsWritten = 0
+        self.file = None
+        self.size = 0
+        self._open()
+
+    def _open(self):
+        # Appends to the trace of an earlier process of this boot, a trace of
+        # another boot (or in another format) is moved away first
+        bootId = _bootId()
+        self.file = open(self.fileName, 'a+b')
+        self.size = self.file.seek(0, os.SEEK_END)
+        if self.size > 0:
+            self.file.seek(0)
+            header = self.file.read(HEADER.size)
+            if len(header) < HEADER.size or HEADER.unpack(header)[:4] != (MAGIC, VERSION, RECORD.size, bootId):
+                self.file.close()
+                os.replace(self.fileName, self.fileName + '.1')
+                self.file = open(self.fileName, 'a+b')
+                self.size = 0
+            elif (self.size - HEADER.size) % RECORD.size:
+                # Cut short by a crash, drop the partial record
+                self.file.truncate(self.size - (self.size - HEADER.size) % RECORD.size)
+                self.size = self.file.seek(0, os.SEEK_END)
+        if self.size == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size, bootId, clock(), time.time_ns()))
+            self.size = HEADER.size
+
+    def Record(self, device, outcome, report=b'', report_id=b'\x00', start=None):
+        # start: clock() before the transfer, for its duration
+        now = clock()
+        duration = min((now - start) // 1000, 0xFFFFFFFF) if start is not None else 0
+        with self.lock:
+            if self.file is None:
+                return
+            RECORD.pack_into(self.buffer, self.count * RECORD.size, now, duration, device, outcome, report_id[0], min(len(report), MAX_REPORT_LENGTH), report)
+            self.count += 1
+            if self.count == self.BUFFER_RECORDS or outcome == DISCONNECTED or now - self.flushedAt > self.FLUSH_INTERVAL_NS:
+                self._flush(now)
+            elif self.timer is None:
+                self.timer = threading.Timer(self.FLUSH_INTERVAL_NS / 1e9, self._onTimer)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def _onTimer(self):
+        with self.lock:
+            self.timer = None
+            self._flush(clock())
+
+    def Flush(self):
+        with self.lock:
+            self._flush(clock())
+
+    def Close(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self._flush(clock())
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def _flush(self, now):
+        self.flushedAt = now
+        if not self.count or self.file is None:
+            return
+        try:
+            self.file.write(memoryview(self.buffer)[:self.count * RECORD.size])
+            self.file.flush()
+            self.size += self.count * RECORD.size
+            self.recordsWritten += self.count
+            if self.size >= self.maxSize:
+                self.file.close()
+                os.replace(self.fileName, self.fileName + '.1')
+                self._open()
+        except OSError as e:
+            msikblog.Error("Can't write HID trace to '%s', stopping it: %s", self.fileName, e)
+            self.file = None
+        self.count = 0
+
+
+class TraceReader:
+    # Memory-mapped trace, records are decoded on access
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as trace_file:
+            if os.fstat(trace_file.fileno()).st_size < HEADER.size:
+                raise ValueError("'" + file_name + "' is not a HID trace")
+            self.map = mmap.mmap(trace_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.bootId, self.startTime, self.startWallTime = HEADER.unpack_from(self.map)
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+            self.map.close()
+            raise ValueError("'" + file_name + "' is not a version " + str(VERSION) + " HID trace")
+        # A partial record at the end is ignored
+        self.count = (len(self.map) - HEADER.size) // RECORD.size
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError("trace record index out of range")
+        return self._decode(RECORD.unpack_from(self.map, HEADER.size + index * RECORD.size))
+
+    def __iter__(self):
+        view = memoryview(self.map)[HEADER.size:HEADER.size + self.count * RECORD.size]
+        try:
+            for fields in RECORD.iter_unpack(view):
+                yield self._decode(fields)
+        finally:
+            view.release()
+
+    @staticmethod
+    def _decode(fields):
+        timestamp, duration, device, outcome, report_id, length, report = fields
+        return TraceRecord(timestamp, duration, device, outcome, bytes((report_id,)), report[:length])
+
+    def WallTime(self, record):
+        # Wall clock time of a record in seconds since the epoch
+        return (self.startWallTime + record.time - self.startTime) / 1e9
+
+    def Close(self):
+        self.map.close()
+
+
+def Replay(reader, keyboard, speed=1.0, device=None, out=sys.stdout):
+    # Write the sent and failed reports of a trace to keyboard with the
+    # original timing divided by speed, 0 for as fast as possible. Reports
+    # are written unconditionally, the shadow registers don't drop any.
+    # Returns the number of reports written.
+    written = 0
+    first = None
+    start = clock()
+    for record in reader:
+        if device is not None and record.device != device:
+            continue
+        if record.outcome not in (SENT, FAILED):
+            continue
+        if first is None:
+            first = record.time
+        if speed > 0:
+            delay = (record.time - first) / speed - (clock() - start)
+            if delay > 0:
+                time.sleep(delay / 1e9)
+        try:
+            keyboard.EnsureConnected()
+            keyboard._writeToDevice(record.report, force=True)
+            written += 1
+        except OSError as e:
+            print("Report " + record.report.hex() + " failed: " + str(e), file=out)
+    return written
+
+
+def _formatRecord(reader, record):
+    wall_time = reader.WallTime(record)
+    stamp = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(wall_time)) + ('%.6f' % (wall_time % 1))[1:]
+    line = stamp + ' dev' + str(record.device) + ' ' + OUTCOME_NAMES.get(record.outcome, str(record.outcome))
+    if record.report:
+        line += ' ' + record.report.hex()
+    if record.duration:
+        line += ' ' + str(record.duration) + 'us'
+    return line
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Show or replay msikeyboard HID traces")
+    commands = parser.add_subparsers(dest='command', required=True)
+    dump_parser = commands.add_parser('dump', help="print the records of a trace")
+    dump_parser.add_argument('trace', help="trace file")
+    replay_parser = commands.add_parser('replay', help="write the reports of a trace to a keyboard")
+    replay_parser.add_argument('trace', help="trace file")
+    replay_parser.add_argument('--speed', type=float, default=1.0, help="timing speed-up, 0 - as fast as possible")
+    replay_parser.add_argument('--device', type=int, help="only replay reports of the device with this index")
+    replay_parser.add_argument('--path', help="HID device node of the keyboard, the first matching one by default")
+    replay_parser.add_argument('--simulate', nargs='?', const='', metavar='OPTIONS', help="replay to a simulated keyboard, see msikeyboardd --simulate")
+    args = parser.parse_args()
+    try:
+        reader = TraceReader(args.trace)
+    except (OSError, ValueError) as e:
+        print("Can't open trace: " + str(e), file=sys.stderr)
+        sys.exit(2)
+
+    if args.command == 'dump':
+        try:
+            for record in reader:
+                print(_formatRecord(reader, record))
+        except BrokenPipeError:
+            pass
+        return
+
+    from msikeyboard import msikbapi
+    from msikeyboard import msikbsim
+    if args.simulate is not None:
+        try:
+            keyboard, = msikbsim.CreateKeyboards(**dict(msikbsim.ParseOptions(args.simulate), devices=1))
+        except ValueError as e:
+            parser.error(str(e))
+    else:
+        keyboard = msikbapi.MSIKeyboard(args.path.encode() if args.path is not None else None)
+    written = Replay(reader, keyboard, args.speed, args.device)
+    print(str(written) + " report(s) replayed")
+    if args.simulate is not None:
+        mode, zone_colors, attributes = keyboard.transport.controller.GetState()
+        print("Simulated keyboard state: mode " + str(mode) + ", zone colors " + str(zone_colors) + ", attributes " + str(attributes))
+
+if __name__ == "__main__":
+    main()
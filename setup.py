@@ -34,12 +34,18 @@ setup(
     packages=find_packages(),
     data_files = [("/etc/msikeyboard/",  ["data/config.yaml"])], 
     entry_points = {
-        'console_scripts': ['msikeyboardd=msikeyboard.msikblightd:main'], 
+        'console_scripts': [
+            'msikeyboardd=msikeyboard.msikblightd:main', 
+            'msikeyboard=msikeyboard.msikbctl:main'
+        ], 
     }, 
     install_requires = [
         "hidapi-cffi", 
         "dbus-python", 
         "pyyaml", 
         "pygobject"
-    ]
+    ], 
+    extras_require = {
+        'audio': ["numpy"], 
+    }
 )